@@ -13,6 +13,9 @@ def create_app():
 
     app.secret_key = os.environ.get('FLASK_SECRET_KEY')
     app.debug = os.environ.get('FLASK_DEBUG') == '1'
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get(
+        'X_ACCEL_REDIRECT_PREFIX')
 
     if not app.debug:
         file_handler = logging.FileHandler('server.log')
@@ -6,20 +6,84 @@ application that is used for running background tasks.
 
 from celery import Celery
 from datetime import timedelta
+from kombu import Queue
 import os
 
 celery_app = Celery('gepify')
 
+# The tasks are split in queues which are consumed by separate workers,
+# so downloading a big playlist does not delay the songs requested by
+# other users:
+#   songs - single songs requested by the users
+#   playlist_songs - the songs of the playlists which are downloaded,
+#                    sent in turns for the different users
+#   playlists - assembling playlists and cleaning up old files
+SONGS_QUEUE = 'songs'
+PLAYLIST_SONGS_QUEUE = 'playlist_songs'
+PLAYLISTS_QUEUE = 'playlists'
+# Tasks with higher priority are taken first from a shared queue
+MAX_PRIORITY = 9
+INTERACTIVE_PRIORITY = 9
+PLAYLIST_PRIORITY = 6
+BULK_PRIORITY = 3
+
+
+def _queue(name):
+    return Queue(name, routing_key=name,
+                 queue_arguments={'x-max-priority': MAX_PRIORITY})
+
+
 celery_app.conf.update(
     BROKER_URL=os.environ.get('CELERY_BROKER_URL'),
     CELERY_RESULT_BACKEND=os.environ.get('CELERY_BACKEND'),
     CELERY_TASK_SERIALIZER='json',
     CELERY_ACCEPT_CONTENT=['json'],
     CELERY_RESULT_SERIALIZER='json',
+    CELERY_QUEUES=[
+        _queue(SONGS_QUEUE),
+        _queue(PLAYLIST_SONGS_QUEUE),
+        _queue(PLAYLISTS_QUEUE)
+    ],
+    # Tasks without a route (e.g. internal celery tasks) go to this queue
+    CELERY_DEFAULT_QUEUE=PLAYLISTS_QUEUE,
+    CELERY_ROUTES={
+        'gepify.providers.songs.download_song': {
+            'queue': SONGS_QUEUE,
+            'routing_key': SONGS_QUEUE,
+            'priority': INTERACTIVE_PRIORITY
+        },
+        'gepify.providers.playlists.download_playlist_song': {
+            'queue': PLAYLIST_SONGS_QUEUE,
+            'routing_key': PLAYLIST_SONGS_QUEUE,
+            'priority': BULK_PRIORITY
+        },
+        'gepify.providers.playlists.*': {
+            'queue': PLAYLISTS_QUEUE,
+            'routing_key': PLAYLISTS_QUEUE,
+            'priority': PLAYLIST_PRIORITY
+        },
+        'gepify.providers.songs.evict_songs': {
+            'queue': PLAYLISTS_QUEUE,
+            'routing_key': PLAYLISTS_QUEUE,
+            'priority': BULK_PRIORITY
+        }
+    },
+    # Workers take only one task at a time, so the waiting tasks are not
+    # held by a busy worker while another one is free and the priorities
+    # are respected.
+    CELERYD_PREFETCH_MULTIPLIER=1,
     CELERYBEAT_SCHEDULE={
         'clean-playlists': {
             'task': 'gepify.providers.playlists.clean_playlists',
             'schedule': timedelta(hours=1)
+        },
+        'evict-songs': {
+            'task': 'gepify.providers.songs.evict_songs',
+            'schedule': timedelta(hours=1)
+        },
+        'dispatch-playlist-songs': {
+            'task': 'gepify.providers.playlists.dispatch_playlist_songs',
+            'schedule': timedelta(minutes=1)
         }
     }
 )
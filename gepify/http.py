@@ -0,0 +1,77 @@
+"""HTTP sessions.
+
+This module provides sessions for the HTTP requests made to the APIs of
+the services (e.g. for authenticating users and getting their playlists).
+Every upstream has its own session, so the connections to it are kept
+open and reused by the following requests.
+"""
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import requests
+
+# Seconds to wait for connecting to the server and for its response.
+TIMEOUT = (5, 30)
+# Number of times a request is retried after connection errors
+# or temporary errors of the server.
+RETRIES = 3
+# Exponential backoff between the retries (0.5s, 1s, 2s).
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class Session(requests.Session):
+    """Session with timeouts and retries for the requests to a service.
+
+    Only the requests which are safe to repeat are retried after the
+    server has received them. Other requests (e.g. requesting an access
+    token from an authentication code) are retried only if they could
+    not be sent. The connections are not shared with forked processes
+    (e.g. the celery workers).
+
+    Parameters
+    ----------
+    pool_maxsize : (optional) int
+        Maximum number of connections kept open to each host.
+    timeout : (optional) float or tuple
+        The default timeout for the requests.
+    retry_sent_requests : (optional) bool
+        Whether to retry the requests which are safe to repeat after the
+        server has received them. Should be False for services which
+        use them for things that can not be repeated (e.g. deezer
+        exchanges authentication codes with GET requests).
+    """
+
+    def __init__(self, pool_maxsize=10, timeout=TIMEOUT,
+                 retry_sent_requests=True):
+        super().__init__()
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.retry_sent_requests = retry_sent_requests
+        self._mount_adapters()
+
+    def _mount_adapters(self):
+        self.pid = os.getpid()
+        retry = Retry(
+            total=RETRIES,
+            # Read errors and error responses mean the server has
+            # received the request.
+            read=None if self.retry_sent_requests else 0,
+            status=None if self.retry_sent_requests else 0,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_maxsize=self.pool_maxsize, max_retries=retry)
+
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if self.pid != os.getpid():
+            self._mount_adapters()
+
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
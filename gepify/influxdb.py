@@ -5,31 +5,126 @@ used for collecting various statistics and metrics.
 """
 
 from influxdb import InfluxDBClient
+import atexit
+import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two writes of the collected metrics to InfluxDB.
+FLUSH_INTERVAL = int(os.environ.get('INFLUXDB_FLUSH_INTERVAL', 10))
+# Maximum number of different metrics kept between two writes.
+# Counts of metrics above this limit are dropped.
+MAX_METRICS = 1000
+# Seconds to wait for InfluxDB to respond.
+TIMEOUT = 5
 
 
 class Client:
-    def __init__(self):
+    """Collects counters in memory and writes them to InfluxDB in batches.
+
+    Counting never waits for InfluxDB. The counters are written every
+    `flush_interval` seconds by a background thread and once more when
+    the process exits. The connection to InfluxDB is made by the first
+    write, so it does not slow down starting the application. If
+    InfluxDB is not configured counting does nothing.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL,
+                 max_metrics=MAX_METRICS):
         host = os.environ.get('INFLUXDB_HOST')
         port = os.environ.get('INFLUXDB_PORT', 8086)
         username = os.environ.get('INFLUXDB_USER', 'root')
         password = os.environ.get('INFLUXDB_USER_PASSWORD', 'root')
         database = os.environ.get('INFLUXDB_DB', 'gepify')
 
+        self.flush_interval = flush_interval
+        self.max_metrics = max_metrics
+        self.counters = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.flusher_pid = None
+
+        self.connection_options = (host, port, username, password, database)
+        self.enabled = bool(host)
         self.client = None
-        if host:
-            self.client = InfluxDBClient(
-                    host, port, username, password, database)
-            self.client.create_database(database)
+
+        if self.enabled:
+            atexit.register(self.flush)
 
     def count(self, metric):
-        if self.client:
-            self.client.write_points([{
+        """Increase a counter by one."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if metric in self.counters:
+                self.counters[metric] += 1
+            elif len(self.counters) < self.max_metrics:
+                self.counters[metric] = 1
+            else:
+                self.dropped += 1
+
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # Threads do not survive forking, so every process (e.g. gunicorn
+        # or celery workers) needs to start its own flusher.
+        if self.flusher_pid == os.getpid():
+            return
+
+        self.flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write the collected counters to InfluxDB and reset them."""
+
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped > 0:
+            logger.warning('Dropped {} metrics'.format(dropped))
+
+        if len(counters) == 0:
+            return
+
+        client = self._get_client()
+        if client is None:
+            logger.warning('Dropped {} metrics'.format(len(counters)))
+            return
+
+        try:
+            client.write_points([{
                 'measurement': metric,
                 'fields': {
-                    'value': 1
+                    'value': value
                 }
-            }])
+            } for metric, value in counters.items()])
+        except Exception:
+            logger.exception('Could not write metrics to InfluxDB')
 
-influxdb = Client()
+    def _get_client(self):
+        if self.client is None:
+            host, port, username, password, database = self.connection_options
+            try:
+                client = InfluxDBClient(
+                    host, port, username, password, database, timeout=TIMEOUT)
+                client.create_database(database)
+            except Exception:
+                logger.exception('Could not connect to InfluxDB')
+                return None
+
+            self.client = client
 
+        return self.client
+
+influxdb = Client()
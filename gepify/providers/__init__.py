@@ -12,8 +12,13 @@ import os
 DATA_DIRECTORY = os.environ.get('DATA_DIRECTORY', '.')
 SONGS_DIRECTORY = '{}/songs'.format(DATA_DIRECTORY)
 PLAYLISTS_DIRECTORY = '{}/playlists'.format(DATA_DIRECTORY)
+SOURCES_DIRECTORY = '{}/sources'.format(DATA_DIRECTORY)
 SUPPORTED_FORMATS = ('mp3', 'ogg', 'opus', 'aac')
 SUPPORTED_PROVIDERS = ('youtube', 'soundcloud')
+# Seconds for which the providers remember the results of song searches.
+SEARCH_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+# Seconds for which the providers remember that a song could not be found.
+NOT_FOUND_CACHE_TIMEOUT = 24 * 60 * 60
 MIMETYPES = {
     'mp3': 'audio/mpeg',
     'ogg': 'audio/ogg',
@@ -7,15 +7,21 @@
 """
 
 from werkzeug.contrib.cache import RedisCache
+from redis import WatchError
 from gepify.celery import celery_app
-from . import songs, PLAYLISTS_DIRECTORY
+from gepify.redis import redis_client
+from . import songs, youtube, PLAYLISTS_DIRECTORY, SUPPORTED_PROVIDERS
 from .songs import SUPPORTED_FORMATS
-from celery import chord
 from celery.utils.log import get_task_logger
 import zipfile
+from collections import OrderedDict
 from hashlib import md5
+import glob
+import json
 import os
+import struct
 import time
+import uuid
 
 cache = RedisCache(
     host=os.environ.get('REDIS_HOST', 'localhost'),
@@ -26,6 +32,30 @@ cache = RedisCache(
 )
 logger = get_task_logger(__name__)
 
+# Seconds after which a playlist archive which is not served is deleted
+PLAYLIST_TIMEOUT = 30 * 60
+# Sorted set of the playlist archives by the time they were last used
+PLAYLISTS_KEY = 'playlist_archives'
+# Set once the archives created before PLAYLISTS_KEY existed are added to it
+PLAYLISTS_INDEXED_KEY = 'playlist_archives_indexed'
+# Maximum number of playlist songs downloaded at the same time. It should
+# match the number of processes consuming the playlist_songs queue.
+MAX_CONCURRENT_SONGS = int(os.environ.get('PLAYLIST_SONGS_CONCURRENCY', 8))
+# Seconds after which a song which is still not downloaded is considered
+# lost (e.g. because its worker crashed), so another one can be started.
+SONG_DOWNLOAD_TIMEOUT = 60 * 60
+# Seconds for which an unfinished playlist download is kept
+PLAYLIST_JOB_TIMEOUT = 24 * 60 * 60
+# Seconds for which a stored playlist is kept (see `store_playlist`).
+# It should outlive the unfinished downloads of the playlist.
+STORED_PLAYLIST_TIMEOUT = PLAYLIST_JOB_TIMEOUT + SONG_DOWNLOAD_TIMEOUT
+
+# List of the users with playlist songs waiting to be downloaded,
+# in the order in which they take turns.
+WAITING_USERS_KEY = 'playlist_song_users'
+# Sorted set of the playlist songs being downloaded by their start time
+DOWNLOADING_SONGS_KEY = 'playlist_songs_downloading'
+
 
 def get_playlist(service, playlist, format):
     """Return information about a playlists if it exists.
@@ -77,6 +107,81 @@ def has_playlist(service, playlist, format):
     return playlist is not None and playlist != 'downloading'
 
 
+def _stored_playlist_key(playlist_ref):
+    return 'playlist_data_{}'.format(playlist_ref)
+
+
+def store_playlist(playlist):
+    """Store the information needed for downloading a playlist.
+
+    The tasks get a short reference to the stored playlist instead of
+    the whole playlist, so big playlists do not go through the broker.
+    Only the names of the songs and their ids by the providers are kept.
+
+    Parameters
+    ----------
+    playlist : dict
+        The playlist as returned by the services.
+
+    Returns
+    -------
+    str
+        A reference to the playlist (used by `load_playlist`). It is
+        the same for playlists with the same songs.
+    """
+
+    stored_playlist = json.dumps({
+        'id': playlist['id'],
+        'name': playlist['name'],
+        'tracks': [{
+            key: value for key, value in song.items()
+            if key == 'name' or key in SUPPORTED_PROVIDERS
+        } for song in playlist['tracks']]
+    }, sort_keys=True)
+    playlist_ref = md5(stored_playlist.encode('utf-8')).hexdigest()
+
+    redis_client.set(
+        _stored_playlist_key(playlist_ref), stored_playlist,
+        ex=STORED_PLAYLIST_TIMEOUT)
+    return playlist_ref
+
+
+def load_playlist(playlist_ref):
+    """Return a playlist stored with `store_playlist`.
+
+    Raises
+    ------
+    RuntimeError
+        If the playlist is no longer stored.
+    """
+
+    stored_playlist = redis_client.get(_stored_playlist_key(playlist_ref))
+    if stored_playlist is None:
+        raise RuntimeError('Playlist not found: {}'.format(playlist_ref))
+    return json.loads(stored_playlist.decode())
+
+
+def _touch_playlist(playlist_cache_key):
+    redis_client.execute_command(
+        'ZADD', PLAYLISTS_KEY, time.time(), playlist_cache_key)
+
+
+def mark_playlist_served(service, playlist, format):
+    """Record that a playlist was just served, so it is kept longer.
+
+    Parameters
+    ----------
+    service : str
+        The service which provided the playlist (e.g. spotify).
+    playlist : str
+        The id of the playlist.
+    format : str
+        The format of the songs in the playlist.
+    """
+
+    _touch_playlist('{}_{}_{}'.format(service, playlist, format))
+
+
 def checksum(tracks):
     """Return the checksum of the tracks.
 
@@ -100,44 +205,666 @@ def handle_error(playlist_cache_key):
     logger.error('An error occured while trying to download a playlist.'
                  ' Cache key: {}'.format(playlist_cache_key))
     cache.delete(playlist_cache_key)
+    songs.unpin_songs(playlist_cache_key)
 
 
-@celery_app.task
-def create_zip_playlist(playlist, service, checksum, format='mp3'):
-    playlist_cache_key = '{}_{}_{}'.format(service, playlist['id'], format)
-    playlist_zip_filename = '{}/{}.zip'.format(PLAYLISTS_DIRECTORY, playlist_cache_key)
-    playlist_zip = zipfile.ZipFile(playlist_zip_filename, 'w')
+def has_all_songs(playlist, format):
+    """Check if all songs of a playlist are downloaded in `format`.
+
+    Parameters
+    ----------
+    playlist : dict
+        The playlist as returned by the services. Each of its tracks
+        should contain the information returned by `songs.get_song`.
+    format : str
+        The format of the songs.
+
+    Returns
+    -------
+    bool
+        True if every song is downloaded in `format`, False otherwise.
+    """
+
+    return all(
+        track['files'].get(format) not in (None, 'downloading')
+        for track in playlist['tracks'])
+
+
+def _m3u_contents(playlist, format):
     playlist_m3u_contents = ['#EXTM3U']
 
-    for song_info in playlist['tracks']:
-        song = songs.get_song(song_info['name'])
-        playlist_zip.write(
-            song['files'][format], '{}.{}'.format(song['name'], format))
+    for song in playlist['tracks']:
         playlist_m3u_contents.append(
             '#EXTINF:{},{}\n{}.{}\n'.format(
                 -1, song['name'], song['name'], format)
         )
 
-    playlist_zip.writestr(
-        '{}.m3u'.format(playlist['name']),
-        bytes('\n'.join(playlist_m3u_contents), 'utf-8')
-    )
+    return bytes('\n'.join(playlist_m3u_contents), 'utf-8')
+
+
+class _ZipStream:
+    """Write-only file object which keeps what is written until popped."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _get_file_info(song, format):
+    """Return the recorded file info of a song if it is still accurate."""
+
+    file_info = song.get('file_info', {}).get(format)
+    if file_info is None:
+        return None
+
+    try:
+        stat = os.stat(song['files'][format])
+    except OSError:
+        return None
+
+    if (stat.st_size != file_info['size'] or
+            stat.st_mtime != file_info['mtime']):
+        return None
+
+    return file_info
+
+
+def _add_stored_entry(playlist_zip, filename, file_info):
+    """Register an uncompressed entry whose size and CRC-32 are known.
+
+    The entry is added at the current position of the archive, so its
+    contents can be copied right after the returned local header without
+    going through `zipfile`. Once they are written `start_dir` of the
+    archive has to be moved after them.
+
+    Returns
+    -------
+    bytes
+        The local file header of the entry.
+    """
+
+    date_time = time.localtime(max(file_info['mtime'], 315532800))[:6]
+    zinfo = zipfile.ZipInfo(filename, date_time)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = zinfo.compress_size = file_info['size']
+    zinfo.CRC = file_info['crc32']
+    zinfo.external_attr = 0o644 << 16
+    zinfo.header_offset = playlist_zip.fp.tell()
+
+    playlist_zip.filelist.append(zinfo)
+    playlist_zip.NameToInfo[filename] = zinfo
+
+    return zinfo.FileHeader()
+
+
+def _sendfile(source, destination, count, offset=0):
+    end = offset + count
+    while offset < end:
+        sent = os.sendfile(
+            destination.fileno(), source.fileno(), offset, end - offset)
+        if sent == 0:
+            raise RuntimeError('Unexpected end of file: {}'.format(
+                source.name))
+        offset += sent
+
+
+def _unique_songs(playlist):
+    # Songs which are repeated in the playlist are archived only once.
+    return list(OrderedDict(
+        (song['name'], song) for song in playlist['tracks']).values())
+
+
+def zip_playlist_size(playlist, format):
+    """Return the size of the archive generated by `stream_zip_playlist`.
+
+    The size is known in advance only if every song has recorded file
+    info (see `songs.get_file_info`), because the others are compressed
+    while they are archived.
+
+    Parameters
+    ----------
+    playlist : dict
+        The playlist as returned by the services. All of its songs should
+        be downloaded in `format` (see `has_all_songs`).
+    format : str
+        The format of the songs.
+
+    Returns
+    -------
+    int
+        The size of the archive in bytes.
+    None
+        If the size is not known in advance.
+    """
+
+    playlist_songs = _unique_songs(playlist)
+    file_infos = [_get_file_info(song, format) for song in playlist_songs]
+    if None in file_infos:
+        return None
+
+    # The archive is generated without the contents of the songs.
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as playlist_zip:
+        for song, file_info in zip(playlist_songs, file_infos):
+            song_filename = '{}.{}'.format(song['name'], format)
+            stream.write(
+                _add_stored_entry(playlist_zip, song_filename, file_info))
+            stream.pop()
+            stream.position += file_info['size']
+            playlist_zip.start_dir = stream.tell()
+
+        playlist_zip.writestr(
+            '{}.m3u'.format(playlist['name']),
+            _m3u_contents(playlist, format)
+        )
+
+    return stream.tell()
+
+
+def stream_zip_playlist(playlist, format, chunk_size=64 * 1024):
+    """Generate a zip archive of a playlist on the fly.
+
+    The songs are stored in the archive without compression and are read
+    directly from their files, so nothing is written to the disk. Songs with
+    recorded file info (see `songs.get_file_info`) are copied as they are,
+    without computing their checksums again.
+
+    Parameters
+    ----------
+    playlist : dict
+        The playlist as returned by the services. All of its songs should
+        be downloaded in `format` (see `has_all_songs`).
+    format : str
+        The format of the songs.
+    chunk_size : int
+        The size of the parts in which the songs are read.
+
+    Yields
+    ------
+    bytes
+        The next part of the archive.
+    """
+
+    playlist_songs = _unique_songs(playlist)
+    songs.mark_songs_served(playlist_songs, format)
+    stream = _ZipStream()
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as playlist_zip:
+        for song in playlist_songs:
+            song_filename = '{}.{}'.format(song['name'], format)
+            file_info = _get_file_info(song, format)
+
+            if file_info is None:
+                with open(song['files'][format], 'rb') as song_file, \
+                        playlist_zip.open(song_filename, 'w') as zip_entry:
+                    for chunk in iter(
+                            lambda: song_file.read(chunk_size), b''):
+                        zip_entry.write(chunk)
+                        yield stream.pop()
+                yield stream.pop()
+                continue
+
+            stream.write(
+                _add_stored_entry(playlist_zip, song_filename, file_info))
+            with open(song['files'][format], 'rb') as song_file:
+                yield stream.pop()
+                for chunk in iter(lambda: song_file.read(chunk_size), b''):
+                    yield chunk
+                    stream.position += len(chunk)
+            playlist_zip.start_dir = stream.tell()
+
+        playlist_zip.writestr(
+            '{}.m3u'.format(playlist['name']),
+            _m3u_contents(playlist, format)
+        )
+
+    yield stream.pop()
+
+
+def _manifest_key(playlist_cache_key):
+    return '{}_manifest'.format(playlist_cache_key)
+
+
+def _write_song(playlist_zip, song, format):
+    song_filename = '{}.{}'.format(song['name'], format)
+    file_info = _get_file_info(song, format)
+
+    if file_info is None:
+        playlist_zip.write(song['files'][format], song_filename)
+        return
+
+    # The checksum of the song is already known, so its contents are
+    # copied by the kernel straight into the archive.
+    playlist_zip.fp.seek(playlist_zip.start_dir)
+    header = _add_stored_entry(playlist_zip, song_filename, file_info)
+    playlist_zip.fp.write(header)
+    playlist_zip.fp.flush()
+    with open(song['files'][format], 'rb') as song_file:
+        _sendfile(song_file, playlist_zip.fp, file_info['size'])
+    # The song may overwrite old entries (see `_update_zip_playlist`), so
+    # the next one starts right after it and not at the end of the file.
+    playlist_zip.start_dir += len(header) + file_info['size']
+    playlist_zip.fp.seek(playlist_zip.start_dir)
+
+
+def _entry_size(playlist_zip, zinfo):
+    """Return the number of bytes an entry takes in the archive."""
+
+    playlist_zip.fp.seek(zinfo.header_offset)
+    header = struct.unpack(
+        zipfile.structFileHeader,
+        playlist_zip.fp.read(zipfile.sizeFileHeader))
+
+    return (zipfile.sizeFileHeader +
+            header[zipfile._FH_FILENAME_LENGTH] +
+            header[zipfile._FH_EXTRA_FIELD_LENGTH] +
+            zinfo.compress_size)
+
+
+def _build_zip_playlist(path, playlist, format):
+    song_names = list(OrderedDict.fromkeys(
+        song['name'] for song in playlist['tracks']))
+    m3u_filename = '{}.m3u'.format(playlist['name'])
+
+    playlist_songs = songs.get_songs(song_names)
+    songs.mark_songs_served(playlist_songs, format)
+
+    with zipfile.ZipFile(path, 'w') as playlist_zip:
+        for song in playlist_songs:
+            _write_song(playlist_zip, song, format)
+
+        playlist_zip.writestr(m3u_filename, _m3u_contents(playlist, format))
+
+    return {
+        'tracks': song_names,
+        'm3u': m3u_filename,
+        'dead_bytes': 0
+    }
+
+
+def _update_zip_playlist(path, manifest, playlist, format):
+    song_names = list(OrderedDict.fromkeys(
+        song['name'] for song in playlist['tracks']))
+    archived_songs = set(manifest['tracks'])
+    new_songs = [name for name in song_names if name not in archived_songs]
+    removed_songs = archived_songs - set(song_names)
+    m3u_filename = '{}.m3u'.format(playlist['name'])
+    dead_bytes = manifest['dead_bytes']
+
+    with zipfile.ZipFile(path, 'a') as playlist_zip:
+        # The m3u file is always the last entry, so it is overwritten by
+        # the new songs. Removed songs are only left out of the central
+        # directory and their contents stay in the archive until it is
+        # compacted.
+        old_m3u = playlist_zip.getinfo(manifest['m3u'])
+        removed_entries = [
+            playlist_zip.getinfo('{}.{}'.format(name, format))
+            for name in removed_songs
+        ]
+
+        for zinfo in removed_entries:
+            dead_bytes += _entry_size(playlist_zip, zinfo)
+
+        for zinfo in removed_entries + [old_m3u]:
+            playlist_zip.filelist.remove(zinfo)
+            del playlist_zip.NameToInfo[zinfo.filename]
+
+        playlist_zip.start_dir = old_m3u.header_offset
+
+        playlist_songs = songs.get_songs(new_songs)
+        songs.mark_songs_served(playlist_songs, format)
+        for song in playlist_songs:
+            _write_song(playlist_zip, song, format)
+
+        playlist_zip.writestr(m3u_filename, _m3u_contents(playlist, format))
+
+    if dead_bytes * 2 > os.path.getsize(path):
+        _compact_zip_playlist(path)
+        dead_bytes = 0
+
+    return {
+        'tracks': song_names,
+        'm3u': m3u_filename,
+        'dead_bytes': dead_bytes
+    }
+
+
+def _compact_zip_playlist(path):
+    """Rewrite an archive without the contents of its removed entries.
+
+    The remaining entries are copied as they are, without being
+    decompressed or checked again.
+    """
+
+    compact_path = '{}.compact'.format(path)
+
+    with zipfile.ZipFile(path) as playlist_zip, \
+            zipfile.ZipFile(compact_path, 'w') as compact_zip:
+        entries = sorted(
+            playlist_zip.infolist(), key=lambda zinfo: zinfo.header_offset)
+
+        for zinfo in entries:
+            size = _entry_size(playlist_zip, zinfo)
+            offset = zinfo.header_offset
+
+            zinfo.header_offset = compact_zip.fp.tell()
+            _sendfile(playlist_zip.fp, compact_zip.fp, size, offset)
+            compact_zip.fp.seek(0, os.SEEK_END)
+            compact_zip.start_dir = compact_zip.fp.tell()
+            compact_zip.filelist.append(zinfo)
+            compact_zip.NameToInfo[zinfo.filename] = zinfo
+
+    os.replace(compact_path, path)
+
+
+@celery_app.task
+def create_zip_playlist(playlist_ref, service, checksum, format='mp3'):
+    """Create or update the zip archive of a playlist.
+
+    If an archive of the playlist already exists, only the new songs are
+    added to it, while the removed ones are dropped from its central
+    directory. Their contents are removed once they take more than half
+    of the archive.
+
+    Parameters
+    ----------
+    playlist_ref : str
+        Reference to the playlist (see `store_playlist`).
+        All of its songs should be downloaded in `format`.
+    service : str
+        The service which provided the playlist (e.g. spotify).
+    checksum : str
+        The `checksum` of the tracks in the playlist.
+    format : str
+        The format of the songs.
+    """
+
+    playlist = load_playlist(playlist_ref)
+    playlist_cache_key = '{}_{}_{}'.format(service, playlist['id'], format)
+    playlist_zip_filename = '{}/{}.zip'.format(PLAYLISTS_DIRECTORY, playlist_cache_key)
+    manifest_key = _manifest_key(playlist_cache_key)
+    manifest = cache.get(manifest_key)
+
+    # If the update fails midway the archive can not be trusted anymore,
+    # so the next attempt should start from scratch.
+    cache.delete(manifest_key)
+    _touch_playlist(playlist_cache_key)
 
-    playlist_zip.close()
+    if manifest is not None and os.path.isfile(playlist_zip_filename):
+        manifest = _update_zip_playlist(
+            playlist_zip_filename, manifest, playlist, format)
+    else:
+        manifest = _build_zip_playlist(
+            playlist_zip_filename, playlist, format)
+
+    cache.set(manifest_key, manifest)
     cache.set(playlist_cache_key, {
         'path': playlist_zip_filename,
         'checksum': checksum
     })
+    _touch_playlist(playlist_cache_key)
+    songs.unpin_songs(playlist_cache_key)
+
+
+def _resolve_songs(tracks, provider):
+    # Search all songs at once instead of leaving every download task
+    # to search for its own song before it can start downloading.
+    if provider != 'youtube':
+        return tracks
+
+    try:
+        song_ids = youtube.get_song_ids(
+            [song['name'] for song in tracks if 'youtube' not in song])
+    except Exception:
+        # The download tasks will search for the songs themselves.
+        logger.exception('Could not search for the songs of a playlist')
+        return tracks
+
+    resolved_tracks = []
+    for song in tracks:
+        if 'youtube' not in song and song['name'] in song_ids:
+            song = dict(song, youtube=song_ids[song['name']])
+        resolved_tracks.append(song)
+
+    return resolved_tracks
+
+
+def _waiting_songs_key(user):
+    return 'playlist_songs_waiting_{}'.format(user)
+
+
+def _playlist_job_key(playlist_cache_key):
+    return 'playlist_job_{}'.format(playlist_cache_key)
+
+
+def _add_waiting_songs(user, playlist_cache_key, job_id, tracks, provider,
+                       format):
+    waiting_songs = [json.dumps({
+        'playlist': playlist_cache_key,
+        'job': job_id,
+        'song': song,
+        'provider': provider,
+        'format': format
+    }) for song in tracks]
+
+    waiting_count = redis_client.rpush(
+        _waiting_songs_key(user), *waiting_songs)
+    if waiting_count == len(waiting_songs):
+        redis_client.rpush(WAITING_USERS_KEY, user)
+
+
+def _next_waiting_song():
+    # Every user takes a turn, so users with small playlists do not wait
+    # for the big playlists of other users to be downloaded first.
+    for i in range(redis_client.llen(WAITING_USERS_KEY)):
+        user = redis_client.lpop(WAITING_USERS_KEY)
+        if user is None:
+            return None
+
+        user = user.decode()
+        waiting_song = redis_client.lpop(_waiting_songs_key(user))
+        # A user may be listed twice if new songs are added while their
+        # last song is taken. The extra turn is simply skipped.
+        if waiting_song is None:
+            continue
+
+        if redis_client.llen(_waiting_songs_key(user)) > 0:
+            redis_client.rpush(WAITING_USERS_KEY, user)
+        return json.loads(waiting_song.decode())
+
+    return None
+
+
+def _start_song_download():
+    """Take one of the free download slots.
+
+    Returns
+    -------
+    str
+        The id of the taken slot.
+    None
+        If all slots are taken.
+    """
+
+    redis_client.zremrangebyscore(
+        DOWNLOADING_SONGS_KEY, '-inf', time.time() - SONG_DOWNLOAD_TIMEOUT)
+    download_id = uuid.uuid4().hex
+
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(DOWNLOADING_SONGS_KEY)
+                if pipe.zcard(DOWNLOADING_SONGS_KEY) >= MAX_CONCURRENT_SONGS:
+                    pipe.reset()
+                    return None
+                pipe.multi()
+                pipe.execute_command(
+                    'ZADD', DOWNLOADING_SONGS_KEY, time.time(), download_id)
+                pipe.execute()
+                return download_id
+            except WatchError:
+                continue
+
+
+@celery_app.task(ignore_result=True)
+def dispatch_playlist_songs():
+    """Start downloading waiting playlist songs in the free download slots.
+
+    The songs are taken from the users in turns, so everyone's playlists
+    make progress no matter how big the other playlists are. Runs every
+    time a song is added or downloaded and periodically, in case a
+    worker has crashed.
+    """
+
+    while True:
+        download_id = _start_song_download()
+        if download_id is None:
+            return
+
+        waiting_song = _next_waiting_song()
+        if waiting_song is None:
+            redis_client.zrem(DOWNLOADING_SONGS_KEY, download_id)
+            return
+
+        download_playlist_song.delay(
+            waiting_song['playlist'], waiting_song['job'],
+            waiting_song['song'], waiting_song['provider'],
+            waiting_song['format'], download_id)
+
+
+def _finish_playlist_song(playlist_cache_key, job_id, failed):
+    job_key = _playlist_job_key(playlist_cache_key)
+
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(job_key)
+                # The songs of a job which has expired (or was replaced
+                # by another download of the playlist) are ignored.
+                current_job_id = pipe.hget(job_key, 'id')
+                if current_job_id is None or current_job_id.decode() != job_id:
+                    pipe.reset()
+                    return
+
+                pipe.multi()
+                if failed:
+                    pipe.hset(job_key, 'failed', 1)
+                pipe.hincrby(job_key, 'pending', -1)
+                pipe.hgetall(job_key)
+                job = pipe.execute()[-1]
+                break
+            except WatchError:
+                continue
+
+    if int(job[b'pending']) > 0:
+        return
+
+    redis_client.delete(job_key)
+
+    if int(job[b'failed']):
+        handle_error(playlist_cache_key)
+        return
+
+    create_zip_playlist.apply_async(
+        args=json.loads(job[b'args'].decode()),
+        link_error=handle_error.si(playlist_cache_key)
+    )
+
+
+def _create_playlist_job(playlist_cache_key, job):
+    """Start a job for downloading the songs of a playlist.
+
+    Returns
+    -------
+    str
+        The id of the job.
+    None
+        If the playlist already has a job.
+    """
+
+    job_key = _playlist_job_key(playlist_cache_key)
+    job_id = uuid.uuid4().hex
+
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(job_key)
+                if pipe.exists(job_key):
+                    pipe.reset()
+                    return None
+                pipe.multi()
+                pipe.hmset(job_key, dict(job, id=job_id))
+                pipe.expire(job_key, PLAYLIST_JOB_TIMEOUT)
+                pipe.execute()
+                return job_id
+            except WatchError:
+                continue
+
+
+@celery_app.task
+def download_playlist_song(playlist_cache_key, job_id, song_info, provider,
+                           format, download_id):
+    """Download a song of a playlist.
+
+    The playlist is created once all of its songs are downloaded. If any
+    of them fails the playlist is not created (see `handle_error`).
+
+    Parameters
+    ----------
+    playlist_cache_key : str
+        Identifies the playlist which is being downloaded.
+    job_id : str
+        Identifies the download of the playlist which the song is part of.
+    song_info : dict
+        Contains information about the song (see `songs.download_song`).
+    provider : str
+        The provider to use when downloading the song.
+    format : str
+        The format in which to convert the song after downloading.
+    download_id : str
+        The download slot taken for the song (see `dispatch_playlist_songs`).
+    """
+
+    failed = True
+    try:
+        songs.download_song_file(song_info, provider, format, wait=True)
+        failed = False
+    finally:
+        redis_client.zrem(DOWNLOADING_SONGS_KEY, download_id)
+        _finish_playlist_song(playlist_cache_key, job_id, failed)
+        dispatch_playlist_songs()
 
 
 @celery_app.task
-def download_playlist(playlist, service, provider='youtube', format='mp3'):
+def download_playlist(playlist_ref, service, provider='youtube',
+                      format='mp3', user=None):
     """Download a playlist.
 
+    The missing songs wait in a queue of the user. They are downloaded
+    in turns with the songs of the other users (see
+    `dispatch_playlist_songs`).
+
     Parameters
     ----------
-    playlist : dict
-        Contains information about the playlist:
+    playlist_ref : str
+        Reference to the playlist (see `store_playlist`). The playlist
+        contains:
         id - The id of the playlist.
         tracks - List of dicts with information about songs.
         Each dict should have:
@@ -151,16 +878,22 @@ def download_playlist(playlist, service, provider='youtube', format='mp3'):
         The provider to use when downloading the songs.
     format : str
         The format in which to convert the songs after downloading.
+    user : str
+        Identifies the user who requested the playlist. If missing the
+        playlist takes turns as if it was requested by a separate user.
 
     Raises
     ------
     ValueError
         If `format` is not supported.
+    RuntimeError
+        If the playlist is no longer stored.
     """
 
     if format not in SUPPORTED_FORMATS:
         raise ValueError('Format not supported: {}'.format(format))
 
+    playlist = load_playlist(playlist_ref)
     playlist_cache_key = '{}_{}_{}'.format(service, playlist['id'], format)
     playlist_data = cache.get(playlist_cache_key)
 
@@ -177,41 +910,109 @@ def download_playlist(playlist, service, provider='youtube', format='mp3'):
         return
 
     cache.set(playlist_cache_key, 'downloading')
-
-    download_song_tasks = []
-    for song in playlist['tracks']:
-        if not songs.has_song_format(song['name'], format):
-            download_song_tasks.append(
-                songs.download_song.si(
-                    song, provider, format
-                )
-            )
-
-    if len(download_song_tasks) == 0:
+    # The archive may be updated, so it should not be deleted meanwhile.
+    _touch_playlist(playlist_cache_key)
+    # Neither should the songs which are already downloaded, until the
+    # archive is created.
+    songs.pin_songs(
+        playlist_cache_key, [song['name'] for song in playlist['tracks']],
+        STORED_PLAYLIST_TIMEOUT)
+
+    # The songs are looked up at once, however big the playlist is.
+    playlist_songs = songs.get_songs(
+        [song['name'] for song in playlist['tracks']])
+    missing_songs = [
+        song for song, song_info in zip(playlist['tracks'], playlist_songs)
+        if song_info['files'].get(format) in (None, 'downloading')]
+
+    if len(missing_songs) == 0:
         create_zip_playlist.apply_async(
-            args=(playlist, service, playlist_checksum, format),
+            args=(playlist_ref, service, playlist_checksum, format),
             link_error=handle_error.si(playlist_cache_key)
         )
-    else:
-        chord(
-            download_song_tasks,
-            create_zip_playlist.si(
-                playlist, service, playlist_checksum, format
-            ),
-            link_error=handle_error.si(playlist_cache_key)
-        ).delay()
+        return
+
+    job_id = _create_playlist_job(playlist_cache_key, {
+        'pending': len(missing_songs),
+        'failed': 0,
+        'args': json.dumps([playlist_ref, service, playlist_checksum, format])
+    })
+    if job_id is None:
+        logger.info(
+            'Attempt to download a playlist in the process of downloading')
+        return
+
+    _add_waiting_songs(
+        user or playlist_cache_key, playlist_cache_key, job_id,
+        _resolve_songs(missing_songs, provider), provider, format)
+    dispatch_playlist_songs()
+
+
+def _expire_playlist(playlist_cache_key, expired_before):
+    """Remove a playlist from the index if it has not been used since."""
+
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(PLAYLISTS_KEY)
+                last_used = pipe.zscore(PLAYLISTS_KEY, playlist_cache_key)
+                if last_used is None or last_used > expired_before:
+                    return False
+                pipe.multi()
+                pipe.zrem(PLAYLISTS_KEY, playlist_cache_key)
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def _index_old_playlists():
+    """Add the archives created before they were indexed to the index."""
+
+    if not redis_client.set(PLAYLISTS_INDEXED_KEY, 1, nx=True):
+        return
+
+    for path in glob.glob(glob.escape(PLAYLISTS_DIRECTORY) + '/*.zip'):
+        playlist_cache_key = os.path.basename(path)[:-len('.zip')]
+        # They are considered used when they were last modified.
+        redis_client.execute_command(
+            'ZADD', PLAYLISTS_KEY, 'NX', os.path.getmtime(path),
+            playlist_cache_key)
 
 
 @celery_app.task(ignore_result=True)
 def clean_playlists():
-    """Delete old playlist files."""
+    """Delete the playlists which were not used recently.
+
+    A playlist expires `PLAYLIST_TIMEOUT` seconds after it was last
+    served, downloaded or updated. Only the expired playlists are looked
+    at, so the cost does not depend on the number of kept playlists.
+    Playlists whose songs are still being downloaded are kept.
+    """
+
+    _index_old_playlists()
+
+    expired_before = time.time() - PLAYLIST_TIMEOUT
+    expired_playlists = redis_client.zrangebyscore(
+        PLAYLISTS_KEY, '-inf', expired_before)
+
+    for playlist_cache_key in expired_playlists:
+        playlist_cache_key = playlist_cache_key.decode()
+        if (cache.get(playlist_cache_key) == 'downloading' and
+                redis_client.exists(_playlist_job_key(playlist_cache_key))):
+            continue
+
+        # The playlist may have been served since it was listed.
+        if not _expire_playlist(playlist_cache_key, expired_before):
+            continue
 
-    for playlist in os.listdir(PLAYLISTS_DIRECTORY):
-        path_to_playlist = '{}/{}'.format(PLAYLISTS_DIRECTORY, playlist)
-        last_modified = os.path.getmtime(path_to_playlist)
-        now = time.time()
+        path_to_playlist = '{}/{}.zip'.format(
+            PLAYLISTS_DIRECTORY, playlist_cache_key)
+        cache.delete(playlist_cache_key)
+        cache.delete(_manifest_key(playlist_cache_key))
 
-        if now - last_modified > 30 * 60:  # 30 minutes
+        try:
             os.remove(path_to_playlist)
-            cache.delete(playlist[:-4])
-            logger.info('Deleting old playlist: {}'.format(path_to_playlist))
+        except FileNotFoundError:
+            pass
+        logger.info('Deleting old playlist: {}'.format(path_to_playlist))
@@ -0,0 +1,110 @@
+"""
+    gepify.providers.rate_limits
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Limits the rate of the requests made to the providers by all
+    workers together, so they do not get rejected for making too many.
+"""
+
+import math
+import time
+
+from redis import WatchError
+from gepify.redis import redis_client
+
+# Requests per second and the size of the burst allowed for each endpoint
+RATE_LIMITS = {
+    'youtube.search': (5, 20),
+    'youtube.download': (2, 5),
+    'soundcloud.search': (5, 20),
+    'soundcloud.download': (2, 5),
+}
+# Maximum seconds to wait for the permission to make a request.
+WAIT_TIMEOUT = 5 * 60
+
+
+def _bucket_key(name):
+    return 'rate_limit_{}'.format(name)
+
+
+def _take_tokens(name, count):
+    """Take `count` tokens from a bucket if it has enough of them.
+
+    Returns
+    -------
+    float
+        0 if the tokens were taken, otherwise the seconds after which
+        the bucket will have enough tokens.
+    """
+
+    rate, capacity = RATE_LIMITS[name]
+    key = _bucket_key(name)
+    # Requests for more tokens than the bucket holds wait for a full
+    # bucket and leave it in debt, which the following requests wait out.
+    needed = min(count, capacity)
+
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                # The time of the redis server is shared by all workers.
+                seconds, microseconds = pipe.time()
+                now = seconds + microseconds / 1000000
+
+                bucket = pipe.hgetall(key)
+                tokens = float(bucket.get(b'tokens', capacity))
+                updated = float(bucket.get(b'updated', now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+
+                if tokens < needed:
+                    pipe.reset()
+                    return (needed - tokens) / rate
+
+                tokens -= count
+                pipe.multi()
+                pipe.hmset(key, {'tokens': tokens, 'updated': now})
+                # The bucket is forgotten once it would be full again.
+                pipe.expire(key, math.ceil((capacity - tokens) / rate) + 1)
+                pipe.execute()
+                return 0
+            except WatchError:
+                continue
+
+
+def acquire(name, count=1, timeout=WAIT_TIMEOUT):
+    """Wait until `count` requests can be made to an endpoint.
+
+    Every endpoint has a token bucket shared by all workers, which is
+    refilled at the allowed rate (see `RATE_LIMITS`).
+
+    Parameters
+    ----------
+    name : str
+        The name of the endpoint (e.g. youtube.search).
+    count : int
+        The number of requests that are going to be made.
+    timeout : int
+        Maximum seconds to wait.
+
+    Raises
+    ------
+    ValueError
+        If `name` is not a rate limited endpoint.
+    RuntimeError
+        If the requests could not be made in `timeout` seconds.
+    """
+
+    if name not in RATE_LIMITS:
+        raise ValueError('Unknown rate limit: {}'.format(name))
+
+    deadline = time.time() + timeout
+
+    while True:
+        wait = _take_tokens(name, count)
+        if wait == 0:
+            return
+
+        if time.time() + wait > deadline:
+            raise RuntimeError('Rate limit exceeded: {}'.format(name))
+
+        time.sleep(wait)
@@ -7,9 +7,16 @@
 """
 
 import os
+import threading
+from collections import OrderedDict
+import time
+import uuid
+import zlib
 
 from werkzeug.contrib.cache import RedisCache
+from redis import WatchError
 from gepify.celery import celery_app
+from gepify.redis import redis_client
 from celery.utils.log import get_task_logger
 from . import youtube, soundcloud, SUPPORTED_FORMATS, SONGS_DIRECTORY
 
@@ -22,6 +29,29 @@ cache = RedisCache(
 )
 logger = get_task_logger(__name__)
 
+# Seconds after which a claim on a song expires if the worker holding it
+# stops renewing it (e.g. because it crashed).
+CLAIM_TIMEOUT = int(os.environ.get('SONG_CLAIM_TIMEOUT', 60))
+# Maximum seconds a task waits for another worker to download a song.
+WAIT_TIMEOUT = 30 * 60
+# Maximum bytes taken by the song files and their sources. When they take
+# more, the least recently served ones are deleted until they fit in 90%
+# of the budget.
+DISK_BUDGET = int(os.environ.get('SONGS_DISK_BUDGET', 20 * 1024 ** 3))
+EVICTION_TARGET = 0.9
+# Song files served in the last seconds are never deleted, because they
+# may still be needed (e.g. for a song which is being converted).
+EVICTION_MIN_IDLE_TIME = 60 * 60
+
+# Sorted set of the song files (and sources) by the time they were last
+# served
+SONG_FILES_KEY = 'song_files'
+# Hash with the size of every song file
+SONG_FILE_SIZES_KEY = 'song_file_sizes'
+# Sorted set of the groups of pinned songs by the time they expire
+# (see `pin_songs`)
+PINS_KEY = 'song_pins'
+
 
 def get_song(song_name):
     """Return information about a song.
@@ -36,6 +66,8 @@ def get_song(song_name):
     dict
         name - The song name.
         files - Dictionary with downloaded files for this song.
+        file_info (optional) - Dictionary with the size, CRC-32 and
+        modification time of each downloaded file (see `get_file_info`).
     """
 
     song = cache.get(song_name)
@@ -50,6 +82,48 @@ def get_song(song_name):
     return song
 
 
+def get_songs(song_names):
+    """Return information about many songs at once.
+
+    All songs are fetched with a single request to the cache and the
+    missing ones are created with another one, no matter how many
+    songs are requested.
+
+    Parameters
+    ----------
+    song_names : list
+        The song names.
+
+    Returns
+    -------
+    list
+        Information about each song (as returned by `get_song`)
+        in the same order as `song_names`.
+    """
+
+    if len(song_names) == 0:
+        return []
+
+    cached_songs = cache.get_many(*song_names)
+    missing_songs = {}
+    result = []
+
+    for song_name, song in zip(song_names, cached_songs):
+        if song is None:
+            song = {
+                'name': song_name,
+                'files': {}
+            }
+            missing_songs[song_name] = song
+
+        result.append(song)
+
+    if len(missing_songs) > 0:
+        cache.set_many(missing_songs)
+
+    return result
+
+
 def add_song_file(song_name, file, format):
     """Mark a song as downloaded in desired format.
 
@@ -72,9 +146,397 @@ def add_song_file(song_name, file, format):
         raise ValueError('Format not supported: {}'.format(format))
 
     song = get_song(song_name)
+    file_info = get_file_info(file)
     song['files'][format] = file
+    song.setdefault('file_info', {})[format] = file_info
     cache.set(song_name, song)
 
+    with redis_client.pipeline() as pipe:
+        pipe.hset(SONG_FILE_SIZES_KEY, file, file_info['size'])
+        pipe.sadd(_file_songs_key(file), song_name)
+        pipe.execute_command('ZADD', SONG_FILES_KEY, time.time(), file)
+        pipe.execute()
+
+
+def add_source_file(file):
+    """Record that the source of a song was just used.
+
+    The sources count towards the disk budget and are deleted like the
+    song files (see `evict_songs`), so they are downloaded again the
+    next time they are needed.
+
+    Parameters
+    ----------
+    file : str
+        The file of the source as a path on the filesystem.
+    """
+
+    with redis_client.pipeline() as pipe:
+        pipe.hset(SONG_FILE_SIZES_KEY, file, os.path.getsize(file))
+        pipe.execute_command('ZADD', SONG_FILES_KEY, time.time(), file)
+        pipe.execute()
+
+
+def _file_songs_key(file):
+    # Different song names may be found as the same song by the providers,
+    # so they share the same file.
+    return 'song_file_songs_{}'.format(file)
+
+
+def mark_songs_served(songs, format):
+    """Record that songs were just served, so they are kept longer.
+
+    Parameters
+    ----------
+    songs : list
+        Information about the songs (as returned by `get_song`).
+    format : str
+        The format in which the songs were served.
+    """
+
+    file_songs = OrderedDict()
+    for song in songs:
+        if song['files'].get(format) not in (None, 'downloading'):
+            file_songs.setdefault(song['files'][format], []).append(
+                song['name'])
+
+    if len(file_songs) == 0:
+        return
+
+    now = time.time()
+    file_sizes = redis_client.hmget(SONG_FILE_SIZES_KEY, list(file_songs))
+    args = []
+
+    with redis_client.pipeline() as pipe:
+        for (file, song_names), size in zip(file_songs.items(), file_sizes):
+            if size is not None:
+                args.extend((now, file))
+                continue
+
+            # Files downloaded before they were tracked (see `add_song_file`)
+            # are tracked from the first time they are served.
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                continue
+            pipe.hset(SONG_FILE_SIZES_KEY, file, size)
+            pipe.sadd(_file_songs_key(file), *song_names)
+            pipe.execute_command('ZADD', SONG_FILES_KEY, now, file)
+
+        if len(args) > 0:
+            # Files deleted meanwhile (see `evict_songs`) are not added again.
+            pipe.execute_command('ZADD', SONG_FILES_KEY, 'XX', *args)
+        pipe.execute()
+
+
+def _pin_key(pin):
+    return 'song_pin_{}'.format(pin)
+
+
+def pin_songs(pin, song_names, timeout):
+    """Keep the files of songs from being deleted (see `evict_songs`).
+
+    Parameters
+    ----------
+    pin : str
+        Identifies the group of pinned songs (e.g. a playlist which is
+        being downloaded). Pinning a group again replaces its songs.
+    song_names : list
+        The names of the songs.
+    timeout : int
+        Seconds after which the songs are unpinned if `unpin_songs`
+        is not called before that.
+    """
+
+    with redis_client.pipeline() as pipe:
+        pipe.delete(_pin_key(pin))
+        if len(song_names) > 0:
+            pipe.sadd(_pin_key(pin), *song_names)
+        pipe.expire(_pin_key(pin), timeout)
+        pipe.execute_command('ZADD', PINS_KEY, time.time() + timeout, pin)
+        pipe.execute()
+
+
+def unpin_songs(pin):
+    """Allow the files of songs pinned with `pin_songs` to be deleted."""
+
+    with redis_client.pipeline() as pipe:
+        pipe.delete(_pin_key(pin))
+        pipe.zrem(PINS_KEY, pin)
+        pipe.execute()
+
+
+def _pinned_songs():
+    redis_client.zremrangebyscore(PINS_KEY, '-inf', time.time())
+    pins = redis_client.zrange(PINS_KEY, 0, -1)
+    if len(pins) == 0:
+        return set()
+
+    return {song_name.decode() for song_name in redis_client.sunion(
+        *[_pin_key(pin.decode()) for pin in pins])}
+
+
+def _evict_song_file(file):
+    for song_name in redis_client.smembers(_file_songs_key(file)):
+        song = cache.get(song_name.decode())
+        if song is None:
+            continue
+
+        for format, song_file in list(song['files'].items()):
+            if song_file == file:
+                del song['files'][format]
+                song.get('file_info', {}).pop(format, None)
+        cache.set(song['name'], song)
+
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+
+    with redis_client.pipeline() as pipe:
+        pipe.zrem(SONG_FILES_KEY, file)
+        pipe.hdel(SONG_FILE_SIZES_KEY, file)
+        pipe.delete(_file_songs_key(file))
+        pipe.execute()
+
+
+@celery_app.task(ignore_result=True)
+def evict_songs(disk_budget=DISK_BUDGET):
+    """Delete the least recently served song files over the disk budget.
+
+    The deleted files are removed from the information about their songs,
+    so the songs are downloaded again the next time they are needed.
+    The files of pinned songs (see `pin_songs`) are kept.
+
+    Parameters
+    ----------
+    disk_budget : int
+        Maximum bytes taken by the song files and their sources.
+    """
+
+    total_size = sum(
+        int(size) for size in redis_client.hvals(SONG_FILE_SIZES_KEY))
+    if total_size <= disk_budget:
+        return
+
+    target_size = disk_budget * EVICTION_TARGET
+    max_last_served = time.time() - EVICTION_MIN_IDLE_TIME
+    pinned_songs = _pinned_songs()
+    # The kept files stay listed, so they are skipped on the next pages.
+    kept_files = 0
+
+    while total_size > target_size:
+        files = redis_client.zrangebyscore(
+            SONG_FILES_KEY, '-inf', max_last_served,
+            start=kept_files, num=100)
+        if len(files) == 0:
+            logger.warning(
+                'Song files take {} bytes, but none of them can be '
+                'deleted'.format(total_size))
+            return
+
+        for file in files:
+            file = file.decode()
+            # The file may have been served (or deleted) since it was listed.
+            last_served = redis_client.zscore(SONG_FILES_KEY, file)
+            if last_served is None or last_served > max_last_served:
+                continue
+
+            file_songs = {song_name.decode() for song_name in
+                          redis_client.smembers(_file_songs_key(file))}
+            if not file_songs.isdisjoint(pinned_songs):
+                kept_files += 1
+                continue
+
+            size = redis_client.hget(SONG_FILE_SIZES_KEY, file)
+            _evict_song_file(file)
+            total_size -= int(size or 0)
+            logger.info('Deleting song file: {}'.format(file))
+
+            if total_size <= target_size:
+                return
+
+
+def get_file_info(file, chunk_size=64 * 1024):
+    """Return the metadata needed to put a song file in a zip archive.
+
+    Parameters
+    ----------
+    file : str
+        The file of the song as a path on the filesystem.
+    chunk_size : int
+        The size of the parts in which the file is read.
+
+    Returns
+    -------
+    dict
+        size - The size of the file in bytes.
+        crc32 - The CRC-32 checksum of the file contents.
+        mtime - The time of the last modification of the file.
+    """
+
+    crc32 = 0
+    with open(file, 'rb') as song_file:
+        for chunk in iter(lambda: song_file.read(chunk_size), b''):
+            crc32 = zlib.crc32(chunk, crc32)
+        stat = os.fstat(song_file.fileno())
+
+    return {
+        'size': stat.st_size,
+        'crc32': crc32 & 0xffffffff,
+        'mtime': stat.st_mtime
+    }
+
+
+def _claim_key(song_name, format):
+    return 'song_claim_{}_{}'.format(song_name, format)
+
+
+def claim_song(song_name, format):
+    """Claim the right to download a song in the desired format.
+
+    Only one claim for a song in a given format can exist at a time.
+    The claim expires after `CLAIM_TIMEOUT` seconds unless it is renewed.
+
+    Parameters
+    ----------
+    song_name : str
+        The song name.
+    format : str
+        The format that is going to be downloaded.
+
+    Returns
+    -------
+    str
+        A token identifying the claim if the song was claimed.
+    None
+        If the song is already claimed by someone else.
+    """
+
+    token = uuid.uuid4().hex
+    claimed = redis_client.set(
+        _claim_key(song_name, format), token, nx=True, ex=CLAIM_TIMEOUT)
+    return token if claimed else None
+
+
+def _update_claim(song_name, format, token, update):
+    key = _claim_key(song_name, format)
+
+    with redis_client.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            current_token = pipe.get(key)
+            if current_token is None or current_token.decode() != token:
+                return False
+            pipe.multi()
+            update(pipe, key)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def renew_claim(song_name, format, token):
+    """Extend a claim with another `CLAIM_TIMEOUT` seconds.
+
+    Returns
+    -------
+    bool
+        True if the claim was renewed, False if it is no longer held
+        by `token`.
+    """
+
+    return _update_claim(
+        song_name, format, token,
+        lambda pipe, key: pipe.expire(key, CLAIM_TIMEOUT))
+
+
+def release_claim(song_name, format, token):
+    """Release a claim if it is still held by `token`."""
+
+    return _update_claim(
+        song_name, format, token, lambda pipe, key: pipe.delete(key))
+
+
+def _done_channel(song_name, format):
+    return 'song_done_{}_{}'.format(song_name, format)
+
+
+def notify_song_done(song_name, format):
+    """Wake up everyone waiting for a song to be downloaded in `format`."""
+
+    redis_client.publish(_done_channel(song_name, format), 'done')
+
+
+def wait_for_song(song_name, format, timeout=WAIT_TIMEOUT):
+    """Block until nobody is downloading a song in the desired format.
+
+    The waiting ends as soon as the worker holding the claim announces
+    it has finished (see `notify_song_done`) or the claim expires
+    because that worker has died.
+
+    Parameters
+    ----------
+    song_name : str
+        The song name.
+    format : str
+        The format that is being downloaded.
+    timeout : int
+        Maximum seconds to wait.
+
+    Returns
+    -------
+    bool
+        True if the song is no longer claimed, False if `timeout` has passed.
+    """
+
+    claim_key = _claim_key(song_name, format)
+    deadline = time.time() + timeout
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_done_channel(song_name, format))
+
+    try:
+        while True:
+            # Checked after subscribing, so a notification sent in between
+            # can not be missed.
+            claim_ttl = redis_client.pttl(claim_key)
+            if claim_ttl is None or claim_ttl < 0:
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            pubsub.get_message(timeout=min(remaining, claim_ttl / 1000))
+    finally:
+        pubsub.close()
+
+
+class ClaimHeartbeat(threading.Thread):
+    """Keep renewing a claim until stopped.
+
+    Runs in the background while a song is being downloaded and converted,
+    so the claim outlives long downloads but not the worker holding it.
+    """
+
+    def __init__(self, song_name, format, token):
+        super().__init__(daemon=True)
+        self.song_name = song_name
+        self.format = format
+        self.token = token
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(CLAIM_TIMEOUT / 3):
+            if not renew_claim(self.song_name, self.format, self.token):
+                logger.warning('Lost claim on song {} ({})'.format(
+                    self.song_name, self.format))
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
 
 def has_song_format(song_name, format):
     """Check if a song is already downloaded in the desired format.
@@ -100,8 +562,8 @@ def has_song_format(song_name, format):
     return song['files'][format] != 'downloading'
 
 
-@celery_app.task(bind=True)
-def download_song(self, song_info, provider='youtube', format='mp3'):
+@celery_app.task
+def download_song(song_info, provider='youtube', format='mp3'):
     """Download a song.
 
     Parameters
@@ -123,28 +585,72 @@ def download_song(self, song_info, provider='youtube', format='mp3'):
         If either `format` or `provider` is not supported.
     """
 
+    # Nothing waits for the result, so a song which is being downloaded
+    # by another worker is left to it instead of occupying this worker.
+    download_song_file(song_info, provider, format, wait=False)
+
+
+def download_song_file(song_info, provider='youtube', format='mp3',
+                       wait=False):
+    """Download a song in the current process.
+
+    Parameters
+    ----------
+    song_info : dict
+        Contains information about the song (see `download_song`).
+    provider : str
+        The provider which will download the song. Default: 'youtube'
+    format : str
+        The format in which the song will be saved. Default: 'mp3'
+    wait : bool
+        Whether to wait for the song if it is being downloaded by another
+        worker. Otherwise nothing is done.
+
+    Raises
+    ------
+    ValueError
+        If either `format` or `provider` is not supported.
+    RuntimeError
+        If waiting for the song times out.
+    """
+
     if format not in SUPPORTED_FORMATS:
         raise ValueError('Format not supported: {}'.format(format))
 
     song = get_song(song_info['name'])
 
-    if format in song['files']:
-        if song['files'][format] == 'downloading':
-            if self.request.chord is None:
-                logger.info(
-                    'Attempt to download a song in the process of downloading')
-            else:
-                logger.info(
-                    'Song is aleady downloading. Will retry in 5 seconds.')
-                self.retry(countdown=5)
+    if song['files'].get(format) not in (None, 'downloading'):
+        logger.info('Attempt to download already downloaded song.'
+                    'Cache: {}'.format(song['files'][format]))
+        return
+
+    token = claim_song(song_info['name'], format)
+    while token is None:
+        if not wait:
+            logger.info(
+                'Attempt to download a song in the process of downloading')
             return
-        elif song['files'][format] is not None:
-            logger.info('Attempt to download already downloaded song.'
-                        'Cache: {}'.format(song['files'][format]))
+
+        logger.info('Song is aleady downloading. Waiting for it to finish.')
+        if not wait_for_song(song_info['name'], format):
+            raise RuntimeError('Timed out waiting for song to download')
+
+        if has_song_format(song_info['name'], format):
             return
 
-    song['files'][format] = 'downloading'
-    cache.set(song_info['name'], song)
+        # The other download failed, so try to download the song ourselves.
+        token = claim_song(song_info['name'], format)
+
+    # Another worker may have finished the song between the check above
+    # and taking the claim.
+    if has_song_format(song_info['name'], format):
+        release_claim(song_info['name'], format, token)
+        notify_song_done(song_info['name'], format)
+        logger.info('Song was downloaded by another worker meanwhile')
+        return
+
+    heartbeat = ClaimHeartbeat(song_info['name'], format, token)
+    heartbeat.start()
 
     try:
         song_id = song_info.get(provider)
@@ -161,13 +667,13 @@ def download_song(self, song_info, provider='youtube', format='mp3'):
                     song_info['name'])
             else:
                 song_id, download_id = song_id
-            soundcloud.download_song(download_id, format)
+            soundcloud.download_song(song_id, download_id, format)
             add_song_file(
                 song_info['name'],
                 '{}/{}.{}'.format(SONGS_DIRECTORY, song_id, format), format)
         else:
             raise ValueError('Provider not found: {}'.format(provider))
-    except:
-        del song['files'][format]
-        cache.set(song_info['name'], song)
-        raise
+    finally:
+        heartbeat.stop()
+        release_claim(song_info['name'], format, token)
+        notify_song_done(song_info['name'], format)
@@ -7,15 +7,29 @@
 
 import soundcloud
 import os
-from .youtube import downloaders
-from . import SUPPORTED_FORMATS
+from werkzeug.contrib.cache import RedisCache
+from . import (sources, rate_limits, SUPPORTED_FORMATS, SONGS_DIRECTORY,
+               SEARCH_CACHE_TIMEOUT, NOT_FOUND_CACHE_TIMEOUT)
 
 SOUNDCLOUD_CLIENT_ID = os.environ.get('SOUNDCLOUD_CLIENT_ID')
+# Cached instead of the ids of songs which could not be found
+NOT_FOUND = 'not found'
+
+cache = RedisCache(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', ''),
+    key_prefix='soundcloud_search_',
+    default_timeout=SEARCH_CACHE_TIMEOUT
+)
 
 
 def get_song_id(song_name):
     """Get the soundcloud ids of a song.
 
+    The results of the searches (including the unsuccessful ones)
+    are cached, so every song is searched only once.
+
     Parameters
     ----------
     song_name : str
@@ -34,25 +48,39 @@ def get_song_id(song_name):
         If `song_name` id is not found.
     """
 
+    song_ids = cache.get(song_name)
+    if song_ids == NOT_FOUND:
+        raise RuntimeError('Could not find song')
+    if song_ids is not None:
+        return song_ids
+
     client = soundcloud.Client(client_id=SOUNDCLOUD_CLIENT_ID)
+    rate_limits.acquire('soundcloud.search')
     tracks = client.get('/tracks', q=song_name)
 
     if len(tracks) > 0:
         id = tracks[0].obj['id']
         download_id = '{}/{}'.format(
             tracks[0].obj['user']['permalink'], tracks[0].obj['permalink'])
+        cache.set(song_name, (id, download_id))
         return (id, download_id)
 
+    cache.set(song_name, NOT_FOUND, timeout=NOT_FOUND_CACHE_TIMEOUT)
     raise RuntimeError('Could not find song')
 
 
-def download_song(id, format):
+def download_song(id, download_id, format):
     """Download a song from soundcloud.
 
+    The song is downloaded only the first time it is requested
+    and every following format is converted from the kept source.
+
     Parameters
     ----------
     id : str
-        The song's soundcloud id (download id).
+        The song's soundcloud id.
+    download_id : str
+        The id used for downloading the song (see `get_song_id`).
     format : str
         The format in which to convert the song after downloading.
 
@@ -65,5 +93,7 @@ def download_song(id, format):
     if format not in SUPPORTED_FORMATS:
         raise ValueError('Format not supported: {}'.format(format))
 
-    with downloaders[format] as ydl:
-        return ydl.download(['http://soundcloud.com/' + id])
+    source = sources.get_source(
+        'soundcloud', id, 'http://soundcloud.com/' + download_id)
+    sources.convert(
+        source, '{}/{}.{}'.format(SONGS_DIRECTORY, id, format), format)
@@ -0,0 +1,213 @@
+"""
+    gepify.providers.sources
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Keeps the original audio of the downloaded songs, so every song
+    is downloaded from its provider only once and each format is
+    converted locally from that copy.
+"""
+
+import glob
+import os
+import subprocess
+import tempfile
+import youtube_dl
+from . import songs, rate_limits, SUPPORTED_FORMATS, SOURCES_DIRECTORY
+
+# Sources are downloaded here and moved to SOURCES_DIRECTORY only when
+# they are complete, so partial downloads are never used as sources.
+DOWNLOADS_DIRECTORY = '{}/downloading'.format(SOURCES_DIRECTORY)
+# The sources are claimed like the songs (see `songs.claim_song`), as if
+# they were a song named after their provider and id in this format.
+SOURCE_CLAIM_FORMAT = 'source'
+
+# The audio codec used by each of the supported formats
+CODECS = {
+    'mp3': 'mp3',
+    'ogg': 'vorbis',
+    'opus': 'opus',
+    'aac': 'aac'
+}
+# ffmpeg options for encoding a source in each of the supported formats
+ENCODING_OPTIONS = {
+    'mp3': ['-acodec', 'libmp3lame', '-b:a', '192k'],
+    'ogg': ['-acodec', 'libvorbis', '-b:a', '192k'],
+    'opus': ['-acodec', 'libopus', '-b:a', '192k'],
+    'aac': ['-acodec', 'aac', '-b:a', '192k', '-strict', '-2'],
+}
+# The ffmpeg muxer (container) used by each of the supported formats
+CONTAINERS = {
+    'mp3': 'mp3',
+    'ogg': 'ogg',
+    'opus': 'opus',
+    'aac': 'adts'
+}
+
+
+def _find_source(source_name):
+    for path in glob.glob(glob.escape(source_name) + '.*'):
+        # Leftovers of interrupted downloads (e.g. song.webm.part) have
+        # more than one extension.
+        if '.' not in path[len(source_name) + 1:]:
+            return path
+
+    return None
+
+
+def _download_source(source_name, url):
+    downloader = youtube_dl.YoutubeDL({
+        'format': 'bestaudio/best',
+        'outtmpl': '{}/{}.%(ext)s'.format(
+            DOWNLOADS_DIRECTORY, os.path.basename(source_name)),
+    })
+
+    with downloader as ydl:
+        info = ydl.extract_info(url)
+        downloaded_file = ydl.prepare_filename(info)
+
+    source = '{}.{}'.format(
+        source_name, os.path.splitext(downloaded_file)[1][1:])
+    os.replace(downloaded_file, source)
+    return source
+
+
+def get_source(provider, id, url):
+    """Return the source audio of a song, downloading it if needed.
+
+    Only one worker downloads a source at a time. The others wait for
+    it to finish and use the same source.
+
+    Parameters
+    ----------
+    provider : str
+        The provider of the song (e.g. youtube).
+    id : str
+        The id of the song by `provider`.
+    url : str
+        Where to download the song from if it is not downloaded yet.
+
+    Returns
+    -------
+    str
+        The path to the source audio on the filesystem.
+
+    Raises
+    ------
+    RuntimeError
+        If waiting for another worker to download the source times out.
+    """
+
+    source_name = '{}/{}_{}'.format(SOURCES_DIRECTORY, provider, id)
+    claim_name = '{}_{}'.format(provider, id)
+
+    while True:
+        source = _find_source(source_name)
+        if source is not None:
+            songs.add_source_file(source)
+            return source
+
+        token = songs.claim_song(claim_name, SOURCE_CLAIM_FORMAT)
+        if token is not None:
+            break
+
+        if not songs.wait_for_song(claim_name, SOURCE_CLAIM_FORMAT):
+            raise RuntimeError('Timed out waiting for source to download')
+
+    heartbeat = songs.ClaimHeartbeat(claim_name, SOURCE_CLAIM_FORMAT, token)
+    heartbeat.start()
+
+    try:
+        # Another worker may have finished the source before it was claimed.
+        source = _find_source(source_name)
+        if source is None:
+            rate_limits.acquire('{}.download'.format(provider))
+            source = _download_source(source_name, url)
+        songs.add_source_file(source)
+        return source
+    finally:
+        heartbeat.stop()
+        songs.release_claim(claim_name, SOURCE_CLAIM_FORMAT, token)
+        songs.notify_song_done(claim_name, SOURCE_CLAIM_FORMAT)
+
+
+def get_audio_codec(path):
+    """Return the codec of the audio stream in a file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the file.
+
+    Returns
+    -------
+    str
+        The codec name as reported by ffprobe (e.g. opus).
+    None
+        If the codec could not be detected.
+    """
+
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-loglevel', 'error', '-select_streams', 'a:0',
+             '-show_entries', 'stream=codec_name',
+             '-of', 'default=noprint_wrappers=1:nokey=1', path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except subprocess.CalledProcessError:
+        return None
+
+    codec = result.stdout.decode('utf-8', 'replace').strip()
+    return codec or None
+
+
+def convert(source, destination, format):
+    """Convert a source audio to the desired format.
+
+    If the source audio is already encoded with the codec of `format`
+    it is only copied into the new container, without re-encoding.
+
+    Parameters
+    ----------
+    source : str
+        The path to the source audio.
+    destination : str
+        The path where to save the converted song.
+    format : str
+        The format in which to convert the song.
+
+    Raises
+    ------
+    ValueError
+        If `format` is not supported.
+    RuntimeError
+        If the conversion fails.
+    """
+
+    if format not in SUPPORTED_FORMATS:
+        raise ValueError('Format not supported: {}'.format(format))
+
+    if get_audio_codec(source) == CODECS[format]:
+        codec_options = ['-acodec', 'copy']
+    else:
+        codec_options = ENCODING_OPTIONS[format]
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # Different song names may be the same song, which is then converted
+    # to the same destination by more than one worker at a time.
+    fd, partial_destination = tempfile.mkstemp(
+        suffix='.part', prefix=os.path.basename(destination) + '.',
+        dir=os.path.dirname(destination))
+    os.close(fd)
+
+    try:
+        subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-i', source, '-vn'] +
+            codec_options + ['-f', CONTAINERS[format], partial_destination],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        os.chmod(partial_destination, 0o644)
+        os.replace(partial_destination, destination)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError('Could not convert song: {}'.format(
+            e.stderr.decode('utf-8', 'replace')))
+    finally:
+        if os.path.exists(partial_destination):
+            os.remove(partial_destination)
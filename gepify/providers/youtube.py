@@ -6,59 +6,56 @@
 """
 
 import os
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-import youtube_dl
-from . import SUPPORTED_FORMATS, SONGS_DIRECTORY
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.contrib.cache import RedisCache
+from gepify import youtube_api
+from . import (sources, rate_limits, SUPPORTED_FORMATS, SONGS_DIRECTORY,
+               SEARCH_CACHE_TIMEOUT, NOT_FOUND_CACHE_TIMEOUT)
 
 DEVELOPER_KEY = os.environ.get('YOUTUBE_DEVELOPER_KEY')
-YOUTUBE_API_SERVICE_NAME = 'youtube'
-YOUTUBE_API_VERSION = 'v3'
-
-downloaders = {
-    'mp3': youtube_dl.YoutubeDL({
-        'format': 'bestaudio/best',
-        'outtmpl': '{}/%(id)s.%(ext)s'.format(SONGS_DIRECTORY),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-    }),
-    'ogg': youtube_dl.YoutubeDL({
-        'format': 'bestaudio/best',
-        'outtmpl': '{}/%(id)s.%(ext)s'.format(SONGS_DIRECTORY),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'vorbis',
-            'preferredquality': '192',
-        }],
-    }),
-    'opus': youtube_dl.YoutubeDL({
-        'format': 'bestaudio/best',
-        'outtmpl': '{}/%(id)s.%(ext)s'.format(SONGS_DIRECTORY),
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'opus',
-            'preferredquality': '192',
-        }],
-    }),
-    'aac': youtube_dl.YoutubeDL({
-        'format': 'bestaudio/best',
-        'outtmpl': '{}/%(id)s.%(ext)s'.format(SONGS_DIRECTORY),
-        'postprocessor_args': ['-strict', '-2'],
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'aac',
-            'preferredquality': '192',
-        }],
-    }),
-}
+# Cached instead of the id of songs which could not be found
+NOT_FOUND = 'not found'
+# Maximum number of searches sent in one batch request
+BATCH_SIZE = 50
+# Maximum number of batch requests sent at the same time
+MAX_CONCURRENT_REQUESTS = 4
+
+cache = RedisCache(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', ''),
+    key_prefix='youtube_search_',
+    default_timeout=SEARCH_CACHE_TIMEOUT
+)
+
+# The searches run in long-lived threads, so each of them builds its API
+# client only once (see `youtube_api.get_client`).
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        # Threads do not survive forking (e.g. of the celery workers),
+        # so every process starts its own.
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS)
+            _executor_pid = os.getpid()
+
+    return _executor
 
 
 def get_song_id(song_name):
     """Get the youtube id of a song.
 
+    The results of the searches (including the unsuccessful ones)
+    are cached, so every song is searched only once.
+
     Parameters
     ----------
     song_name : str
@@ -75,27 +72,101 @@ def get_song_id(song_name):
         If `song_name` id is not found.
     """
 
-    youtube = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                    developerKey=DEVELOPER_KEY)
+    song_id = cache.get(song_name)
+    if song_id == NOT_FOUND:
+        raise RuntimeError('Could not find song')
+    if song_id is not None:
+        return song_id
+
+    youtube = youtube_api.get_client(DEVELOPER_KEY)
+    rate_limits.acquire('youtube.search')
+    search_response = _search_request(youtube, song_name).execute()
 
-    search_response = youtube.search().list(
-            q=song_name,
-            part='id,snippet',
-            maxResults=10
-        ).execute()
+    song_id = _cache_search_result(song_name, search_response)
+    if song_id == NOT_FOUND:
+        raise RuntimeError('Could not find song')
+    return song_id
 
-    videos = []
 
+def _search_request(youtube, song_name):
+    return youtube.search().list(
+        q=song_name,
+        part='id,snippet',
+        maxResults=10
+    )
+
+
+def _cache_search_result(song_name, search_response):
     for search_result in search_response.get('items', []):
         if search_result['id']['kind'] == 'youtube#video':
-            return search_result['id']['videoId']
+            song_id = search_result['id']['videoId']
+            cache.set(song_name, song_id)
+            return song_id
+
+    cache.set(song_name, NOT_FOUND, timeout=NOT_FOUND_CACHE_TIMEOUT)
+    return NOT_FOUND
+
+
+def _search_batch(song_names):
+    song_ids = {}
+
+    def handle_response(request_id, response, exception):
+        # Failed searches are left unresolved (and not cached),
+        # so they are searched again when the song is downloaded.
+        if exception is None:
+            song_name = song_names[int(request_id)]
+            song_ids[song_name] = _cache_search_result(song_name, response)
+
+    youtube = youtube_api.get_client(DEVELOPER_KEY)
+    batch = youtube.new_batch_http_request(callback=handle_response)
+    for i, song_name in enumerate(song_names):
+        batch.add(_search_request(youtube, song_name), request_id=str(i))
+    # Every search in the batch counts as a separate request.
+    rate_limits.acquire('youtube.search', len(song_names))
+    batch.execute()
 
-    raise RuntimeError('Could not find song')
+    return song_ids
+
+
+def get_song_ids(song_names):
+    """Get the youtube ids of many songs.
+
+    The songs which were not searched before are searched with batch
+    requests, so resolving a whole playlist takes only a few requests.
+
+    Parameters
+    ----------
+    song_names : list
+        The song names.
+
+    Returns
+    -------
+    dict
+        The youtube id of every song which was found by its name.
+        Songs which could not be found (or searched) are missing.
+    """
+
+    song_names = list(OrderedDict.fromkeys(song_names))
+    cached_ids = cache.get_many(*song_names) if song_names else []
+    song_ids = dict(zip(song_names, cached_ids))
+
+    missing_songs = [name for name in song_names if song_ids[name] is None]
+    batches = [missing_songs[i:i + BATCH_SIZE]
+               for i in range(0, len(missing_songs), BATCH_SIZE)]
+
+    for batch_ids in _get_executor().map(_search_batch, batches):
+        song_ids.update(batch_ids)
+
+    return {name: song_id for name, song_id in song_ids.items()
+            if song_id not in (None, NOT_FOUND)}
 
 
 def download_song(id, format):
     """Download a song from youtube.
 
+    The video is downloaded only the first time a song is requested
+    and every following format is converted from the kept source.
+
     Parameters
     ----------
     id : str
@@ -112,5 +183,7 @@ def download_song(id, format):
     if format not in SUPPORTED_FORMATS:
         raise ValueError('Format not supported: {}'.format(format))
 
-    with downloaders[format] as ydl:
-        return ydl.download(['http://www.youtube.com/watch?v=' + id])
+    source = sources.get_source(
+        'youtube', id, 'http://www.youtube.com/watch?v=' + id)
+    sources.convert(
+        source, '{}/{}.{}'.format(SONGS_DIRECTORY, id, format), format)
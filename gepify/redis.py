@@ -0,0 +1,15 @@
+"""Redis configuration.
+
+This module serves as a configuration for a Redis client used
+for coordinating work between the web server and the celery workers
+(e.g. which worker is currently downloading a song).
+"""
+
+from redis import StrictRedis
+import os
+
+redis_client = StrictRedis(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', '')
+)
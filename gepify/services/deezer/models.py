@@ -1,13 +1,36 @@
 from flask import session
 import gepify.providers.songs as songs
+from werkzeug.contrib.cache import RedisCache
+from concurrent.futures import ThreadPoolExecutor
+from gepify.http import Session
 import os
-import requests
 import json
 import time
 
 DEEZER_APP_ID = os.environ.get('DEEZER_APP_ID')
 DEEZER_SECRET = os.environ.get('DEEZER_SECRET')
 DEEZER_REDIRECT_URI = os.environ.get('DEEZER_REDIRECT_URI')
+DEEZER_API_URL = 'http://api.deezer.com'
+# Number of items requested with each page
+PAGE_SIZE = 100
+# Maximum number of pages requested at the same time
+MAX_CONCURRENT_REQUESTS = 8
+
+# Keeps the connections to deezer open between requests
+api_session = Session(pool_maxsize=MAX_CONCURRENT_REQUESTS)
+# The authentication codes are exchanged with GET requests, which must not
+# be repeated once sent, because every code can be used only once.
+auth_session = Session(retry_sent_requests=False)
+
+# Keeps the information about playlists which is needed to show and
+# download them, so it is not requested again until they change.
+cache = RedisCache(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', ''),
+    key_prefix='deezer_playlist_',
+    default_timeout=7 * 24 * 60 * 60
+)
 
 
 def get_access_token_data(code):
@@ -24,12 +47,14 @@ def get_access_token_data(code):
         If deezer API gives an error.
     """
 
-    auth_request = requests.get(
-        'https://connect.deezer.com/oauth/access_token.php' +
-        '?output=json'
-        '&app_id={}'.format(DEEZER_APP_ID) +
-        '&secret={}'.format(DEEZER_SECRET) +
-        '&code={}'.format(code))
+    auth_request = auth_session.get(
+        'https://connect.deezer.com/oauth/access_token.php',
+        params={
+            'output': 'json',
+            'app_id': DEEZER_APP_ID,
+            'secret': DEEZER_SECRET,
+            'code': code
+        })
 
     if auth_request.status_code == 200:
         if auth_request.text == 'wrong code':
@@ -89,6 +114,58 @@ def get_song_name(track):
     return '{} - {}'.format(track['artist']['name'], track['title'])
 
 
+def _api_get(path, **params):
+    api_request = api_session.get(
+        '{}{}'.format(DEEZER_API_URL, path), params=params)
+
+    if api_request.status_code != 200:
+        raise RuntimeError('Deezer API error')
+
+    return json.loads(api_request.text)
+
+
+def _get_all_items(path, first_page, total, access_token):
+    """Return the items of all pages of a list from the deezer API.
+
+    The pages after the first one are requested concurrently.
+
+    Parameters
+    ----------
+    path : str
+        The path of the list in the API (e.g. /user/me/playlists).
+    first_page : list
+        The items of the first page.
+    total : int
+        The total number of items in the list.
+    access_token : str
+        The access token of the user.
+
+    Returns
+    -------
+    list
+        The items from all pages.
+
+    Raises
+    ------
+    RuntimeError
+        If deezer API gives an error.
+    """
+
+    items = list(first_page)
+    offsets = range(len(items), total, PAGE_SIZE)
+
+    def get_page(offset):
+        return _api_get(path, access_token=access_token,
+                        index=offset, limit=PAGE_SIZE)['data']
+
+    if len(offsets) > 0:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            for page in executor.map(get_page, offsets):
+                items.extend(page)
+
+    return items
+
+
 def get_playlists():
     """Get the playlists of the user.
 
@@ -109,18 +186,15 @@ def get_playlists():
 
     access_token = get_access_token_from_session()
 
-    playlists_request = requests.get(
-        'http://api.deezer.com/user/me/playlists' +
-        '?access_token={}'.format(access_token)
-    )
+    playlists_data = _api_get(
+        '/user/me/playlists', access_token=access_token, limit=PAGE_SIZE)
+    items = _get_all_items(
+        '/user/me/playlists', playlists_data['data'],
+        playlists_data.get('total', 0), access_token)
 
-    if playlists_request.status_code != 200:
-        raise RuntimeError('Deezer API error')
-
-    playlists_data = json.loads(playlists_request.text)
     playlists = []
 
-    for item in playlists_data['data']:
+    for item in items:
         if item['type'] == 'playlist':
             playlist = {
                 'id': item['id'],
@@ -133,9 +207,30 @@ def get_playlists():
     return playlists
 
 
+def _request_playlist(playlist_id, checksum, access_token):
+    playlist_data = _api_get(
+        '/playlist/{}'.format(playlist_id), access_token=access_token)
+    tracks = _get_all_items(
+        '/playlist/{}/tracks'.format(playlist_id),
+        playlist_data['tracks']['data'], playlist_data['nb_tracks'],
+        access_token)
+
+    return {
+        'id': playlist_id,
+        'name': playlist_data['title'],
+        'description': playlist_data['description'],
+        'image': playlist_data['picture_medium'],
+        'checksum': checksum,
+        'song_names': [get_song_name(track) for track in tracks]
+    }
+
+
 def get_playlist(playlist_id):
     """Get a playlist by its id.
 
+    The playlist is requested only if its checksum has changed since
+    the last time it was requested.
+
     Parameters
     ----------
     playlist_id : str
@@ -148,6 +243,7 @@ def get_playlist(playlist_id):
         name - The name of the playlist.
         description - The description of the playlist.
         image - A url for an image of the playlist.
+        checksum - The version of the playlist.
         tracks - List of the tracks of the playlist.
 
     Raises
@@ -158,26 +254,18 @@ def get_playlist(playlist_id):
 
     access_token = get_access_token_from_session()
 
-    playlist_request = requests.get(
-        'http://api.deezer.com/playlist/{}'.format(playlist_id) +
-        '?access_token={}'.format(access_token)
-    )
-
-    if playlist_request.status_code != 200:
-        raise RuntimeError('Deezer API error')
-
-    playlist_data = json.loads(playlist_request.text)
-
-    playlist = {
-        'id': playlist_id,
-        'name': playlist_data['title'],
-        'description': playlist_data['description'],
-        'tracks': [],
-        'image': playlist_data['picture_medium']
-    }
+    # Only a single track is requested, because the checksum of
+    # the playlist comes with every page of its tracks.
+    checksum = _api_get(
+        '/playlist/{}/tracks'.format(playlist_id),
+        access_token=access_token, limit=1).get('checksum')
+    playlist = cache.get(playlist_id)
 
-    for track in playlist_data['tracks']['data']:
-        song = songs.get_song(get_song_name(track))
-        playlist['tracks'].append(song)
+    if (playlist is None or checksum is None or
+            playlist['checksum'] != checksum):
+        playlist = _request_playlist(playlist_id, checksum, access_token)
+        cache.set(playlist_id, playlist)
 
+    playlist = dict(playlist)
+    playlist['tracks'] = songs.get_songs(playlist.pop('song_names'))
     return playlist
@@ -6,7 +6,7 @@ from flask import (
 from .view_decorators import login_required, logout_required
 from . import models
 from .models import DEEZER_APP_ID, DEEZER_REDIRECT_URI
-from ..util import (get_random_str, send_file)
+from ..util import get_random_str, get_user_id, send_file, send_stream
 import urllib
 from gepify.providers import (
     songs, playlists, SUPPORTED_FORMATS, SUPPORTED_PROVIDERS, MIMETYPES
@@ -138,6 +138,7 @@ def download_song(song_name, format):
 
     influxdb.count('deezer.downloaded_songs')
     song = songs.get_song(song_name)
+    songs.mark_songs_served([song], format)
     return send_file(
         song['files'][format],
         as_attachment=True,
@@ -178,28 +179,34 @@ def download_playlist():
             'show_message.html', message='Unsupported provider'), 400
 
     playlist = models.get_playlist(playlist_id)
-    if not playlists.has_playlist('deezer', playlist_id, format):
-        playlists.download_playlist.delay(
-            playlist, 'deezer', format=format, provider=provider)
-        return render_template('show_message.html',
-                               message='Your playlist is getting downloaded')
-
-    playlist_checksum = playlists.checksum(playlist['tracks'])
-    playlist_data = playlists.get_playlist('deezer', playlist_id, format)
-
-    if playlist_data['checksum'] != playlist_checksum:
-        playlists.download_playlist.delay(
-            playlist, 'deezer', format=format, provider=provider)
-        return render_template('show_message.html',
-                               message='Your playlist is getting downloaded')
-
-    influxdb.count('deezer.downloaded_playlists')
-    return send_file(
-        playlist_data['path'],
-        as_attachment=True,
-        attachment_filename='{}.zip'.format(playlist['name']),
-        mimetype='application/zip'
-    )
+    if playlists.has_playlist('deezer', playlist_id, format):
+        playlist_checksum = playlists.checksum(playlist['tracks'])
+        playlist_data = playlists.get_playlist('deezer', playlist_id, format)
+
+        if playlist_data['checksum'] == playlist_checksum:
+            influxdb.count('deezer.downloaded_playlists')
+            playlists.mark_playlist_served('deezer', playlist_id, format)
+            return send_file(
+                playlist_data['path'],
+                as_attachment=True,
+                attachment_filename='{}.zip'.format(playlist['name']),
+                mimetype='application/zip'
+            )
+
+    if playlists.has_all_songs(playlist, format):
+        influxdb.count('deezer.downloaded_playlists')
+        return send_stream(
+            playlists.stream_zip_playlist(playlist, format),
+            attachment_filename='{}.zip'.format(playlist['name']),
+            mimetype='application/zip',
+            content_length=playlists.zip_playlist_size(playlist, format)
+        )
+
+    playlists.download_playlist.delay(
+        playlists.store_playlist(playlist), 'deezer', format=format,
+        provider=provider, user=get_user_id())
+    return render_template('show_message.html',
+                           message='Your playlist is getting downloaded')
 
 
 @deezer_service.route('/get_access_token/<code>')
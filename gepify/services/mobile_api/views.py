@@ -5,9 +5,8 @@ from gepify.providers import (
     songs, SUPPORTED_FORMATS, SUPPORTED_PROVIDERS, MIMETYPES
 )
 from gepify.services.spotify.models import (
-    SPOTIFY_AUTHORIZATION_DATA
+    SPOTIFY_AUTHORIZATION_DATA, SPOTIFY_TOKEN_URL, accounts_session
 )
-import requests
 import json
 from gepify.influxdb import influxdb
 from ..util import send_file
@@ -29,8 +28,8 @@ def get_access_token(code):
     }
 
     try:
-        post_request = requests.post('https://accounts.spotify.com/api/token',
-                                     data=payload, headers=headers)
+        post_request = accounts_session.post(
+            SPOTIFY_TOKEN_URL, data=payload, headers=headers)
 
         if post_request.status_code == 200:
             response_data = json.loads(post_request.text)
@@ -65,8 +64,8 @@ def refresh_access_token(refresh_token):
     }
 
     try:
-        post_request = requests.post('https://accounts.spotify.com/api/token',
-                                     data=payload, headers=headers)
+        post_request = accounts_session.post(
+            SPOTIFY_TOKEN_URL, data=payload, headers=headers)
 
         if post_request.status_code == 200:
             response_data = json.loads(post_request.text)
@@ -118,6 +117,7 @@ def download_song(song_name, format):
 
     influxdb.count('mobile_api.downloaded_songs')
     song = songs.get_song(song_name)
+    songs.mark_songs_served([song], format)
 
     return send_file(
         song['files'][format],
@@ -1,8 +1,10 @@
 from flask import session, g
 import gepify.providers.songs as songs
+from werkzeug.contrib.cache import RedisCache
+from concurrent.futures import ThreadPoolExecutor
+from gepify.http import Session
 import os
 import base64
-import requests
 import time
 import json
 
@@ -11,6 +13,30 @@ SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.environ.get('SPOTIFY_REDIRECT_URI')
 SPOTIFY_AUTHORIZATION_DATA = base64.b64encode(bytes(
     SPOTIFY_CLIENT_ID + ':' + SPOTIFY_CLIENT_SECRET, 'utf-8')).decode('utf-8')
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+# The maximum page sizes allowed by the spotify API
+PLAYLISTS_PAGE_SIZE = 50
+ALBUMS_PAGE_SIZE = 50
+PLAYLIST_TRACKS_PAGE_SIZE = 100
+ALBUM_TRACKS_PAGE_SIZE = 50
+# Only the fields needed for the song names are requested
+PLAYLIST_TRACKS_FIELDS = 'items(track(name,artists(name)))'
+# Maximum number of pages requested at the same time
+MAX_CONCURRENT_REQUESTS = 8
+
+# Keeps the connections to the spotify accounts service open between requests
+accounts_session = Session()
+
+# Keeps the information about playlists (and albums) which is needed
+# to show and download them, so it is not requested again until they change.
+cache = RedisCache(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', ''),
+    key_prefix='spotify_playlist_',
+    default_timeout=7 * 24 * 60 * 60
+)
 
 
 def _get_token(payload):
@@ -18,8 +44,8 @@ def _get_token(payload):
         'Authorization': 'Basic {}'.format(SPOTIFY_AUTHORIZATION_DATA)
     }
 
-    post_request = requests.post('https://accounts.spotify.com/api/token',
-                                 data=payload, headers=headers)
+    post_request = accounts_session.post(
+        SPOTIFY_TOKEN_URL, data=payload, headers=headers)
 
     if post_request.status_code == 200:
         response_data = json.loads(post_request.text)
@@ -117,6 +143,45 @@ def get_song_name(track):
         track['name'])
 
 
+def _get_all_items(first_page, get_page, limit):
+    """Return the items of all pages of a paginated result.
+
+    The pages after the first one are requested concurrently.
+
+    Parameters
+    ----------
+    first_page : dict
+        The first page of the result (should contain its `total`).
+    get_page : callable
+        Requests the page starting at the offset passed to it.
+    limit : int
+        The number of items in each page.
+
+    Returns
+    -------
+    list
+        The items from all pages.
+    """
+
+    items = list(first_page['items'])
+    offsets = range(len(items), first_page['total'], limit)
+
+    if len(offsets) > 0:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            for page in executor.map(get_page, offsets):
+                items.extend(page['items'])
+
+    return items
+
+
+def _get_image(images):
+    for image in images:
+        if image['width'] == 300:
+            return image['url']
+
+    return images[0]['url']
+
+
 def get_playlists():
     """Get the playlists and saved albums of the user.
 
@@ -131,102 +196,122 @@ def get_playlists():
     """
 
     username = get_username()
-    result = g.spotipy.user_playlists(username)
+    # g is not available in the threads requesting the pages
+    spotipy = g.spotipy
+
+    items = _get_all_items(
+        spotipy.user_playlists(username, limit=PLAYLISTS_PAGE_SIZE),
+        lambda offset: spotipy.user_playlists(
+            username, limit=PLAYLISTS_PAGE_SIZE, offset=offset),
+        PLAYLISTS_PAGE_SIZE)
 
     playlists = []
-    while result is not None:
-        for item in result['items']:
-            playlist = {
-                'id': '{}:{}'.format(item['owner']['id'], item['id']),
-                'image': item['images'][0]['url'],
-                'name': item['name'],
-                'num_tracks': item['tracks']['total']
-            }
-
-            for image in item['images']:
-                if image['width'] == 300:
-                    playlist['image'] = image['url']
-                    break
-
-            playlists.append(playlist)
-
-        result = g.spotipy.next(result) if result['next'] else None
-
-    result = g.spotipy.current_user_saved_albums()
-    while result is not None:
-        for item in result['items']:
-            playlist = {
-                'id': 'album:{}'.format(item['album']['id']),
-                'image': item['album']['images'][0]['url'],
-                'name': item['album']['name'],
-                'num_tracks': item['album']['tracks']['total']
-            }
-
-            for image in item['album']['images']:
-                if image['width'] == 300:
-                    playlist['image'] = image['url']
-                    break
-
-            playlists.append(playlist)
-
-        result = g.spotipy.next(result) if result['next'] else None
+    for item in items:
+        playlists.append({
+            'id': '{}:{}'.format(item['owner']['id'], item['id']),
+            'image': _get_image(item['images']),
+            'name': item['name'],
+            'num_tracks': item['tracks']['total']
+        })
+
+    items = _get_all_items(
+        spotipy.current_user_saved_albums(limit=ALBUMS_PAGE_SIZE),
+        lambda offset: spotipy.current_user_saved_albums(
+            limit=ALBUMS_PAGE_SIZE, offset=offset),
+        ALBUMS_PAGE_SIZE)
+
+    for item in items:
+        playlists.append({
+            'id': 'album:{}'.format(item['album']['id']),
+            'image': _get_image(item['album']['images']),
+            'name': item['album']['name'],
+            'num_tracks': item['album']['tracks']['total']
+        })
 
     return playlists
 
 
+def _with_tracks(playlist):
+    playlist = dict(playlist)
+    playlist['tracks'] = songs.get_songs(playlist.pop('song_names'))
+    return playlist
+
+
 def _get_playlist(username, playlist_id):
-    result = g.spotipy.user_playlist(username, playlist_id,
-                                     'name,description,tracks,images')
-    playlist = {
+    # The snapshot id changes only when the playlist changes,
+    # so the tracks are requested again only if it is different.
+    snapshot_id = g.spotipy.user_playlist(
+        username, playlist_id, 'snapshot_id')['snapshot_id']
+    cache_key = '{}:{}'.format(username, playlist_id)
+    playlist = cache.get(cache_key)
+
+    if playlist is None or playlist['snapshot_id'] != snapshot_id:
+        playlist = _request_playlist(username, playlist_id)
+        cache.set(cache_key, playlist)
+
+    return _with_tracks(playlist)
+
+
+def _request_playlist(username, playlist_id):
+    spotipy = g.spotipy
+    result = spotipy.user_playlist(
+        username, playlist_id,
+        'name,description,images,snapshot_id,'
+        'tracks(total,{})'.format(PLAYLIST_TRACKS_FIELDS))
+
+    items = _get_all_items(
+        result['tracks'],
+        lambda offset: spotipy.user_playlist_tracks(
+            username, playlist_id, fields=PLAYLIST_TRACKS_FIELDS,
+            limit=PLAYLIST_TRACKS_PAGE_SIZE, offset=offset),
+        PLAYLIST_TRACKS_PAGE_SIZE)
+
+    return {
         'id': '{}:{}'.format(username, playlist_id),
         'name': result['name'],
         'description': result['description'],
-        'image': result['images'][0]['url'],
-        'tracks': []
+        'image': _get_image(result['images']),
+        'snapshot_id': result['snapshot_id'],
+        'song_names': [get_song_name(item['track']) for item in items]
     }
 
-    for image in result['images']:
-        if image['width'] == 300:
-            playlist['image'] = image['url']
-            break
 
-    tracks = result['tracks']
-    while tracks is not None:
-        for item in tracks['items']:
-            song = songs.get_song(get_song_name(item['track']))
-            playlist['tracks'].append(song)
-        tracks = g.spotipy.next(tracks) if tracks['next'] else None
+def _get_album(album_id):
+    # Albums do not change, so they are requested only once.
+    cache_key = 'album:{}'.format(album_id)
+    playlist = cache.get(cache_key)
 
-    return playlist
+    if playlist is None:
+        playlist = _request_album(album_id)
+        cache.set(cache_key, playlist)
 
+    return _with_tracks(playlist)
 
-def _get_album(album_id):
-    result = g.spotipy.album(album_id)
-    playlist = {
-        'id': 'album:{}'.format(album_id),
-        'name': result['name'],
-        'image': result['images'][0]['url'],
-        'tracks': []
-    }
 
-    for image in result['images']:
-        if image['width'] == 300:
-            playlist['image'] = image['url']
-            break
+def _request_album(album_id):
+    spotipy = g.spotipy
+    result = spotipy.album(album_id)
 
-    tracks = result['tracks']
-    while tracks is not None:
-        for track in tracks['items']:
-            song = songs.get_song(get_song_name(track))
-            playlist['tracks'].append(song)
-        tracks = g.spotipy.next(tracks) if tracks['next'] else None
+    items = _get_all_items(
+        result['tracks'],
+        lambda offset: spotipy.album_tracks(
+            album_id, limit=ALBUM_TRACKS_PAGE_SIZE, offset=offset),
+        ALBUM_TRACKS_PAGE_SIZE)
 
-    return playlist
+    return {
+        'id': 'album:{}'.format(album_id),
+        'name': result['name'],
+        'image': _get_image(result['images']),
+        'song_names': [get_song_name(track) for track in items]
+    }
 
 
 def get_playlist(playlist_id):
     """Get a playlist (or album) by its id.
 
+    Only the snapshot id of a playlist is requested if it has not changed
+    since the last time it was requested.
+
     Parameters
     ----------
     playlist_id : str
@@ -239,6 +324,7 @@ def get_playlist(playlist_id):
         name - The name of the playlist (album).
         description - The description of the playlist (album).
         image - A url for an image of the playlist (album).
+        snapshot_id - The version of the playlist (not present for albums).
         tracks - List of the tracks of the playlist (album).
     """
 
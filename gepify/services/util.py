@@ -1,10 +1,13 @@
+import os
 import string
 import random
 
-from flask import send_file as flask_send_file
+from flask import (
+    current_app, session, Response, send_file as flask_send_file
+)
 import unicodedata
 from werkzeug.urls import url_quote
-
+from gepify.providers import DATA_DIRECTORY
 
 
 def get_random_str(length):
@@ -13,10 +16,56 @@ def get_random_str(length):
     return ''.join(
         random.choice(string.ascii_lowercase) for i in range(length))
 
+
+def get_user_id():
+    """Return a random id identifying the user of the current session."""
+
+    if 'user_id' not in session:
+        session['user_id'] = get_random_str(32)
+    return session['user_id']
+
 # TODO: temporary workaround until flask 1.0.3
 def send_file(filename, attachment_filename, mimetype, **kwargs):
-    response = flask_send_file(filename, mimetype=mimetype)
+    """Send a file from the data directory as an attachment.
+
+    Range requests and conditional requests (If-None-Match and
+    If-Modified-Since) are supported, so interrupted downloads can be
+    resumed. If `X_ACCEL_REDIRECT_PREFIX` is configured the file is not
+    sent by the application, but by the reverse proxy in front of it
+    (e.g. nginx) which serves the data directory under this prefix.
+    The same goes for `USE_X_SENDFILE` with servers supporting X-Sendfile.
+    """
+
+    accel_redirect_prefix = current_app.config.get('X_ACCEL_REDIRECT_PREFIX')
+
+    if accel_redirect_prefix:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = '{}/{}'.format(
+            accel_redirect_prefix.rstrip('/'),
+            url_quote(os.path.relpath(filename, DATA_DIRECTORY)))
+    else:
+        response = flask_send_file(
+            filename, mimetype=mimetype, conditional=True)
+
+    return _set_attachment_filename(response, attachment_filename)
+
+
+def send_stream(stream, attachment_filename, mimetype, content_length=None):
+    """Send the parts generated by `stream` as a file attachment.
+
+    Unlike `send_file` range requests are not supported, so interrupted
+    downloads can not be resumed. If `content_length` is given clients
+    can at least show the progress of the download.
+    """
+
+    response = Response(stream, mimetype=mimetype)
+    response.headers['Accept-Ranges'] = 'none'
+    if content_length is not None:
+        response.content_length = content_length
+    return _set_attachment_filename(response, attachment_filename)
+
 
+def _set_attachment_filename(response, attachment_filename):
     try:
         attachment_filename = attachment_filename.encode('ascii')
     except UnicodeEncodeError:
@@ -1,12 +1,35 @@
 from flask import g
+from apiclient.errors import HttpError
+from werkzeug.contrib.cache import RedisCache
+from gepify.http import Session
 import os
 import gepify.providers.songs as songs
-import requests
 import json
 
 YOUTUBE_CLIENT_ID = os.environ.get('YOUTUBE_CLIENT_ID')
 YOUTUBE_CLIENT_SECRET = os.environ.get('YOUTUBE_CLIENT_SECRET')
 YOUTUBE_REDIRECT_URI = os.environ.get('YOUTUBE_REDIRECT_URI')
+YOUTUBE_TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
+# The maximum page size allowed by the youtube API
+PAGE_SIZE = 50
+# Only the fields needed for showing and downloading playlists are requested
+PLAYLIST_FIELDS = (
+    'etag,items/snippet(title,description,thumbnails/medium/url)')
+PLAYLIST_ITEMS_FIELDS = (
+    'etag,nextPageToken,items(snippet/title,contentDetails/videoId)')
+
+# Keeps the connections to the google oauth service open between requests
+oauth_session = Session()
+
+# Keeps the responses for playlists with their ETags,
+# so they are transferred again only if they have changed.
+cache = RedisCache(
+    host=os.environ.get('REDIS_HOST', 'localhost'),
+    port=os.environ.get('REDIS_PORT', 6379),
+    password=os.environ.get('REDIS_PASS', ''),
+    key_prefix='youtube_playlist_',
+    default_timeout=7 * 24 * 60 * 60
+)
 
 
 def refresh_tokens(refresh_token):
@@ -29,10 +52,7 @@ def refresh_tokens(refresh_token):
         'grant_type': 'refresh_token'
     }
 
-    request = requests.post(
-        'https://www.googleapis.com/oauth2/v4/token',
-        data=payload
-    )
+    request = oauth_session.post(YOUTUBE_TOKEN_URL, data=payload)
 
     if request.status_code == 200:
         response= json.loads(request.text)
@@ -48,32 +68,99 @@ def refresh_tokens(refresh_token):
         raise RuntimeError('Could not refresh token')
 
 
-def get_playlists():
-    playlist_data = g.youtube.playlists().list(
-        part='id,snippet,contentDetails',
-        mine=True
-    ).execute()
+def _execute(request, cached_response=None):
+    """Execute an API request, revalidating a previous response.
 
-    playlists = []
+    Parameters
+    ----------
+    request : googleapiclient.http.HttpRequest
+        The request to execute.
+    cached_response : dict
+        A previous response for the same request (containing its etag).
+
+    Returns
+    -------
+    dict
+        The response for the request or `cached_response`
+        if it has not changed.
+    """
 
-    for item in playlist_data['items']:
-        playlist = {
-            'id': item['id'],
-            'name': item['snippet']['title'],
-            'num_tracks': item['contentDetails']['itemCount'],
-            'image': item['snippet']['thumbnails']['medium']['url']
-        }
-        playlists.append(playlist)
+    if cached_response is not None:
+        request.headers['If-None-Match'] = cached_response['etag']
 
-    return playlists
+    try:
+        return request.execute()
+    except HttpError as e:
+        if cached_response is not None and e.resp.status == 304:
+            return cached_response
+        raise
+
+
+def get_playlists():
+    playlists = []
+    page_token = None
+
+    while True:
+        playlist_data = g.youtube.playlists().list(
+            part='id,snippet,contentDetails',
+            mine=True,
+            maxResults=PAGE_SIZE,
+            pageToken=page_token
+        ).execute()
+
+        for item in playlist_data['items']:
+            playlist = {
+                'id': item['id'],
+                'name': item['snippet']['title'],
+                'num_tracks': item['contentDetails']['itemCount'],
+                'image': item['snippet']['thumbnails']['medium']['url']
+            }
+            playlists.append(playlist)
+
+        page_token = playlist_data.get('nextPageToken')
+        if page_token is None:
+            return playlists
 
 
 def get_playlist(playlist_id):
-    playlist_data = g.youtube.playlists().list(
-        part='snippet',
-        id=playlist_id
-    ).execute()['items'][0]
+    # Every page can only be requested with the token from the previous
+    # one, so the pages are requested one after another. Unchanged pages
+    # are answered with 304 Not Modified.
+    cached = cache.get(playlist_id) or {'playlist': None, 'pages': []}
 
+    playlist_data = _execute(g.youtube.playlists().list(
+        part='snippet',
+        id=playlist_id,
+        fields=PLAYLIST_FIELDS
+    ), cached['playlist'])
+
+    pages = []
+    page_token = None
+
+    while True:
+        cached_page = None
+        if len(pages) < len(cached['pages']) and (
+                len(pages) == 0 or
+                cached['pages'][len(pages) - 1].get('nextPageToken') ==
+                page_token):
+            cached_page = cached['pages'][len(pages)]
+
+        page = _execute(g.youtube.playlistItems().list(
+            part='snippet,contentDetails',
+            playlistId=playlist_id,
+            maxResults=PAGE_SIZE,
+            pageToken=page_token,
+            fields=PLAYLIST_ITEMS_FIELDS
+        ), cached_page)
+        pages.append(page)
+
+        page_token = page.get('nextPageToken')
+        if page_token is None:
+            break
+
+    cache.set(playlist_id, {'playlist': playlist_data, 'pages': pages})
+
+    playlist_data = playlist_data['items'][0]
     playlist = {
         'id': playlist_id,
         'name': playlist_data['snippet']['title'],
@@ -82,15 +169,14 @@ def get_playlist(playlist_id):
         'image': playlist_data['snippet']['thumbnails']['medium']['url']
     }
 
-    playlist_songs = g.youtube.playlistItems().list(
-        part='snippet,contentDetails',
-        playlistId=playlist_id,
-        maxResults=50
-    ).execute()['items']
+    playlist_songs = [
+        track for page in pages for track in page.get('items', [])]
+
+    playlist['tracks'] = songs.get_songs([
+        track['snippet']['title'] for track in playlist_songs
+    ])
 
-    for track in playlist_songs:
-        song = songs.get_song(track['snippet']['title'])
+    for song, track in zip(playlist['tracks'], playlist_songs):
         song['youtube'] = track['contentDetails']['videoId']
-        playlist['tracks'].append(song)
 
     return playlist
@@ -1,8 +1,7 @@
 from flask import session, redirect, url_for, render_template, g
 from functools import wraps
-import httplib2
 from oauth2client import client
-from apiclient.discovery import build
+from gepify import youtube_api
 
 
 def login_required(f):
@@ -18,8 +17,7 @@ def login_required(f):
         if credentials.access_token_expired:
             return redirect(url_for('youtube.login'))
 
-        http_auth = credentials.authorize(httplib2.Http())
-        g.youtube = build('youtube', 'v3', http=http_auth)
+        g.youtube = youtube_api.get_authorized_client(credentials)
         return f(*args, **kwargs)
     return decorated_function
 
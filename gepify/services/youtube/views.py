@@ -2,7 +2,7 @@ from flask import (
     session, render_template, redirect, request,
     url_for, current_app, jsonify
 )
-from ..util import send_file
+from ..util import get_user_id, send_file, send_stream
 from . import youtube_service
 from .view_decorators import login_required, logout_required
 from oauth2client import client
@@ -134,6 +134,7 @@ def download_song(song_name, format):
 
     influxdb.count('youtube.downloaded_songs')
     song = songs.get_song(song_name)
+    songs.mark_songs_served([song], format)
     return send_file(
         song['files'][format],
         as_attachment=True,
@@ -170,28 +171,34 @@ def download_playlist():
             'show_message.html', message='Unsupported provider'), 400
 
     playlist = models.get_playlist(playlist_id)
-    if not playlists.has_playlist('youtube', playlist_id, format):
-        playlists.download_playlist.delay(
-            playlist, 'youtube', format=format, provider=provider)
-        return render_template('show_message.html',
-                               message='Your playlist is getting downloaded')
-
-    playlist_checksum = playlists.checksum(playlist['tracks'])
-    playlist_data = playlists.get_playlist('youtube', playlist_id, format)
-
-    if playlist_data['checksum'] != playlist_checksum:
-        playlists.download_playlist.delay(
-            playlist, 'youtube', format=format, provider=provider)
-        return render_template('show_message.html',
-                               message='Your playlist is getting downloaded')
-
-    influxdb.count('youtube.downloaded_playlists')
-    return send_file(
-        playlist_data['path'],
-        as_attachment=True,
-        attachment_filename='{}.zip'.format(playlist['name']),
-        mimetype='application/zip'
-    )
+    if playlists.has_playlist('youtube', playlist_id, format):
+        playlist_checksum = playlists.checksum(playlist['tracks'])
+        playlist_data = playlists.get_playlist('youtube', playlist_id, format)
+
+        if playlist_data['checksum'] == playlist_checksum:
+            influxdb.count('youtube.downloaded_playlists')
+            playlists.mark_playlist_served('youtube', playlist_id, format)
+            return send_file(
+                playlist_data['path'],
+                as_attachment=True,
+                attachment_filename='{}.zip'.format(playlist['name']),
+                mimetype='application/zip'
+            )
+
+    if playlists.has_all_songs(playlist, format):
+        influxdb.count('youtube.downloaded_playlists')
+        return send_stream(
+            playlists.stream_zip_playlist(playlist, format),
+            attachment_filename='{}.zip'.format(playlist['name']),
+            mimetype='application/zip',
+            content_length=playlists.zip_playlist_size(playlist, format)
+        )
+
+    playlists.download_playlist.delay(
+        playlists.store_playlist(playlist), 'youtube', format=format,
+        provider=provider, user=get_user_id())
+    return render_template('show_message.html',
+                           message='Your playlist is getting downloaded')
 
 
 @youtube_service.route('/get_access_token/<code>')
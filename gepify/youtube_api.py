@@ -0,0 +1,122 @@
+"""YouTube Data API clients.
+
+This module provides clients for the YouTube Data API which are reused
+between celery tasks and flask requests. The discovery document of the
+API is fetched once per process and every thread keeps its own clients
+(and HTTP connections), because they are not thread-safe.
+"""
+
+from apiclient.discovery import build_from_document, DISCOVERY_URI
+from apiclient.errors import HttpError
+import httplib2
+import json
+import os
+import threading
+
+YOUTUBE_API_SERVICE_NAME = 'youtube'
+YOUTUBE_API_VERSION = 'v3'
+
+_discovery_document = None
+_discovery_document_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_discovery_document():
+    """Return the discovery document of the YouTube Data API."""
+
+    global _discovery_document
+
+    with _discovery_document_lock:
+        if _discovery_document is None:
+            uri = DISCOVERY_URI.format(
+                api=YOUTUBE_API_SERVICE_NAME, apiVersion=YOUTUBE_API_VERSION)
+            response, content = httplib2.Http().request(uri)
+
+            if response.status >= 400:
+                raise HttpError(response, content, uri=uri)
+
+            _discovery_document = json.loads(content.decode('utf-8'))
+
+    return _discovery_document
+
+
+class _AuthorizedHttp:
+    """Adds the authorization of the current user to the requests.
+
+    Unlike `OAuth2Credentials.authorize` it does not modify the wrapped
+    `httplib2.Http`, so its connections can be reused for different users.
+    """
+
+    def __init__(self, http):
+        self.http = http
+        self.credentials = None
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        self.credentials.apply(headers)
+        return self.http.request(
+            uri, method, body=body, headers=headers, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+def _get_clients():
+    # The connections of the parent process must not be used after forking
+    # (e.g. by the celery workers).
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.clients = {}
+
+    return _local.clients
+
+
+def get_client(developer_key):
+    """Return an API client authorized with a developer key.
+
+    Parameters
+    ----------
+    developer_key : str
+        The developer key of the application.
+
+    Returns
+    -------
+    googleapiclient.discovery.Resource
+        The API client for the current thread.
+    """
+
+    clients = _get_clients()
+
+    if developer_key not in clients:
+        clients[developer_key] = build_from_document(
+            get_discovery_document(), http=httplib2.Http(),
+            developerKey=developer_key)
+
+    return clients[developer_key]
+
+
+def get_authorized_client(credentials):
+    """Return an API client authorized as a user.
+
+    Parameters
+    ----------
+    credentials : oauth2client.client.OAuth2Credentials
+        The credentials of the user.
+
+    Returns
+    -------
+    googleapiclient.discovery.Resource
+        The API client for the current thread. It should not be used
+        after the next call to this function from the same thread.
+    """
+
+    clients = _get_clients()
+
+    if 'authorized' not in clients:
+        http = _AuthorizedHttp(httplib2.Http())
+        clients['authorized'] = (
+            build_from_document(get_discovery_document(), http=http), http)
+
+    client, http = clients['authorized']
+    http.credentials = credentials
+    return client
@@ -22,7 +22,8 @@ setup(
         'influxdb>=4.1.1'
     ],
     tests_require=[
-        'coverage>=4.1'
+        'coverage>=4.1',
+        'fakeredis>=0.16.0'
     ],
     test_suite='tests',
     author='Nikolai Lazarov',
@@ -1,12 +1,15 @@
 from . import GepifyTestCase
 from gepify.services import deezer
-from gepify.providers import songs
+from gepify.providers import songs, playlists
 from werkzeug.contrib.cache import SimpleCache
+from fakeredis import FakeStrictRedis
 from urllib import parse
 from unittest import mock
 from flask import url_for, session
+import io
 import json
 import os
+import zipfile
 
 
 class MockResponse:
@@ -15,11 +18,14 @@ class MockResponse:
         self.status_code = status_code
 
 
-def mocked_deezer_api_get_404(url):
+def mocked_deezer_api_get_404(url, **kwargs):
     return MockResponse({}, 404)
 
 
-def mocked_deezer_api_get(url):
+def mocked_deezer_api_get(url, params=None, **kwargs):
+    if params is not None:
+        url = '{}?{}'.format(url, parse.urlencode(params))
+
     if url.startswith('https://connect.deezer.com/oauth/access_token.php'):
         params = parse.parse_qs(parse.urlparse(url).query)
         assert params['output'][0] == 'json'
@@ -50,6 +56,19 @@ def mocked_deezer_api_get(url):
                 }
             ]
         }, 200)
+    elif url.startswith('http://api.deezer.com/playlist/1/tracks'):
+        return MockResponse({
+            'data': [
+                {
+                    'title': 'Song 1',
+                    'artist': {
+                        'name': 'Artist 1'
+                    },
+                }
+            ],
+            'checksum': 'first checksum',
+            'total': 1
+        }, 200)
     elif url.startswith('http://api.deezer.com/playlist/1'):
         return MockResponse({
             'title': 'Playlist 1',
@@ -64,6 +83,8 @@ def mocked_deezer_api_get(url):
                     }
                 ]
             },
+            'nb_tracks': 1,
+            'checksum': 'first checksum',
             'picture_medium': 'some url'
         }, 200)
 
@@ -71,7 +92,7 @@ def mocked_deezer_api_get(url):
 
 
 class ProfileMixin():
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def login(self, *args):
         login_response = self.client.get(url_for('deezer.login'))
         deezer_redirect = login_response.location
@@ -86,7 +107,7 @@ class ProfileMixin():
         self.assertRedirects(response, url_for('deezer.index'))
         return response
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def logout(self, *args):
         logout_response = self.client.get(url_for('deezer.logout'))
         self.assertRedirects(logout_response, url_for('views.index'))
@@ -145,7 +166,11 @@ class DeezerDecoratorsTestCase(GepifyTestCase, ProfileMixin):
 
 
 class DeezerModelsTestCase(GepifyTestCase, ProfileMixin):
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    def setUp(self):
+        super().setUp()
+        deezer.models.cache = SimpleCache()
+
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_request_access_token(self, get):
         self.assertNotIn('deezer_access_token', session)
         self.assertNotIn('deezer_expires_at', session)
@@ -154,7 +179,7 @@ class DeezerModelsTestCase(GepifyTestCase, ProfileMixin):
         self.assertEqual(session['deezer_access_token'], 'dummy token')
         self.assertIn('deezer_expires_at', session)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_request_access_token_with_deezer_error(self, get):
         self.assertNotIn('deezer_access_token', session)
         self.assertNotIn('deezer_expires_at', session)
@@ -180,7 +205,7 @@ class DeezerModelsTestCase(GepifyTestCase, ProfileMixin):
         self.assertEqual(deezer.models.get_song_name(track),
                          'Artist - Track name')
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_get_playlists(self, *args):
         with self.client:
             self.login()
@@ -192,17 +217,18 @@ class DeezerModelsTestCase(GepifyTestCase, ProfileMixin):
             )
             self.assertEqual(playlists[1]['name'], 'Duets')
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get_404)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get_404)
     def test_get_playlists_with_deezer_error(self, *args):
         with self.client:
             self.login()
             with self.assertRaisesRegex(RuntimeError, 'Deezer API error'):
                 deezer.models.get_playlists()
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
-    @mock.patch('gepify.providers.songs.get_song',
-                side_effect=lambda song_name: {'name': song_name})
-    def test_get_playlist_without_keeping_song_names(self, get_song, *args):
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name} for song_name in song_names])
+    def test_get_playlist_without_keeping_song_names(self, get_songs, *args):
         with self.client:
             self.login()
             playlist = deezer.models.get_playlist('1')
@@ -211,17 +237,80 @@ class DeezerModelsTestCase(GepifyTestCase, ProfileMixin):
             self.assertEqual(playlist['name'], 'Playlist 1')
             self.assertEqual(playlist['image'], 'some url')
             self.assertEqual(len(playlist['tracks']), 1)
-            self.assertEqual(get_song.call_count, len(playlist['tracks']))
+            self.assertEqual(get_songs.call_count, 1)
             self.assertEqual(
                 playlist['tracks'][0]['name'], 'Artist 1 - Song 1')
 
             with self.assertRaisesRegex(RuntimeError, 'Deezer API error'):
                 deezer.models.get_playlist('missing id')
 
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name} for song_name in song_names])
+    def test_get_playlist_if_playlist_has_not_changed(self, get_songs, get):
+        with self.client:
+            self.login()
+            deezer.models.get_playlist('1')
+            get.reset_mock()
+
+            playlist = deezer.models.get_playlist('1')
+            self.assertEqual(get.call_count, 1)
+            self.assertTrue(get.call_args[0][0].endswith('/playlist/1/tracks'))
+            self.assertEqual(playlist['name'], 'Playlist 1')
+            self.assertEqual(
+                playlist['tracks'][0]['name'], 'Artist 1 - Song 1')
+            self.assertNotIn('song_names', playlist)
+
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name} for song_name in song_names])
+    def test_get_playlist_if_playlist_has_changed(self, get_songs, get):
+        with self.client:
+            self.login()
+            deezer.models.get_playlist('1')
+            playlist = deezer.models.cache.get('1')
+            playlist['checksum'] = 'old checksum'
+            deezer.models.cache.set('1', playlist)
+            get.reset_mock()
+
+            playlist = deezer.models.get_playlist('1')
+            self.assertEqual(get.call_count, 2)
+            self.assertEqual(playlist['checksum'], 'first checksum')
+
+    @mock.patch('requests.Session.get')
+    def test_get_playlists_with_many_pages(self, get):
+        def get_page(url, params):
+            index = params.get('index', 0)
+            return MockResponse({
+                'data': [{
+                    'id': str(i),
+                    'title': 'Playlist {}'.format(i),
+                    'nb_tracks': 1,
+                    'type': 'playlist',
+                    'picture_medium': 'some url'
+                } for i in range(index, min(index + params['limit'], 250))],
+                'total': 250
+            }, 200)
+
+        get.side_effect = get_page
+
+        with self.client:
+            self.login()
+            playlists = deezer.models.get_playlists()
+
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual([playlist['id'] for playlist in playlists],
+                         [str(i) for i in range(250)])
+
 
 class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
     def setUp(self):
         songs.cache = SimpleCache()
+        songs.redis_client = FakeStrictRedis()
+        playlists.redis_client = FakeStrictRedis()
+        deezer.models.cache = SimpleCache()
 
     @classmethod
     def tearDownClass(cls):
@@ -235,7 +324,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         response = self.client.get(url_for('deezer.index'))
         self.assertRedirects(response, url_for('deezer.login'))
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_index_if_logged_in(self, *args):
         self.login()
         response = self.client.get(url_for('deezer.index'))
@@ -256,7 +345,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertIn(b'You need to be logged out to see this page',
                       response.data)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_login_callback(self, get, *args):
         response = self.client.get(
             url_for('deezer.callback', error_reason='access_denied'))
@@ -280,7 +369,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertRedirects(response, url_for('deezer.index'))
         self.assertEqual(get.call_count, 1)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_login_callback_with_deezer_error(self, get, *args):
         with self.client.session_transaction() as sess:
             sess['deezer_auth_state'] = 'some state'
@@ -292,7 +381,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
                       b'Please, try again.', response.data)
         self.assertEqual(get.call_count, 1)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_logout(self, *args):
         response = self.client.get(url_for('deezer.logout'))
         self.assertRedirects(response, url_for('views.index'))
@@ -306,16 +395,18 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         response = self.client.get(url_for('deezer.index'))
         self.assertRedirects(response, url_for('deezer.login'))
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
-    @mock.patch('gepify.providers.songs.get_song',
-                side_effect=lambda song_name: {'name': song_name, 'files': {}})
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name, 'files': {}}
+                    for song_name in song_names])
     def test_get_playlist(self, *args):
         self.login()
         response = self.client.get(url_for('deezer.playlist', id='1'))
         self.assert200(response)
         self.assertIn(b'Playlist 1', response.data)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_get_missing_playlist(self, *args):
         self.app.config.update(PROPAGATE_EXCEPTIONS=True)
         self.login()
@@ -383,7 +474,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assert500(response)
         response.close()
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     def test_download_playlist_with_wrong_post_data(self, *args):
         self.login()
         response = self.client.post(url_for('deezer.download_playlist'))
@@ -404,7 +495,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertEqual(response.status_code, 400)
         self.assertIn(b'Unsupported provider', response.data)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     @mock.patch('gepify.providers.playlists.has_playlist',
                 side_effect=lambda *args: False)
     @mock.patch('gepify.providers.playlists.download_playlist.delay')
@@ -416,7 +507,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assert200(response)
         self.assertIn(b'Your playlist is getting downloaded', response.data)
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     @mock.patch('gepify.providers.playlists.has_playlist',
                 side_effect=lambda *args: True)
     @mock.patch('gepify.providers.playlists.get_playlist',
@@ -436,7 +527,7 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertEqual(response.content_type, 'application/zip')
         response.close()
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     @mock.patch('gepify.providers.playlists.has_playlist',
                 side_effect=lambda *args: True)
     @mock.patch('gepify.providers.playlists.get_playlist',
@@ -451,7 +542,33 @@ class DeezerViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assert500(response)
         response.close()
 
-    @mock.patch('requests.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
+    @mock.patch('gepify.providers.playlists.has_playlist',
+                side_effect=lambda *args: False)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name, 'files': {'mp3': 'test song.mp3'}}
+                    for song_name in song_names])
+    @mock.patch('gepify.providers.playlists.download_playlist.delay')
+    def test_download_playlist_if_all_songs_are_downloaded(
+            self, download_playlist, *args):
+        with open('test song.mp3', 'w+') as f:
+            f.write('some data')
+
+        self.login()
+        response = self.client.post(
+            url_for('deezer.download_playlist'),
+            data={'playlist_id': '1', 'format': 'mp3'})
+        self.assert200(response)
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertFalse(download_playlist.called)
+
+        with zipfile.ZipFile(io.BytesIO(response.data)) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            self.assertEqual(len(playlist_zip.namelist()), 1 + 1)
+        response.close()
+
+    @mock.patch('requests.Session.get', side_effect=mocked_deezer_api_get)
     @mock.patch('gepify.providers.playlists.has_playlist',
                 side_effect=lambda *args: True)
     @mock.patch('gepify.providers.playlists.get_playlist',
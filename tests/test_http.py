@@ -0,0 +1,54 @@
+from unittest import mock, TestCase
+from gepify import http
+
+
+@mock.patch('requests.Session.send')
+class SessionTestCase(TestCase):
+    def test_request_uses_default_timeout(self, send):
+        session = http.Session(timeout=(1, 2))
+        session.get('https://api.example.com/playlists')
+        self.assertEqual(send.call_args[1]['timeout'], (1, 2))
+
+        session.get('https://api.example.com/playlists', timeout=10)
+        self.assertEqual(send.call_args[1]['timeout'], 10)
+
+    def test_adapters_are_reused(self, send):
+        session = http.Session(pool_maxsize=4)
+        adapter = session.get_adapter('https://api.example.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, http.RETRIES)
+        self.assertIs(session.get_adapter('http://api.example.com'), adapter)
+
+        session.get('https://api.example.com/playlists')
+        self.assertIs(session.get_adapter('https://api.example.com'), adapter)
+
+    def test_adapters_are_not_shared_after_fork(self, send):
+        session = http.Session()
+        adapter = session.get_adapter('https://api.example.com')
+
+        pid = session.pid + 1
+        with mock.patch('os.getpid', return_value=pid):
+            session.get('https://api.example.com/playlists')
+        self.assertIsNot(
+            session.get_adapter('https://api.example.com'), adapter)
+        self.assertEqual(session.pid, pid)
+
+    def test_only_safe_requests_are_retried_after_sending(self, send):
+        session = http.Session()
+        retry = session.get_adapter('https://api.example.com').max_retries
+        self.assertTrue(retry._is_method_retryable('GET'))
+        self.assertFalse(retry._is_method_retryable('POST'))
+
+    def test_sent_requests_are_not_retried_if_disabled(self, send):
+        session = http.Session(retry_sent_requests=False)
+        retry = session.get_adapter('https://api.example.com').max_retries
+        self.assertTrue(retry._is_method_retryable('GET'))
+        self.assertEqual(retry.read, 0)
+        self.assertEqual(retry.status, 0)
+        self.assertEqual(retry.connect, None)
+
+        session.get('https://api.example.com/playlists')
+        with mock.patch('os.getpid', return_value=session.pid + 1):
+            session.get('https://api.example.com/playlists')
+        retry = session.get_adapter('https://api.example.com').max_retries
+        self.assertEqual(retry.read, 0)
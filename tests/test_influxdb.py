@@ -0,0 +1,82 @@
+from unittest import mock, TestCase
+from gepify import influxdb
+import os
+
+
+@mock.patch.dict(os.environ, {'INFLUXDB_HOST': 'localhost'})
+@mock.patch('gepify.influxdb.InfluxDBClient')
+class InfluxDBTestCase(TestCase):
+    def setUp(self):
+        register = mock.patch('atexit.register')
+        register.start()
+        self.addCleanup(register.stop)
+
+    @mock.patch('threading.Thread')
+    def test_count_does_not_write(self, Thread, InfluxDBClient):
+        client = influxdb.Client()
+        client.count('spotify.downloaded_songs')
+        self.assertFalse(InfluxDBClient.called)
+        self.assertEqual(Thread().start.call_count, 1)
+
+    @mock.patch('threading.Thread')
+    def test_flush(self, Thread, InfluxDBClient):
+        client = influxdb.Client()
+        client.count('spotify.downloaded_songs')
+        client.count('spotify.downloaded_songs')
+        client.count('deezer.downloaded_songs')
+        client.flush()
+
+        points = InfluxDBClient().write_points.call_args[0][0]
+        self.assertEqual(
+            sorted((point['measurement'], point['fields']['value'])
+                   for point in points),
+            [('deezer.downloaded_songs', 1), ('spotify.downloaded_songs', 2)])
+
+        client.flush()
+        self.assertEqual(InfluxDBClient().write_points.call_count, 1)
+
+    @mock.patch('threading.Thread')
+    def test_count_drops_metrics_on_overflow(self, Thread, InfluxDBClient):
+        client = influxdb.Client(max_metrics=2)
+        for metric in ['first', 'second', 'third', 'first']:
+            client.count(metric)
+
+        with mock.patch('gepify.influxdb.logger') as logger:
+            client.flush()
+            logger.warning.assert_called_once_with('Dropped 1 metrics')
+
+        points = InfluxDBClient().write_points.call_args[0][0]
+        self.assertEqual(
+            sorted(point['measurement'] for point in points),
+            ['first', 'second'])
+
+    @mock.patch('threading.Thread')
+    def test_flush_if_influxdb_is_down(self, Thread, InfluxDBClient):
+        InfluxDBClient().write_points.side_effect = ConnectionError
+        client = influxdb.Client()
+        client.count('spotify.downloaded_songs')
+
+        with mock.patch('gepify.influxdb.logger') as logger:
+            client.flush()
+            self.assertTrue(logger.exception.called)
+
+    @mock.patch('threading.Thread')
+    def test_flush_if_influxdb_is_unreachable(self, Thread, InfluxDBClient):
+        InfluxDBClient().create_database.side_effect = [ConnectionError, None]
+        client = influxdb.Client()
+        client.count('spotify.downloaded_songs')
+
+        with mock.patch('gepify.influxdb.logger') as logger:
+            client.flush()
+            logger.warning.assert_called_once_with('Dropped 1 metrics')
+        self.assertFalse(InfluxDBClient().write_points.called)
+
+        client.count('spotify.downloaded_songs')
+        client.flush()
+        self.assertTrue(InfluxDBClient().write_points.called)
+
+    def test_count_if_influxdb_is_not_configured(self, InfluxDBClient):
+        with mock.patch.dict(os.environ, {'INFLUXDB_HOST': ''}):
+            client = influxdb.Client()
+        client.count('spotify.downloaded_songs')
+        self.assertFalse(InfluxDBClient.called)
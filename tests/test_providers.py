@@ -1,14 +1,29 @@
 from unittest import mock, TestCase
-from gepify.providers import songs, playlists, youtube, soundcloud
+import gepify.celery
+from gepify.providers import (
+    songs, playlists, youtube, soundcloud, sources, rate_limits
+)
 from werkzeug.contrib.cache import SimpleCache
+from fakeredis import FakeStrictRedis
+import io
 import json
+import subprocess
+import threading
 import time
 import os
+import zipfile
+import zlib
 
 
 class SongsTestCase(TestCase):
     def setUp(self):
         songs.cache = SimpleCache()
+        songs.redis_client = FakeStrictRedis()
+        get_file_info = mock.patch(
+            'gepify.providers.songs.get_file_info',
+            side_effect=lambda file: {'size': 9, 'crc32': 1, 'mtime': 1})
+        get_file_info.start()
+        self.addCleanup(get_file_info.stop)
 
     def test_get_song_if_song_is_not_in_cache(self):
         song = songs.get_song('some song')
@@ -20,6 +35,28 @@ class SongsTestCase(TestCase):
         self.assertEqual(song['name'], 'some song')
         self.assertEqual(song['files'], {})
 
+    def test_get_songs(self):
+        songs.add_song_file('some song', 'some song.mp3', 'mp3')
+        result = songs.get_songs(['other song', 'some song', 'other song'])
+        self.assertEqual([song['name'] for song in result],
+                         ['other song', 'some song', 'other song'])
+        self.assertEqual(result[0]['files'], {})
+        self.assertEqual(result[1]['files'], {'mp3': 'some song.mp3'})
+        self.assertIsNotNone(songs.cache.get('other song'))
+
+    @mock.patch('gepify.providers.songs.cache.set_many')
+    @mock.patch('gepify.providers.songs.cache.get_many',
+                side_effect=lambda *names: [None] * len(names))
+    def test_get_songs_makes_constant_number_of_cache_requests(
+            self, get_many, set_many):
+        songs.get_songs(['song {}'.format(i) for i in range(100)])
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(len(set_many.call_args[0][0]), 100)
+
+    def test_get_songs_with_no_songs(self):
+        self.assertEqual(songs.get_songs([]), [])
+
     def test_add_song_file_if_format_is_unsupported(self):
         with self.assertRaises(ValueError):
             songs.add_song_file('some song', 'some song.mp3', 'wav')
@@ -30,6 +67,8 @@ class SongsTestCase(TestCase):
         songs.add_song_file('some song', 'some song.mp3', 'mp3')
         song = songs.get_song('some song')
         self.assertEqual(song['files']['mp3'], 'some song.mp3')
+        self.assertEqual(song['file_info']['mp3'],
+                         {'size': 9, 'crc32': 1, 'mtime': 1})
 
     def test_has_song_format(self):
         self.assertFalse(songs.has_song_format('some song', 'mp3'))
@@ -44,9 +83,202 @@ class SongsTestCase(TestCase):
         self.assertFalse(songs.has_song_format('some song', 'mp3'))
 
 
+class SongFileInfoTestCase(TestCase):
+    def test_get_file_info(self):
+        with open('test.mp3', 'wb') as f:
+            f.write(b'some data')
+        self.addCleanup(os.remove, 'test.mp3')
+
+        file_info = songs.get_file_info('test.mp3', chunk_size=4)
+        self.assertEqual(file_info['size'], 9)
+        self.assertEqual(file_info['crc32'], zlib.crc32(b'some data'))
+        self.assertEqual(file_info['mtime'], os.path.getmtime('test.mp3'))
+
+
+class SongEvictionTestCase(TestCase):
+    def setUp(self):
+        songs.cache = SimpleCache()
+        songs.redis_client = FakeStrictRedis()
+        get_file_info = mock.patch(
+            'gepify.providers.songs.get_file_info',
+            side_effect=lambda file: {'size': 100, 'crc32': 0, 'mtime': 0})
+        get_file_info.start()
+        self.addCleanup(get_file_info.stop)
+
+    def add_song_file(self, song_name, file, format, last_served):
+        with mock.patch('time.time', return_value=last_served):
+            songs.add_song_file(song_name, file, format)
+
+    @mock.patch('os.remove')
+    def test_evict_songs_within_budget(self, os_remove):
+        self.add_song_file('song', 'song.mp3', 'mp3', 0)
+        songs.evict_songs(disk_budget=100)
+        self.assertFalse(os_remove.called)
+        self.assertTrue(songs.has_song_format('song', 'mp3'))
+
+    @mock.patch('os.remove')
+    def test_evict_songs_over_budget(self, os_remove):
+        self.add_song_file('old song', 'old.mp3', 'mp3', 0)
+        self.add_song_file('old song', 'old.ogg', 'ogg', 10)
+        self.add_song_file('new song', 'new.mp3', 'mp3', 20)
+        with mock.patch('time.time', return_value=30):
+            songs.mark_songs_served([songs.get_song('old song')], 'mp3')
+
+        songs.evict_songs(disk_budget=250)
+        os_remove.assert_called_once_with('old.ogg')
+        self.assertFalse(songs.has_song_format('old song', 'ogg'))
+        self.assertTrue(songs.has_song_format('old song', 'mp3'))
+        self.assertNotIn('ogg', songs.get_song('old song')['file_info'])
+        self.assertTrue(songs.has_song_format('new song', 'mp3'))
+
+        songs.evict_songs(disk_budget=100)
+        self.assertEqual(os_remove.call_count, 3)
+        self.assertEqual(songs.get_song('new song')['files'], {})
+        self.assertEqual(
+            songs.redis_client.zcard(songs.SONG_FILES_KEY), 0)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.getsize', side_effect=lambda file: 100)
+    def test_evict_songs_downloaded_before_tracking(self, getsize, os_remove):
+        songs.cache.set('song', {'name': 'song', 'files': {'mp3': 'old.mp3'}})
+        songs.cache.set('same song', {
+            'name': 'same song', 'files': {'mp3': 'old.mp3'}})
+        songs.evict_songs(disk_budget=0)
+        self.assertFalse(os_remove.called)
+
+        with mock.patch('time.time', return_value=0):
+            songs.mark_songs_served(
+                songs.get_songs(['song', 'same song']), 'mp3')
+        songs.evict_songs(disk_budget=0)
+        os_remove.assert_called_once_with('old.mp3')
+        self.assertFalse(songs.has_song_format('same song', 'mp3'))
+
+    @mock.patch('os.remove')
+    def test_evict_songs_sharing_a_file(self, os_remove):
+        self.add_song_file('song', 'song.mp3', 'mp3', 0)
+        self.add_song_file('same song', 'song.mp3', 'mp3', 0)
+        songs.evict_songs(disk_budget=0)
+        os_remove.assert_called_once_with('song.mp3')
+        self.assertFalse(songs.has_song_format('song', 'mp3'))
+        self.assertFalse(songs.has_song_format('same song', 'mp3'))
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.getsize', side_effect=lambda file: 100)
+    def test_evict_songs_with_sources(self, getsize, os_remove):
+        with mock.patch('time.time', return_value=0):
+            songs.add_source_file('sources/youtube_song.webm')
+        self.add_song_file('song', 'song.mp3', 'mp3', 10)
+
+        songs.evict_songs(disk_budget=150)
+        os_remove.assert_called_once_with('sources/youtube_song.webm')
+        self.assertTrue(songs.has_song_format('song', 'mp3'))
+        self.assertEqual(
+            songs.redis_client.hkeys(songs.SONG_FILE_SIZES_KEY),
+            [b'song.mp3'])
+
+    @mock.patch('os.remove')
+    def test_evict_songs_keeps_pinned_songs(self, os_remove):
+        self.add_song_file('pinned song', 'pinned.mp3', 'mp3', 0)
+        self.add_song_file('song', 'song.mp3', 'mp3', 10)
+        songs.pin_songs('playlist', ['pinned song'], timeout=60)
+
+        songs.evict_songs(disk_budget=0)
+        os_remove.assert_called_once_with('song.mp3')
+        self.assertTrue(songs.has_song_format('pinned song', 'mp3'))
+
+        songs.unpin_songs('playlist')
+        songs.evict_songs(disk_budget=0)
+        self.assertFalse(songs.has_song_format('pinned song', 'mp3'))
+
+    @mock.patch('os.remove')
+    def test_evict_songs_if_pin_expires(self, os_remove):
+        self.add_song_file('song', 'song.mp3', 'mp3', 0)
+        with mock.patch('time.time', return_value=0):
+            songs.pin_songs('playlist', ['song'], timeout=60)
+
+        songs.evict_songs(disk_budget=0)
+        os_remove.assert_called_once_with('song.mp3')
+        self.assertEqual(songs.redis_client.zcard(songs.PINS_KEY), 0)
+
+    @mock.patch('os.remove')
+    def test_evict_songs_keeps_recently_served_songs(self, os_remove):
+        self.add_song_file('song', 'song.mp3', 'mp3', time.time())
+        with mock.patch('gepify.providers.songs.logger') as logger:
+            songs.evict_songs(disk_budget=0)
+            self.assertTrue(logger.warning.called)
+        self.assertFalse(os_remove.called)
+        self.assertTrue(songs.has_song_format('song', 'mp3'))
+
+
+class SongClaimsTestCase(TestCase):
+    def setUp(self):
+        songs.redis_client = FakeStrictRedis()
+
+    def test_claim_song(self):
+        token = songs.claim_song('some song', 'mp3')
+        self.assertIsNotNone(token)
+        self.assertIsNone(songs.claim_song('some song', 'mp3'))
+        self.assertIsNotNone(songs.claim_song('some song', 'ogg'))
+
+    def test_claim_song_expires(self):
+        songs.claim_song('some song', 'mp3')
+        self.assertLessEqual(
+            songs.redis_client.ttl('song_claim_some song_mp3'),
+            songs.CLAIM_TIMEOUT)
+
+        songs.redis_client.delete('song_claim_some song_mp3')
+        self.assertIsNotNone(songs.claim_song('some song', 'mp3'))
+
+    def test_renew_claim(self):
+        token = songs.claim_song('some song', 'mp3')
+        songs.redis_client.expire('song_claim_some song_mp3', 1)
+        self.assertTrue(songs.renew_claim('some song', 'mp3', token))
+        self.assertGreater(
+            songs.redis_client.ttl('song_claim_some song_mp3'), 1)
+        self.assertFalse(songs.renew_claim('some song', 'mp3', 'other'))
+
+    def test_wait_for_song_if_song_is_not_claimed(self):
+        self.assertTrue(songs.wait_for_song('some song', 'mp3', timeout=1))
+
+    def test_wait_for_song_until_song_is_done(self):
+        token = songs.claim_song('some song', 'mp3')
+
+        def finish_download():
+            time.sleep(0.1)
+            songs.release_claim('some song', 'mp3', token)
+            songs.notify_song_done('some song', 'mp3')
+
+        threading.Thread(target=finish_download).start()
+        started_at = time.time()
+        self.assertTrue(songs.wait_for_song('some song', 'mp3', timeout=5))
+        self.assertLess(time.time() - started_at, 5)
+
+    def test_wait_for_song_if_claim_expires(self):
+        songs.claim_song('some song', 'mp3')
+        songs.redis_client.pexpire('song_claim_some song_mp3', 100)
+        self.assertTrue(songs.wait_for_song('some song', 'mp3', timeout=5))
+
+    def test_wait_for_song_timeout(self):
+        songs.claim_song('some song', 'mp3')
+        self.assertFalse(songs.wait_for_song('some song', 'mp3', timeout=0.1))
+
+    def test_release_claim(self):
+        token = songs.claim_song('some song', 'mp3')
+        self.assertFalse(songs.release_claim('some song', 'mp3', 'other'))
+        self.assertIsNone(songs.claim_song('some song', 'mp3'))
+        self.assertTrue(songs.release_claim('some song', 'mp3', token))
+        self.assertIsNotNone(songs.claim_song('some song', 'mp3'))
+
+
 class SongsTasksTestCase(TestCase):
     def setUp(self):
         songs.cache = SimpleCache()
+        songs.redis_client = FakeStrictRedis()
+        get_file_info = mock.patch(
+            'gepify.providers.songs.get_file_info',
+            side_effect=lambda file: {'size': 9, 'crc32': 1, 'mtime': 1})
+        get_file_info.start()
+        self.addCleanup(get_file_info.stop)
 
     def test_download_song_in_unsupported_format(self):
         with self.assertRaisesRegex(ValueError, 'Format not supported: wav'):
@@ -61,27 +293,73 @@ class SongsTasksTestCase(TestCase):
             'Cache: song.mp3'
         )
 
-    @mock.patch('gepify.providers.songs.download_song.retry')
     @mock.patch('logging.Logger.info')
-    def test_download_song_if_song_is_being_downloaded(self, log_info, retry):
-        song = songs.get_song('song')
-        song['files']['mp3'] = 'downloading'
-        songs.cache.set('song', song)
+    def test_download_song_if_song_is_being_downloaded(self, log_info):
+        songs.claim_song('song', 'mp3')
         songs.download_song({'name': 'song'}, format='mp3')
         log_info.assert_called_once_with(
             'Attempt to download a song in the process of downloading')
 
-        # log_info.reset_mock()
-        # songs.download_song('song', format='mp3')
-        # log_info.assert_called_once_with(
-        #     'Song is aleady downloading. Will retry in 5 seconds.')
-        # self.assertTrue(retry.called)
+    @mock.patch('gepify.providers.songs.wait_for_song')
+    @mock.patch('gepify.providers.youtube.download_song')
+    def test_download_song_file_waits_if_song_is_being_downloaded(
+            self, download_song, wait_for_song):
+        def finish_download(song_name, format):
+            songs.redis_client.delete('song_claim_song_mp3')
+            songs.add_song_file('song', 'song.mp3', 'mp3')
+            return True
+
+        wait_for_song.side_effect = finish_download
+        songs.claim_song('song', 'mp3')
+        songs.download_song_file({'name': 'song'}, format='mp3', wait=True)
+
+        self.assertEqual(wait_for_song.call_count, 1)
+        self.assertFalse(download_song.called)
+
+    @mock.patch('gepify.providers.songs.wait_for_song',
+                side_effect=lambda *args: False)
+    def test_download_song_file_if_waiting_times_out(self, *args):
+        songs.claim_song('song', 'mp3')
+        with self.assertRaisesRegex(RuntimeError, 'Timed out'):
+            songs.download_song_file(
+                {'name': 'song'}, format='mp3', wait=True)
+
+    @mock.patch('gepify.providers.youtube.download_song')
+    def test_download_song_if_song_is_downloaded_before_claiming(
+            self, download_song):
+        claim_song = songs.claim_song
+
+        def finish_download_and_claim(song_name, format):
+            # Another worker finishes the song right before it is claimed.
+            songs.add_song_file(song_name, 'song.mp3', format)
+            return claim_song(song_name, format)
+
+        with mock.patch('gepify.providers.songs.claim_song',
+                        side_effect=finish_download_and_claim):
+            songs.download_song({'name': 'song'}, format='mp3')
+
+        self.assertFalse(download_song.called)
+        self.assertIsNotNone(songs.claim_song('song', 'mp3'))
 
     def test_download_song_with_unsupported_provider(self):
         with self.assertRaisesRegex(ValueError, 'Provider not found: zamunda'):
             songs.download_song({'name': 'song'}, provider='zamunda')
         song = songs.get_song('song')
         self.assertNotIn('mp3', song['files'])
+        self.assertIsNotNone(songs.claim_song('song', 'mp3'))
+
+    @mock.patch('gepify.providers.youtube.get_song_id',
+                side_effect=lambda name: 'dQw4w9WgXcQ')
+    @mock.patch('gepify.providers.youtube.download_song')
+    def test_download_song_with_stale_downloading_marker(
+            self, download_song, *args):
+        song = songs.get_song('song')
+        song['files']['mp3'] = 'downloading'
+        songs.cache.set('song', song)
+        songs.download_song({'name': 'song'})
+        download_song.assert_called_with('dQw4w9WgXcQ', 'mp3')
+        song = songs.get_song('song')
+        self.assertEqual(song['files']['mp3'], './songs/dQw4w9WgXcQ.mp3')
 
     @mock.patch('gepify.providers.youtube.get_song_id',
                 side_effect=lambda name: 'dQw4w9WgXcQ')
@@ -91,13 +369,14 @@ class SongsTasksTestCase(TestCase):
         download_song.assert_called_with('dQw4w9WgXcQ', 'mp3')
         song = songs.get_song('song')
         self.assertEqual(song['files']['mp3'], './songs/dQw4w9WgXcQ.mp3')
+        self.assertIsNotNone(songs.claim_song('song', 'mp3'))
 
     @mock.patch('gepify.providers.soundcloud.get_song_id',
                 side_effect=lambda name: (1234, 'song id'))
     @mock.patch('gepify.providers.soundcloud.download_song')
     def test_download_song_with_soundcloud(self, download_song, *args):
         songs.download_song({'name': 'song'}, provider='soundcloud')
-        download_song.assert_called_with('song id', 'mp3')
+        download_song.assert_called_with(1234, 'song id', 'mp3')
         song = songs.get_song('song')
         self.assertEqual(song['files']['mp3'], './songs/1234.mp3')
 
@@ -116,6 +395,15 @@ class PlaylistsTestCase(TestCase):
         playlist = playlists.get_playlist('spotify', 'some playlist', 'mp3')
         self.assertIsNone(playlist)
 
+    def test_has_all_songs(self):
+        playlist = {'tracks': [
+            {'name': 'song 1', 'files': {'mp3': 'song 1.mp3'}},
+            {'name': 'song 2', 'files': {'mp3': 'song 2.mp3', 'ogg': 'downloading'}}
+        ]}
+        self.assertTrue(playlists.has_all_songs(playlist, 'mp3'))
+        self.assertFalse(playlists.has_all_songs(playlist, 'ogg'))
+        self.assertFalse(playlists.has_all_songs(playlist, 'opus'))
+
     def test_has_playlist(self):
         self.assertFalse(
             playlists.has_playlist('spotify', 'some playlist', 'mp3'))
@@ -127,15 +415,14 @@ class PlaylistsTestCase(TestCase):
             playlists.has_playlist('spotify', 'some playlist', 'mp3'))
 
 
-def mocked_list_dir(dir):
-    return ['1.zip', '2.zip']
-
+def mocked_get_songs(*downloaded_songs):
+    def get_songs(song_names):
+        return [{
+            'name': name,
+            'files': {'mp3': name + '.mp3'} if name in downloaded_songs else {}
+        } for name in song_names]
 
-def mocked_getmtime(file):
-    if file == './playlists/1.zip':
-        return time.time() - 60 * 60
-    if file == './playlists/2.zip':
-        return time.time() - 42
+    return get_songs
 
 
 class PlaylistsTasksTestCase(TestCase):
@@ -154,67 +441,485 @@ class PlaylistsTasksTestCase(TestCase):
 
     def setUp(self):
         playlists.cache = SimpleCache()
+        playlists.redis_client = FakeStrictRedis()
+        songs.redis_client = FakeStrictRedis()
 
-    @mock.patch('os.listdir', side_effect=mocked_list_dir)
-    @mock.patch('os.path.getmtime', side_effect=mocked_getmtime)
     @mock.patch('logging.Logger')
     @mock.patch('os.remove')
     def test_clean_playlists(self, os_remove, *args):
+        with mock.patch('time.time', return_value=time.time() - 60 * 60):
+            playlists.mark_playlist_served('spotify', '1', 'mp3')
+            playlists.mark_playlist_served('spotify', '2', 'mp3')
+        playlists.mark_playlist_served('spotify', '2', 'mp3')
+        playlists.mark_playlist_served('spotify', '3', 'mp3')
+        for i in range(1, 4):
+            playlists.cache.set('spotify_{}_mp3_manifest'.format(i), {})
+
+        playlists.clean_playlists()
+        os_remove.assert_called_once_with('./playlists/spotify_1_mp3.zip')
+        self.assertIsNone(playlists.cache.get('spotify_1_mp3_manifest'))
+        self.assertIsNotNone(playlists.cache.get('spotify_2_mp3_manifest'))
+        self.assertEqual(
+            playlists.redis_client.zcard(playlists.PLAYLISTS_KEY), 2)
+
         playlists.clean_playlists()
         self.assertEqual(os_remove.call_count, 1)
-        os_remove.assert_called_with('./playlists/1.zip')
+
+    @mock.patch('logging.Logger')
+    @mock.patch('os.remove')
+    def test_clean_playlists_if_playlist_is_downloading(
+            self, os_remove, *args):
+        with mock.patch('time.time', return_value=time.time() - 60 * 60):
+            playlists.mark_playlist_served('spotify', '1', 'mp3')
+            playlists.mark_playlist_served('spotify', '2', 'mp3')
+        playlists.cache.set('spotify_1_mp3', 'downloading')
+        playlists.redis_client.hset(
+            'playlist_job_spotify_1_mp3', 'pending', 1)
+        # The download of this one has crashed.
+        playlists.cache.set('spotify_2_mp3', 'downloading')
+
+        playlists.clean_playlists()
+        os_remove.assert_called_once_with('./playlists/spotify_2_mp3.zip')
+        self.assertEqual(playlists.cache.get('spotify_1_mp3'), 'downloading')
+        self.assertIsNone(playlists.cache.get('spotify_2_mp3'))
+
+    @mock.patch('logging.Logger')
+    def test_clean_playlists_indexes_old_playlists(self, *args):
+        for i in range(1, 3):
+            with open('playlists/spotify_{}_mp3.zip'.format(i), 'w+') as f:
+                f.write('some data')
+        old_time = time.time() - 60 * 60
+        os.utime('playlists/spotify_1_mp3.zip', (old_time, old_time))
+
+        playlists.clean_playlists()
+        self.assertFalse(os.path.isfile('playlists/spotify_1_mp3.zip'))
+        self.assertTrue(os.path.isfile('playlists/spotify_2_mp3.zip'))
+        self.assertIsNotNone(playlists.redis_client.zscore(
+            playlists.PLAYLISTS_KEY, 'spotify_2_mp3'))
+
+        os.remove('playlists/spotify_2_mp3.zip')
+
+    @mock.patch('logging.Logger')
+    @mock.patch('os.remove')
+    def test_clean_playlists_if_playlist_is_served_meanwhile(
+            self, os_remove, *args):
+        with mock.patch('time.time', return_value=time.time() - 60 * 60):
+            playlists.mark_playlist_served('spotify', '1', 'mp3')
+
+        zrangebyscore = playlists.redis_client.zrangebyscore
+
+        def serve_playlist(*args):
+            expired_playlists = zrangebyscore(*args)
+            playlists.mark_playlist_served('spotify', '1', 'mp3')
+            return expired_playlists
+
+        with mock.patch.object(playlists.redis_client, 'zrangebyscore',
+                               side_effect=serve_playlist):
+            playlists.clean_playlists()
+        self.assertFalse(os_remove.called)
 
     @mock.patch('logging.Logger')
     def test_handle_error(self, *args):
         playlists.cache.set('new_playlist', {'checksum': '1234'})
+        songs.pin_songs('new_playlist', ['some song'], timeout=60)
         playlists.handle_error(playlist_cache_key='new_playlist')
         self.assertIsNone(playlists.cache.get('new_playlist'))
+        self.assertEqual(songs.redis_client.zcard(songs.PINS_KEY), 0)
+
+    def test_store_playlist(self):
+        playlist = {'id': '1234', 'name': 'hated', 'description': 'songs',
+                    'tracks': [{'name': 'some track', 'youtube': 'some id',
+                                'files': {'mp3': 'some track.mp3'}}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        self.assertEqual(playlists.load_playlist(playlist_ref), {
+            'id': '1234', 'name': 'hated',
+            'tracks': [{'name': 'some track', 'youtube': 'some id'}]})
+
+        playlist['tracks'][0]['files'] = {}
+        self.assertEqual(playlists.store_playlist(playlist), playlist_ref)
+        playlist['tracks'].append({'name': 'another track'})
+        self.assertNotEqual(playlists.store_playlist(playlist), playlist_ref)
+
+    def test_load_playlist_if_playlist_is_not_stored(self):
+        with self.assertRaisesRegex(RuntimeError, 'Playlist not found'):
+            playlists.load_playlist('some playlist')
 
     def test_download_playlist_in_unsupported_format(self):
         with self.assertRaisesRegex(ValueError, 'Format not supported: wav'):
             playlists.download_playlist(
-                {'id': '1234'}, 'spotify', format='wav')
+                'some playlist', 'spotify', format='wav')
 
     @mock.patch('logging.Logger.info')
     def test_download_playlist_if_playlist_is_downloading(self, log_info):
-        playlist = {'id': '1234', 'tracks': [{'name': 'some track'}]}
+        playlist = {'id': '1234', 'name': 'hated',
+                    'tracks': [{'name': 'some track'}]}
         playlists.cache.set('spotify_1234_mp3', 'downloading')
-        playlists.download_playlist(playlist, 'spotify')
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
         log_info.assert_called_once_with(
             'Attempt to download a playlist in the process of downloading')
 
     @mock.patch('logging.Logger.info')
     def test_download_playlist_if_playlist_is_downloaded(self, log_info):
-        playlist = {'id': '1234', 'tracks': [{'name': 'some track'}]}
+        playlist = {'id': '1234', 'name': 'hated',
+                    'tracks': [{'name': 'some track'}]}
         playlist_data = {'checksum': playlists.checksum(playlist['tracks'])}
         playlists.cache.set('spotify_1234_mp3', playlist_data)
-        playlists.download_playlist(playlist, 'spotify')
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
         log_info.assert_called_once_with(
             'Attempt to download an already downloaded playlist')
 
-    @mock.patch('gepify.providers.songs.has_song_format',
-                side_effect=lambda *args: True)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs('some track', 'another track'))
     @mock.patch('gepify.providers.playlists.create_zip_playlist.apply_async')
     def test_download_playlist_if_no_new_songs_need_to_be_downloaded(
             self, create_zip_playlist, *args):
-        playlist = {'id': '1234', 'tracks': [
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
             {'name': 'some track'}, {'name': 'another track'}]}
-        playlists.download_playlist(playlist, 'spotify')
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
         self.assertTrue(create_zip_playlist.called)
 
-    @mock.patch('gepify.providers.songs.has_song_format',
-                side_effect=lambda *args: False)
-    @mock.patch('gepify.providers.songs.download_song')
-    @mock.patch('celery.chord.delay')
-    def test_download_playlist_with_missing_songs(self, chord, *args):
-        playlist = {'id': '1234', 'tracks': [
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    @mock.patch.object(playlists, 'MAX_CONCURRENT_SONGS', 1)
+    def test_download_playlist_with_missing_songs(
+            self, download_playlist_song, *args):
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            {'name': 'some track'}, {'name': 'another track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+
+        self.assertEqual(download_playlist_song.call_count, 1)
+        args = download_playlist_song.call_args[0]
+        self.assertEqual(args[0], 'spotify_1234_mp3')
+        self.assertEqual(
+            args[2:5], ({'name': 'some track'}, 'youtube', 'mp3'))
+        self.assertEqual(playlists.redis_client.hget(
+            'playlist_job_spotify_1234_mp3', 'pending'), b'2')
+        self.assertEqual(
+            songs.redis_client.smembers('song_pin_spotify_1234_mp3'),
+            {b'some track', b'another track'})
+
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_looks_up_songs_at_once(
+            self, download_playlist_song, *args):
+        songs.cache = SimpleCache()
+        songs.cache.set('downloaded track', {
+            'name': 'downloaded track', 'files': {'mp3': 'track.mp3'}})
+        songs.cache.set('downloading track', {
+            'name': 'downloading track', 'files': {'mp3': 'downloading'}})
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            {'name': 'downloaded track'}, {'name': 'downloading track'},
+            {'name': 'new track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+
+        with mock.patch.object(songs.cache, 'get_many',
+                               wraps=songs.cache.get_many) as get_many:
+            playlists.download_playlist(playlist_ref, 'spotify')
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(playlists.redis_client.hget(
+            'playlist_job_spotify_1234_mp3', 'pending'), b'2')
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs('downloaded track'))
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {'some track': 'some id'})
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_searches_missing_songs(
+            self, download_playlist_song, get_song_ids, *args):
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            {'name': 'some track'}, {'name': 'another track'},
+            {'name': 'known track', 'youtube': 'known id'},
+            {'name': 'downloaded track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+
+        get_song_ids.assert_called_once_with(['some track', 'another track'])
+        self.assertEqual(
+            [call[0][2] for call in download_playlist_song.call_args_list], [
+                {'name': 'some track', 'youtube': 'some id'},
+                {'name': 'another track'},
+                {'name': 'known track', 'youtube': 'known id'}])
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=RuntimeError)
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_if_search_fails(
+            self, download_playlist_song, *args):
+        playlist = {'id': '1234', 'name': 'hated',
+                    'tracks': [{'name': 'some track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+        self.assertEqual(
+            download_playlist_song.call_args[0][2], {'name': 'some track'})
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_songs_take_turns(
+            self, download_playlist_song, *args):
+        big_playlist = playlists.store_playlist({
+            'id': 'big', 'name': 'big', 'tracks': [
+                {'name': 'big {}'.format(i)} for i in range(3)]})
+        small_playlist = playlists.store_playlist({
+            'id': 'small', 'name': 'small', 'tracks': [{'name': 'small'}]})
+        with mock.patch.object(playlists, 'MAX_CONCURRENT_SONGS', 0):
+            playlists.download_playlist(big_playlist, 'spotify', user='big')
+            playlists.download_playlist(
+                small_playlist, 'spotify', user='small')
+        self.assertFalse(download_playlist_song.called)
+
+        playlists.dispatch_playlist_songs()
+        self.assertEqual(
+            [call[0][2]['name']
+             for call in download_playlist_song.call_args_list],
+            ['big 0', 'small', 'big 1', 'big 2'])
+        self.assertEqual(playlists.redis_client.llen(
+            playlists.WAITING_USERS_KEY), 0)
+
+    @mock.patch.object(playlists, 'MAX_CONCURRENT_SONGS', 1)
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_dispatch_playlist_songs_if_download_is_lost(
+            self, download_playlist_song):
+        playlists._add_waiting_songs(
+            'user', 'spotify_1234_mp3', 'job', [{'name': 'song'}], 'youtube',
+            'mp3')
+        with mock.patch('time.time', return_value=time.time() - 2 * 60 * 60):
+            playlists._start_song_download()
+
+        playlists.dispatch_playlist_songs()
+        self.assertTrue(download_playlist_song.called)
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.songs.download_song_file')
+    @mock.patch('gepify.providers.playlists.create_zip_playlist.apply_async')
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_song(
+            self, download_playlist_song, create_zip_playlist,
+            download_song_file, *args):
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            {'name': 'some track'}, {'name': 'another track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+
+        for call in download_playlist_song.call_args_list:
+            self.assertFalse(create_zip_playlist.called)
+            playlists.download_playlist_song(*call[0])
+
+        download_song_file.assert_called_with(
+            {'name': 'another track'}, 'youtube', 'mp3', wait=True)
+        self.assertEqual(
+            create_zip_playlist.call_args[1]['args'],
+            [playlist_ref, 'spotify', playlists.checksum(playlist['tracks']),
+             'mp3'])
+        self.assertEqual(playlists.redis_client.zcard(
+            playlists.DOWNLOADING_SONGS_KEY), 0)
+        self.assertFalse(playlists.redis_client.exists(
+            'playlist_job_spotify_1234_mp3'))
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.songs.download_song_file')
+    @mock.patch('gepify.providers.playlists.create_zip_playlist.apply_async')
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_song_with_error(
+            self, download_playlist_song, create_zip_playlist,
+            download_song_file, *args):
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            {'name': 'some track'}, {'name': 'another track'}]}
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+
+        calls = download_playlist_song.call_args_list
+        download_song_file.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            playlists.download_playlist_song(*calls[0][0])
+        download_song_file.side_effect = None
+        playlists.download_playlist_song(*calls[1][0])
+
+        self.assertFalse(create_zip_playlist.called)
+        self.assertIsNone(playlists.cache.get('spotify_1234_mp3'))
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=mocked_get_songs())
+    @mock.patch('gepify.providers.youtube.get_song_ids',
+                side_effect=lambda names: {})
+    @mock.patch('gepify.providers.songs.download_song_file')
+    @mock.patch('gepify.providers.playlists.create_zip_playlist.apply_async')
+    @mock.patch('gepify.providers.playlists.download_playlist_song.delay')
+    def test_download_playlist_song_of_another_job(
+            self, download_playlist_song, create_zip_playlist, *args):
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
             {'name': 'some track'}, {'name': 'another track'}]}
-        playlists.download_playlist(playlist, 'spotify')
-        self.assertTrue(chord.called)
+        playlist_ref = playlists.store_playlist(playlist)
+        playlists.download_playlist(playlist_ref, 'spotify')
+        calls = download_playlist_song.call_args_list
+
+        # The playlist is downloaded again while its songs are downloading.
+        playlists.cache.delete('spotify_1234_mp3')
+        playlists.download_playlist(playlist_ref, 'spotify')
+        self.assertEqual(download_playlist_song.call_count, 2)
+        self.assertEqual(playlists.redis_client.hget(
+            'playlist_job_spotify_1234_mp3', 'pending'), b'2')
+
+        for call in calls:
+            playlists.download_playlist_song(*call[0])
+        self.assertEqual(create_zip_playlist.call_count, 1)
+
+        # Songs of a finished job do not affect the playlist.
+        playlists.cache.set('spotify_1234_mp3', {'checksum': '1234'})
+        playlists.download_playlist_song(*calls[0][0])
+        self.assertEqual(create_zip_playlist.call_count, 1)
+        self.assertEqual(
+            playlists.cache.get('spotify_1234_mp3'), {'checksum': '1234'})
+        self.assertFalse(playlists.redis_client.exists(
+            'playlist_job_spotify_1234_mp3'))
+
+    def test_queues(self):
+        router = gepify.celery.celery_app.amqp.router
+        route = router.route(
+            {}, 'gepify.providers.playlists.create_zip_playlist')
+        self.assertEqual(route['queue'].name, 'playlists')
+        route = router.route(
+            {}, 'gepify.providers.playlists.download_playlist_song')
+        self.assertEqual(route['queue'].name, 'playlist_songs')
+        self.assertEqual(route['priority'], gepify.celery.BULK_PRIORITY)
+        route = router.route({}, 'gepify.providers.songs.download_song')
+        self.assertEqual(route['queue'].name, 'songs')
+        self.assertEqual(
+            route['priority'], gepify.celery.INTERACTIVE_PRIORITY)
+
+    def test_stream_zip_playlist(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        playlist = {
+            'id': '1234',
+            'name': 'hated',
+            'tracks': [
+                {'name': 'macarena', 'files': {'mp3': 'test.mp3'}},
+                {'name': 'despacito', 'files': {'mp3': 'test.mp3'}}
+            ]
+        }
+
+        chunks = list(playlists.stream_zip_playlist(
+            playlist, 'mp3', chunk_size=1024))
+        self.assertGreater(len(chunks), 2)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            self.assertEqual(
+                playlist_zip.namelist(),
+                ['macarena.mp3', 'despacito.mp3', 'hated.m3u'])
+            self.assertEqual(
+                playlist_zip.getinfo('macarena.mp3').compress_type,
+                zipfile.ZIP_STORED)
+            self.assertEqual(
+                playlist_zip.read('despacito.mp3'),
+                b'some data' * 1000)
+            self.assertIn(b'#EXTINF:-1,macarena\nmacarena.mp3',
+                          playlist_zip.read('hated.m3u'))
+
+    def test_stream_zip_playlist_with_repeated_songs(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data')
+
+        song = {'name': 'macarena', 'files': {'mp3': 'test.mp3'}}
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [song, song]}
+
+        chunks = list(playlists.stream_zip_playlist(playlist, 'mp3'))
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            self.assertEqual(
+                playlist_zip.namelist(), ['macarena.mp3', 'hated.m3u'])
 
-    @mock.patch('gepify.providers.songs.get_song',
-                side_effect=lambda *args: {'name': 'macarena',
-                                           'files': {'mp3': 'test.mp3'}})
+    def test_stream_zip_playlist_with_known_file_info(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        file_info = songs.get_file_info('test.mp3')
+        playlist = {
+            'id': '1234',
+            'name': 'hated',
+            'tracks': [
+                {'name': 'macarena', 'files': {'mp3': 'test.mp3'},
+                 'file_info': {'mp3': file_info}},
+                {'name': 'despacito', 'files': {'mp3': 'test.mp3'},
+                 'file_info': {'mp3': file_info}}
+            ]
+        }
+
+        with mock.patch('zipfile.crc32', wraps=zipfile.crc32) as crc32:
+            chunks = list(playlists.stream_zip_playlist(
+                playlist, 'mp3', chunk_size=1024))
+            # Only the m3u file has its checksum computed
+            self.assertEqual(crc32.call_count, 1)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            self.assertEqual(
+                playlist_zip.namelist(),
+                ['macarena.mp3', 'despacito.mp3', 'hated.m3u'])
+            self.assertEqual(
+                playlist_zip.read('macarena.mp3'),
+                b'some data' * 1000)
+
+        self.assertEqual(playlists.zip_playlist_size(playlist, 'mp3'),
+                         len(b''.join(chunks)))
+
+    def test_zip_playlist_size_with_unknown_file_info(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data')
+
+        song = {'name': 'macarena', 'files': {'mp3': 'test.mp3'},
+                'file_info': {'mp3': songs.get_file_info('test.mp3')}}
+        playlist = {'id': '1234', 'name': 'hated', 'tracks': [
+            song, song, {'name': 'despacito', 'files': {'mp3': 'test.mp3'}}]}
+        self.assertIsNone(playlists.zip_playlist_size(playlist, 'mp3'))
+
+        playlist['tracks'].pop()
+        self.assertEqual(
+            playlists.zip_playlist_size(playlist, 'mp3'),
+            len(b''.join(playlists.stream_zip_playlist(playlist, 'mp3'))))
+
+    def test_stream_zip_playlist_with_outdated_file_info(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data')
+
+        playlist = {
+            'id': '1234',
+            'name': 'hated',
+            'tracks': [
+                {'name': 'macarena', 'files': {'mp3': 'test.mp3'},
+                 'file_info': {'mp3': {'size': 9, 'crc32': 1, 'mtime': 1}}}
+            ]
+        }
+
+        chunks = list(playlists.stream_zip_playlist(playlist, 'mp3'))
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            self.assertEqual(playlist_zip.read('macarena.mp3'), b'some data')
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda names: [{'name': 'macarena',
+                                            'files': {'mp3': 'test.mp3'}}])
     def test_create_zip_playlist(self, *args):
         with open('test.mp3', 'w+') as f:
             f.write('some data')
@@ -225,14 +930,168 @@ class PlaylistsTasksTestCase(TestCase):
             'name': 'hated'
         }
         checksum = playlists.checksum(playlist['tracks'])
+        playlist_ref = playlists.store_playlist(playlist)
 
         self.assertFalse(os.path.isfile('playlists/spotify_1234_mp3.zip'))
-        playlists.create_zip_playlist(playlist, 'spotify', checksum)
+        playlists.create_zip_playlist(playlist_ref, 'spotify', checksum)
         self.assertTrue(os.path.isfile('playlists/spotify_1234_mp3.zip'))
 
         playlist = playlists.cache.get('spotify_1234_mp3')
         self.assertEqual(playlist['path'], './playlists/spotify_1234_mp3.zip')
         self.assertEqual(playlist['checksum'], checksum)
+        self.assertEqual(songs.redis_client.zcard(songs.PINS_KEY), 0)
+
+    def test_create_zip_playlist_with_known_file_info(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        song = {'name': 'macarena', 'files': {'mp3': 'test.mp3'},
+                'file_info': {'mp3': songs.get_file_info('test.mp3')}}
+        playlist = {
+            'id': '1234',
+            'tracks': [{'name': 'macarena'}, {'name': 'macarena 2'}],
+            'name': 'hated'
+        }
+        checksum = playlists.checksum(playlist['tracks'])
+        playlist_ref = playlists.store_playlist(playlist)
+
+        with mock.patch('gepify.providers.songs.get_songs',
+                        side_effect=lambda names: [song, dict(
+                            song, name='macarena 2')]):
+            playlists.create_zip_playlist(playlist_ref, 'spotify', checksum)
+
+        with zipfile.ZipFile('playlists/spotify_1234_mp3.zip') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(
+                zip_file.namelist(),
+                ['macarena.mp3', 'macarena 2.mp3', 'hated.m3u'])
+            self.assertEqual(
+                zip_file.read('macarena 2.mp3'), b'some data' * 1000)
+
+    def create_zip_playlist(self, song_names, playlist_name='hated'):
+        playlist = {
+            'id': '1234',
+            'tracks': [{'name': name} for name in song_names],
+            'name': playlist_name
+        }
+        checksum = playlists.checksum(playlist['tracks'])
+        playlist_ref = playlists.store_playlist(playlist)
+
+        def get_songs(names):
+            return [{'name': name, 'files': {'mp3': 'test.mp3'}}
+                    for name in names]
+
+        with mock.patch('gepify.providers.songs.get_songs',
+                        side_effect=get_songs) as get_songs:
+            playlists.create_zip_playlist(playlist_ref, 'spotify', checksum)
+
+        with zipfile.ZipFile('playlists/spotify_1234_mp3.zip') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(
+                sorted(zip_file.namelist()),
+                sorted(['{}.mp3'.format(name) for name in song_names] +
+                       ['{}.m3u'.format(playlist_name)]))
+            self.assertIn('#EXTINF:-1,{}'.format(song_names[-1]),
+                          zip_file.read('{}.m3u'.format(playlist_name))
+                                  .decode('utf-8'))
+
+        return get_songs
+
+    def test_create_zip_playlist_adds_only_new_songs(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        self.create_zip_playlist(['macarena', 'despacito'])
+        get_songs = self.create_zip_playlist(
+            ['macarena', 'despacito', 'gangnam style'], 'loved')
+        get_songs.assert_called_once_with(['gangnam style'])
+
+        manifest = playlists.cache.get('spotify_1234_mp3_manifest')
+        self.assertEqual(manifest['tracks'],
+                         ['macarena', 'despacito', 'gangnam style'])
+        self.assertEqual(manifest['m3u'], 'loved.m3u')
+        self.assertEqual(manifest['dead_bytes'], 0)
+
+    def test_create_zip_playlist_adds_songs_with_known_file_info(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+        # The new song is smaller than the old m3u and central directory
+        # which it overwrites.
+        with open('playlists/short.mp3', 'w+') as f:
+            f.write('short')
+
+        def get_songs(names):
+            files = {name: 'playlists/short.mp3' if name == 'short song'
+                     else 'test.mp3' for name in names}
+            return [{'name': name, 'files': {'mp3': files[name]},
+                     'file_info': {'mp3': songs.get_file_info(files[name])}}
+                    for name in names]
+
+        for song_names in (['macarena', 'despacito'],
+                           ['macarena', 'despacito', 'short song']):
+            playlist = {
+                'id': '1234',
+                'tracks': [{'name': name} for name in song_names],
+                'name': 'hated'
+            }
+            with mock.patch('gepify.providers.songs.get_songs',
+                            side_effect=get_songs):
+                playlists.create_zip_playlist(
+                    playlists.store_playlist(playlist), 'spotify',
+                    playlists.checksum(playlist['tracks']))
+
+        with zipfile.ZipFile('playlists/spotify_1234_mp3.zip') as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            # The entries follow each other without any gaps.
+            offset = 0
+            for zinfo in zip_file.infolist():
+                self.assertEqual(zinfo.header_offset, offset)
+                offset += playlists._entry_size(zip_file, zinfo)
+            self.assertEqual(zip_file.start_dir, offset)
+
+        self.assertEqual(
+            os.path.getsize('playlists/spotify_1234_mp3.zip'),
+            offset + sum(
+                zipfile.sizeCentralDir + len(zinfo.filename)
+                for zinfo in zip_file.infolist()) + zipfile.sizeEndCentDir)
+        os.remove('playlists/short.mp3')
+
+    def test_create_zip_playlist_removes_songs(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        self.create_zip_playlist(['macarena', 'despacito', 'gangnam style'])
+        size = os.path.getsize('playlists/spotify_1234_mp3.zip')
+        get_songs = self.create_zip_playlist(['macarena', 'despacito'])
+        get_songs.assert_called_once_with([])
+
+        manifest = playlists.cache.get('spotify_1234_mp3_manifest')
+        self.assertEqual(manifest['tracks'], ['macarena', 'despacito'])
+        self.assertGreater(manifest['dead_bytes'], 9000)
+        self.assertGreater(
+            os.path.getsize('playlists/spotify_1234_mp3.zip'),
+            size - 9000)
+
+    def test_create_zip_playlist_compacts_archive(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data' * 1000)
+
+        self.create_zip_playlist(['macarena', 'despacito', 'gangnam style'])
+        self.create_zip_playlist(['macarena'])
+
+        manifest = playlists.cache.get('spotify_1234_mp3_manifest')
+        self.assertEqual(manifest['dead_bytes'], 0)
+        self.assertLess(
+            os.path.getsize('playlists/spotify_1234_mp3.zip'), 10000)
+
+    def test_create_zip_playlist_without_manifest(self):
+        with open('test.mp3', 'w+') as f:
+            f.write('some data')
+
+        self.create_zip_playlist(['macarena', 'despacito'])
+        playlists.cache.delete('spotify_1234_mp3_manifest')
+        get_songs = self.create_zip_playlist(['macarena'])
+        get_songs.assert_called_once_with(['macarena'])
 
 
 class mocked_Resource():
@@ -243,10 +1102,11 @@ class mocked_Resource():
         return self
 
     def list(self, *args, **kwargs):
+        request = mocked_Resource()
         if kwargs['q'] == 'existing song':
             with open('tests/youtube_dump.json') as f:
-                self.result = json.loads(f.read())
-        return self
+                request.result = json.loads(f.read())
+        return request
 
     def execute(self):
         return self
@@ -254,29 +1114,120 @@ class mocked_Resource():
     def get(self, *args, **kwargs):
         return self.result
 
+    def new_batch_http_request(self, callback):
+        return mocked_BatchHttpRequest(callback)
+
+
+class mocked_BatchHttpRequest():
+    exception = None
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            if self.exception is None:
+                self.callback(request_id, request.execute(), None)
+            else:
+                self.callback(request_id, None, self.exception)
+
 
 class YoutubeTestCase(TestCase):
-    @mock.patch('googleapiclient.discovery.Resource',
+    def setUp(self):
+        youtube.cache = SimpleCache()
+        rate_limits.redis_client = FakeStrictRedis()
+
+    @mock.patch('gepify.youtube_api.get_client',
                 side_effect=mocked_Resource)
-    def test_get_song_id(self, Resource):
+    def test_get_song_id(self, get_client):
         song_id = youtube.get_song_id('existing song')
         self.assertEqual(song_id, 'OV5_LQArLa0')
 
-    @mock.patch('googleapiclient.discovery.Resource',
+    @mock.patch('gepify.youtube_api.get_client',
                 side_effect=mocked_Resource)
-    def test_get_song_id_if_no_song_is_found(self, Resource):
+    def test_get_song_id_if_no_song_is_found(self, get_client):
         with self.assertRaises(RuntimeError):
             youtube.get_song_id('missing song')
 
+    @mock.patch('gepify.youtube_api.get_client',
+                side_effect=mocked_Resource)
+    def test_get_song_id_caches_search_results(self, get_client):
+        self.assertEqual(youtube.get_song_id('existing song'), 'OV5_LQArLa0')
+        self.assertEqual(youtube.get_song_id('existing song'), 'OV5_LQArLa0')
+        self.assertEqual(get_client.call_count, 1)
+
+    @mock.patch('gepify.youtube_api.get_client',
+                side_effect=mocked_Resource)
+    def test_get_song_id_caches_missing_songs(self, get_client):
+        for i in range(2):
+            with self.assertRaisesRegex(RuntimeError, 'Could not find song'):
+                youtube.get_song_id('missing song')
+        self.assertEqual(get_client.call_count, 1)
+
+    @mock.patch('gepify.youtube_api.get_client',
+                side_effect=mocked_Resource)
+    def test_get_song_ids(self, get_client):
+        song_ids = youtube.get_song_ids(
+            ['existing song', 'missing song', 'existing song'])
+        self.assertEqual(song_ids, {'existing song': 'OV5_LQArLa0'})
+        self.assertEqual(get_client.call_count, 1)
+        self.assertEqual(youtube.cache.get('missing song'), youtube.NOT_FOUND)
+
+        with self.assertRaisesRegex(RuntimeError, 'Could not find song'):
+            youtube.get_song_id('missing song')
+        self.assertEqual(get_client.call_count, 1)
+
+    @mock.patch('gepify.youtube_api.get_client',
+                side_effect=mocked_Resource)
+    @mock.patch.dict(rate_limits.RATE_LIMITS, {'youtube.search': (1000, 100)})
+    def test_get_song_ids_in_many_batches(self, get_client):
+        youtube.cache.set('cached song', 'cached id')
+        song_names = ['cached song'] + [
+            'song {}'.format(i) for i in range(youtube.BATCH_SIZE + 1)]
+
+        song_ids = youtube.get_song_ids(song_names)
+        self.assertEqual(song_ids, {'cached song': 'cached id'})
+        self.assertEqual(get_client.call_count, 2)
+
+    @mock.patch('gepify.providers.youtube._search_batch',
+                side_effect=lambda song_names: {
+                    song_names[0]: threading.current_thread().name})
+    def test_get_song_ids_reuses_threads(self, *args):
+        song_names = ['song {}'.format(i) for i in range(
+            youtube.BATCH_SIZE * youtube.MAX_CONCURRENT_REQUESTS * 2)]
+        threads = set(youtube.get_song_ids(song_names).values())
+        threads.update(youtube.get_song_ids(song_names).values())
+        self.assertLessEqual(len(threads), youtube.MAX_CONCURRENT_REQUESTS)
+
+        executor = youtube._get_executor()
+        self.assertIs(youtube._get_executor(), executor)
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(youtube._get_executor(), executor)
+
+    @mock.patch('gepify.youtube_api.get_client',
+                side_effect=mocked_Resource)
+    @mock.patch.object(mocked_BatchHttpRequest, 'exception', RuntimeError())
+    def test_get_song_ids_if_search_fails(self, get_client):
+        self.assertEqual(youtube.get_song_ids(['existing song']), {})
+        self.assertIsNone(youtube.cache.get('existing song'))
+
     def test_download_song_with_unsupported_format(self):
         with self.assertRaises(ValueError):
             youtube.download_song('song id', 'wav')
 
-    @mock.patch('youtube_dl.YoutubeDL.download')
-    def test_download_song(self, download):
+    @mock.patch('gepify.providers.sources.convert')
+    @mock.patch('gepify.providers.sources.get_source',
+                side_effect=lambda *args: './sources/youtube_song id.webm')
+    def test_download_song(self, get_source, convert):
         youtube.download_song('song id', 'mp3')
-        self.assertEqual(download.call_count, 1)
-        download.assert_called_with(['http://www.youtube.com/watch?v=song id'])
+        get_source.assert_called_once_with(
+            'youtube', 'song id', 'http://www.youtube.com/watch?v=song id')
+        convert.assert_called_once_with(
+            './sources/youtube_song id.webm', './songs/song id.mp3', 'mp3')
 
 
 class mocked_Response():
@@ -302,6 +1253,10 @@ class mocked_Client():
 
 
 class SoundcloudTestCase(TestCase):
+    def setUp(self):
+        soundcloud.cache = SimpleCache()
+        rate_limits.redis_client = FakeStrictRedis()
+
     @mock.patch('soundcloud.Client', side_effect=mocked_Client)
     def test_get_song_id(self, Client):
         song_id, download_id = soundcloud.get_song_id('existing song')
@@ -313,12 +1268,219 @@ class SoundcloudTestCase(TestCase):
         with self.assertRaises(RuntimeError):
             soundcloud.get_song_id('missing song')
 
+    @mock.patch('soundcloud.Client', side_effect=mocked_Client)
+    def test_get_song_id_caches_search_results(self, Client):
+        soundcloud.get_song_id('existing song')
+        song_id, download_id = soundcloud.get_song_id('existing song')
+        self.assertEqual(song_id, '1234')
+        self.assertEqual(download_id, 'user_permalink/song_permalink')
+        self.assertEqual(Client.call_count, 1)
+
+    @mock.patch('soundcloud.Client', side_effect=mocked_Client)
+    def test_get_song_id_caches_missing_songs(self, Client):
+        for i in range(2):
+            with self.assertRaisesRegex(RuntimeError, 'Could not find song'):
+                soundcloud.get_song_id('missing song')
+        self.assertEqual(Client.call_count, 1)
+
     def test_download_song_with_unsupported_format(self):
         with self.assertRaises(ValueError):
-            soundcloud.download_song('song id', 'wav')
+            soundcloud.download_song('1234', 'song id', 'wav')
+
+    @mock.patch('gepify.providers.sources.convert')
+    @mock.patch('gepify.providers.sources.get_source',
+                side_effect=lambda *args: './sources/soundcloud_1234.mp3')
+    def test_download_song(self, get_source, convert):
+        soundcloud.download_song('1234', 'song id', 'ogg')
+        get_source.assert_called_once_with(
+            'soundcloud', '1234', 'http://soundcloud.com/song id')
+        convert.assert_called_once_with(
+            './sources/soundcloud_1234.mp3', './songs/1234.ogg', 'ogg')
+
 
-    @mock.patch('youtube_dl.YoutubeDL.download')
-    def test_download_song(self, download):
-        soundcloud.download_song('song id', 'mp3')
-        self.assertEqual(download.call_count, 1)
-        download.assert_called_with(['http://soundcloud.com/song id'])
+class SourcesTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.makedirs('sources/downloading', exist_ok=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        for path in ('sources/youtube_song id.webm',
+                     'sources/youtube_song id.webm.part',
+                     'sources/youtube_other id.m4a'):
+            if os.path.isfile(path):
+                os.remove(path)
+        os.rmdir('sources/downloading')
+
+    def setUp(self):
+        rate_limits.redis_client = FakeStrictRedis()
+        songs.redis_client = FakeStrictRedis()
+
+    def mock_download(self, YoutubeDL, filename):
+        def extract_info(url):
+            with open(filename, 'w+') as f:
+                f.write('some data')
+
+        ydl = YoutubeDL.return_value.__enter__.return_value
+        ydl.extract_info.side_effect = extract_info
+        ydl.prepare_filename.return_value = filename
+        return ydl
+
+    @mock.patch('gepify.providers.sources.youtube_dl.YoutubeDL')
+    def test_get_source_if_source_is_missing(self, YoutubeDL):
+        ydl = self.mock_download(
+            YoutubeDL, './sources/downloading/youtube_other id.m4a')
+        source = sources.get_source('youtube', 'other id', 'some url')
+        self.assertEqual(source, './sources/youtube_other id.m4a')
+        self.assertTrue(os.path.isfile(source))
+        self.assertEqual(
+            YoutubeDL.call_args[0][0]['outtmpl'],
+            './sources/downloading/youtube_other id.%(ext)s')
+        ydl.extract_info.assert_called_once_with('some url')
+        self.assertIsNotNone(songs.claim_song('youtube_other id', 'source'))
+        self.assertEqual(songs.redis_client.hget(
+            songs.SONG_FILE_SIZES_KEY, source), b'9')
+
+    @mock.patch('gepify.providers.sources.youtube_dl.YoutubeDL')
+    def test_get_source_if_source_exists(self, YoutubeDL):
+        self.mock_download(
+            YoutubeDL, './sources/downloading/youtube_song id.webm')
+        with open('sources/youtube_song id.webm.part', 'w+') as f:
+            f.write('some data')
+        sources.get_source('youtube', 'song id', 'some url')
+        self.assertTrue(YoutubeDL.called)
+
+        YoutubeDL.reset_mock()
+        source = sources.get_source('youtube', 'song id', 'some url')
+        self.assertEqual(source, './sources/youtube_song id.webm')
+        self.assertFalse(YoutubeDL.called)
+
+    @mock.patch('gepify.providers.songs.wait_for_song')
+    @mock.patch('gepify.providers.sources.youtube_dl.YoutubeDL')
+    def test_get_source_if_source_is_being_downloaded(
+            self, YoutubeDL, wait_for_song):
+        def finish_download(*args):
+            songs.redis_client.delete('song_claim_youtube_song id_source')
+            with open('sources/youtube_song id.webm', 'w+') as f:
+                f.write('some data')
+            return True
+
+        wait_for_song.side_effect = finish_download
+        songs.claim_song('youtube_song id', 'source')
+        source = sources.get_source('youtube', 'song id', 'some url')
+        self.assertEqual(source, './sources/youtube_song id.webm')
+        self.assertFalse(YoutubeDL.called)
+
+    @mock.patch('gepify.providers.songs.wait_for_song',
+                side_effect=lambda *args: False)
+    def test_get_source_if_waiting_times_out(self, *args):
+        songs.claim_song('youtube_new id', 'source')
+        with self.assertRaisesRegex(RuntimeError, 'Timed out'):
+            sources.get_source('youtube', 'new id', 'some url')
+
+    def test_convert_with_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            sources.convert('song.webm', 'songs/song.wav', 'wav')
+
+    @mock.patch('subprocess.run')
+    def test_get_audio_codec(self, run):
+        run.return_value.stdout = b'opus\n'
+        self.assertEqual(sources.get_audio_codec('song.webm'), 'opus')
+        self.assertEqual(run.call_args[0][0][0], 'ffprobe')
+
+        run.side_effect = subprocess.CalledProcessError(1, 'ffprobe')
+        self.assertIsNone(sources.get_audio_codec('song.webm'))
+
+    @mock.patch('os.replace')
+    @mock.patch('subprocess.run')
+    @mock.patch('gepify.providers.sources.get_audio_codec',
+                side_effect=lambda path: 'opus')
+    def test_convert(self, get_audio_codec, run, replace):
+        sources.convert('sources/song.webm', 'songs/song.mp3', 'mp3')
+        command = run.call_args[0][0]
+        self.assertEqual(command[0], 'ffmpeg')
+        self.assertIn('sources/song.webm', command)
+        self.assertIn('libmp3lame', command)
+        self.assertEqual(command[-3:-1], ['-f', 'mp3'])
+        self.assertEqual(
+            os.path.dirname(command[-1]), os.path.abspath('songs'))
+        self.assertTrue(os.path.basename(command[-1]).startswith('song.mp3.'))
+        self.assertTrue(command[-1].endswith('.part'))
+        replace.assert_called_once_with(command[-1], 'songs/song.mp3')
+        self.assertFalse(os.path.exists(command[-1]))
+
+    @mock.patch('subprocess.run')
+    @mock.patch('gepify.providers.sources.get_audio_codec',
+                side_effect=lambda path: 'opus')
+    def test_convert_to_same_destination_at_once(self, get_audio_codec, run):
+        with mock.patch('os.replace'):
+            sources.convert('sources/song.webm', 'songs/song.mp3', 'mp3')
+            sources.convert('sources/song.webm', 'songs/song.mp3', 'mp3')
+        first_command, second_command = [
+            call[0][0] for call in run.call_args_list]
+        self.assertNotEqual(first_command[-1], second_command[-1])
+
+    @mock.patch('os.replace')
+    @mock.patch('subprocess.run')
+    @mock.patch('gepify.providers.sources.get_audio_codec',
+                side_effect=lambda path: 'aac')
+    def test_convert_without_reencoding(self, get_audio_codec, run, *args):
+        sources.convert('sources/song.m4a', 'songs/song.aac', 'aac')
+        command = run.call_args[0][0]
+        self.assertIn('copy', command)
+        self.assertNotIn('-b:a', command)
+        self.assertEqual(command[-3:-1], ['-f', 'adts'])
+
+    @mock.patch('gepify.providers.sources.get_audio_codec',
+                side_effect=lambda path: None)
+    @mock.patch('subprocess.run',
+                side_effect=subprocess.CalledProcessError(
+                    1, 'ffmpeg', stderr=b'Invalid data'))
+    def test_convert_if_ffmpeg_fails(self, *args):
+        with self.assertRaisesRegex(RuntimeError, 'Invalid data'):
+            sources.convert('sources/song.webm', 'songs/song.mp3', 'mp3')
+        self.assertEqual(
+            [name for name in os.listdir('songs') if name.endswith('.part')],
+            [])
+
+
+@mock.patch.dict(rate_limits.RATE_LIMITS, {'test': (1, 2)})
+class RateLimitsTestCase(TestCase):
+    def setUp(self):
+        rate_limits.redis_client = FakeStrictRedis()
+
+    def test_acquire_with_unknown_rate_limit(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown rate limit: wat'):
+            rate_limits.acquire('wat')
+
+    @mock.patch('time.sleep')
+    def test_acquire_within_burst(self, sleep):
+        rate_limits.acquire('test')
+        rate_limits.acquire('test')
+        self.assertFalse(sleep.called)
+        self.assertAlmostEqual(
+            rate_limits._take_tokens('test', 1), 1, places=1)
+
+    def test_acquire_if_requests_are_limited(self):
+        rate_limits.acquire('test', 2)
+        with self.assertRaisesRegex(
+                RuntimeError, 'Rate limit exceeded: test'):
+            rate_limits.acquire('test', timeout=0.5)
+
+    def test_acquire_more_than_burst(self):
+        rate_limits.acquire('test', 5)
+        self.assertAlmostEqual(
+            rate_limits._take_tokens('test', 1), 4, places=1)
+
+    @mock.patch.dict(rate_limits.RATE_LIMITS, {'test': (100, 1)})
+    def test_acquire_waits_for_tokens(self):
+        rate_limits.acquire('test')
+        with mock.patch('time.sleep', wraps=time.sleep) as sleep:
+            rate_limits.acquire('test')
+        self.assertTrue(sleep.called)
+        self.assertLessEqual(sleep.call_args[0][0], 0.01)
+
+    def test_buckets_are_forgotten_when_full(self):
+        rate_limits.acquire('test')
+        ttl = rate_limits.redis_client.ttl(rate_limits._bucket_key('test'))
+        self.assertTrue(0 < ttl <= 2)
@@ -5,10 +5,13 @@ import spotipy
 from urllib import parse
 from unittest import mock
 from gepify.services import spotify
-from gepify.providers import songs
+from gepify.providers import songs, playlists
 from werkzeug.contrib.cache import SimpleCache
+from fakeredis import FakeStrictRedis
+import io
 import json
 import os
+import zipfile
 import time
 
 
@@ -57,6 +60,8 @@ def mocked_spotify_api_401(*args, **kwargs):
 
 
 class MockSpotipy:
+    snapshot_id = 'first snapshot'
+
     def __init__(self, auth=None):
         self.auth = auth
 
@@ -65,35 +70,47 @@ class MockSpotipy:
             'id': 'test_user'
         }
 
-    def user_playlists(self, username):
+    def user_playlists(self, username, limit=50, offset=0):
         with open('tests/spotify_dump/spotify_user_playlists.json') as f:
             return json.loads(f.read())
 
     def user_playlist(self, username, playlist_id, fields=None):
         if username == 'test_user' and playlist_id == '1':
+            if fields == 'snapshot_id':
+                return {'snapshot_id': self.snapshot_id}
+
             with open('tests/spotify_dump/spotify_user_playlist.json') as f:
-                return json.loads(f.read())
+                playlist = json.loads(f.read())
+                playlist['snapshot_id'] = self.snapshot_id
+                return playlist
+
+    def user_playlist_tracks(self, username, playlist_id, fields=None,
+                             limit=100, offset=0):
+        if username == 'test_user' and playlist_id == '1':
+            with open('tests/spotify_dump/spotify_next.json') as f:
+                tracks = json.loads(f.read())
+
+            # The dump contains the second page of a playlist with 243 songs
+            if offset == 200:
+                tracks['items'] = tracks['items'][:43]
+            return tracks
 
-    def current_user_saved_albums(self):
+    def current_user_saved_albums(self, limit=20, offset=0):
         with open('tests/spotify_dump/'
                   'spotify_current_user_saved_albums.json') as f:
             return json.loads(f.read())
 
+    def album_tracks(self, album_id, limit=50, offset=0):
+        return {'items': []}
+
     def album(self, album_id):
         if album_id == '0AYlrY39QmCNwR4r1uzlv3':
             with open('tests/spotify_dump/spotify_album.json') as f:
                 return json.loads(f.read())
 
-    def next(self, result):
-        if result['next'] == 'https://api.spotify.com/v1/users/aplusk' + \
-                             '/playlists/5ExcrV72XoJ6aQT8plfau3/' + \
-                             'tracks?offset=100&limit=100':
-            with open('tests/spotify_dump/spotify_next.json') as f:
-                return json.loads(f.read())
-
 
 class ProfileMixin():
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def login(self, *args):
         login_response = self.client.get(url_for('spotify.login'))
         spotify_redirect = login_response.location
@@ -108,14 +125,14 @@ class ProfileMixin():
         self.assertRedirects(response, url_for('spotify.index'))
         return response
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def logout(self, *args):
         logout_response = self.client.get(url_for('spotify.logout'))
         self.assertRedirects(logout_response, url_for('views.index'))
         return logout_response
 
 
-@mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+@mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
 class SpotifyDecoratorsTestCase(GepifyTestCase, ProfileMixin):
     def test_login_required_decorator(self, *args):
         @self.app.route('/test')
@@ -197,11 +214,12 @@ class SpotifyModelsTestCase(GepifyTestCase):
     def setUp(self):
         g.spotipy = MockSpotipy()
         songs.cache = SimpleCache()
+        spotify.models.cache = SimpleCache()
 
     def tearDown(self):
         g.spotipy = None
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_get_access_token_from_code(self, post):
         token_data =spotify.models.get_access_token_from_code('some code')
         self.assertEqual(post.call_count, 1)
@@ -209,7 +227,7 @@ class SpotifyModelsTestCase(GepifyTestCase):
         self.assertEqual(token_data['refresh_token'], 'refresh me')
         self.assertEqual(token_data['expires_in'], 60)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_get_access_token_from_refresh_token(self, post):
         token_data = spotify.models.get_access_token_from_refresh_token(
                 'refresh me')
@@ -229,7 +247,7 @@ class SpotifyModelsTestCase(GepifyTestCase):
         self.assertEqual(session['spotify_refresh_token'], 'refresh token')
         self.assertEqual(session['spotify_expires_at'], int(time.time()) + 60)
 
-    # @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    # @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     # def test_request_access_token_with_refresh_token_request(self, post):
     #     payload = {
     #         'grant_type': 'refresh_token',
@@ -246,13 +264,13 @@ class SpotifyModelsTestCase(GepifyTestCase):
     #     self.assertEqual(session['spotify_refresh_token'], 'refresh me again')
     #     self.assertIn('spotify_expires_at', session)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_404)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_404)
     def test_get_access_token_from_code_with_error(self, post):
         with self.assertRaisesRegex(
                 RuntimeError, 'Could not get authentication token'):
             spotify.models.get_access_token_from_code('code')
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_404)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_404)
     def test_get_access_token_from_refresh_token_with_error(self, post):
         with self.assertRaisesRegex(
                 RuntimeError, 'Could not get authentication token'):
@@ -282,7 +300,7 @@ class SpotifyModelsTestCase(GepifyTestCase):
         self.assertIsNone(playlist['description'])
         self.assertIn('image', playlist)
         self.assertEqual(playlist['id'], 'test_user:1')
-        self.assertEqual(len(playlist['tracks']), 200)
+        self.assertEqual(len(playlist['tracks']), 243)
 
     def test__get_album(self):
         album = spotify.models._get_album('0AYlrY39QmCNwR4r1uzlv3')
@@ -291,31 +309,98 @@ class SpotifyModelsTestCase(GepifyTestCase):
         self.assertIn('image', album)
         self.assertEqual(len(album['tracks']), 13)
 
-    @mock.patch('gepify.providers.songs.get_song',
-                side_effect=lambda song_name: {'name': song_name})
-    def test_get_playlist_without_keeping_song_names(self, get_song):
+    def test__get_playlist_requests_pages_concurrently(self):
+        with mock.patch.object(g.spotipy, 'user_playlist_tracks',
+                               wraps=g.spotipy.user_playlist_tracks) as \
+                user_playlist_tracks:
+            playlist = spotify.models._get_playlist('test_user', '1')
+
+        self.assertEqual(
+            sorted(call[1]['offset']
+                   for call in user_playlist_tracks.call_args_list),
+            [100, 200])
+        self.assertEqual(playlist['tracks'][142]['name'],
+                         'Sleigh Bells - Rill Rill')
+        self.assertEqual(playlist['tracks'][242]['name'],
+                         'Sleigh Bells - Rill Rill')
+
+    def test_get_all_items(self):
+        def get_page(offset):
+            return {'items': list(range(offset, min(offset + 10, 35)))}
+
+        items = spotify.models._get_all_items(
+            {'items': list(range(5)), 'total': 35}, get_page, 10)
+        self.assertEqual(items, list(range(35)))
+
+    def test__get_playlist_if_playlist_has_not_changed(self):
+        spotify.models._get_playlist('test_user', '1')
+
+        with mock.patch.object(g.spotipy, 'user_playlist_tracks') as \
+                next_tracks, \
+                mock.patch.object(g.spotipy, 'user_playlist',
+                                  wraps=g.spotipy.user_playlist) as \
+                user_playlist:
+            playlist = spotify.models._get_playlist('test_user', '1')
+            user_playlist.assert_called_once_with(
+                'test_user', '1', 'snapshot_id')
+            self.assertFalse(next_tracks.called)
+
+        self.assertEqual(playlist['name'], 'Starred')
+        self.assertEqual(len(playlist['tracks']), 243)
+        self.assertNotIn('song_names', playlist)
+
+    def test__get_playlist_if_playlist_has_changed(self):
+        spotify.models._get_playlist('test_user', '1')
+        g.spotipy.snapshot_id = 'second snapshot'
+
+        with mock.patch.object(g.spotipy, 'user_playlist_tracks',
+                               wraps=g.spotipy.user_playlist_tracks) as \
+                next_tracks:
+            playlist = spotify.models._get_playlist('test_user', '1')
+            self.assertTrue(next_tracks.called)
+
+        self.assertEqual(playlist['snapshot_id'], 'second snapshot')
+        self.assertEqual(len(playlist['tracks']), 243)
+
+    def test__get_album_if_album_is_cached(self):
+        spotify.models._get_album('0AYlrY39QmCNwR4r1uzlv3')
+
+        with mock.patch.object(g.spotipy, 'album') as album:
+            playlist = spotify.models._get_album('0AYlrY39QmCNwR4r1uzlv3')
+            self.assertFalse(album.called)
+
+        self.assertEqual(playlist['name'], 'Bozdugan')
+        self.assertEqual(len(playlist['tracks']), 13)
+
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name} for song_name in song_names])
+    def test_get_playlist_without_keeping_song_names(self, get_songs):
         playlist = spotify.models.get_playlist('test_user:1')
         self.assertEqual(playlist['id'], 'test_user:1')
         self.assertIsNone(playlist['description'])
         self.assertEqual(playlist['name'], 'Starred')
-        self.assertEqual(len(playlist['tracks']), 200)
-        self.assertEqual(get_song.call_count, len(playlist['tracks']))
+        self.assertEqual(len(playlist['tracks']), 243)
+        self.assertEqual(get_songs.call_count, 1)
         self.assertEqual(playlist['tracks'][25]['name'],
                          'Leona Lewis - Bleeding Love')
         self.assertEqual(playlist['tracks'][42]['name'],
                          'The National - Anyone’s Ghost')
 
-        get_song.reset_mock()
+        get_songs.reset_mock()
         playlist = spotify.models.get_playlist('album:0AYlrY39QmCNwR4r1uzlv3')
         self.assertEqual(playlist['name'], 'Bozdugan')
         self.assertEqual(playlist['id'], 'album:0AYlrY39QmCNwR4r1uzlv3')
         self.assertEqual(len(playlist['tracks']), 13)
-        self.assertEqual(get_song.call_count, len(playlist['tracks']))
+        self.assertEqual(get_songs.call_count, 1)
 
 
 class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
     def setUp(self):
         songs.cache = SimpleCache()
+        songs.redis_client = FakeStrictRedis()
+        playlists.redis_client = FakeStrictRedis()
+        spotify.models.cache = SimpleCache()
 
     @classmethod
     def tearDownClass(cls):
@@ -336,7 +421,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assert200(response)
         self.assertIn(b'Bozdugan', response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_login(self, *args):
         response = self.client.get(url_for('spotify.login'))
         self.assertTrue(response.location.startswith(
@@ -346,7 +431,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertIn(b'You need to be logged out to see this page',
                       response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_login_callback(self, post, *args):
         response = self.client.get(
             url_for('spotify.callback', error='access_denied'))
@@ -370,7 +455,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertRedirects(response, url_for('spotify.index'))
         self.assertEqual(post.call_count, 1)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_404)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_404)
     def test_login_callback_with_spotify_error(self, post, *args):
         with self.client.session_transaction() as sess:
             sess['spotify_auth_state'] = 'some state'
@@ -396,9 +481,11 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertRedirects(response, url_for('spotify.login'))
 
     @mock.patch('spotipy.Spotify', side_effect=MockSpotipy)
-    @mock.patch('gepify.providers.songs.get_song',
-                side_effect=lambda song_name: {'name': song_name, 'files': {}})
-    def test_get_playlist(self, get_song, Spotify):
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name, 'files': {}}
+                    for song_name in song_names])
+    def test_get_playlist(self, get_songs, Spotify):
         self.login()
         response = self.client.get(
             url_for('spotify.playlist', id='test_user:1'))
@@ -452,6 +539,63 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertTrue(response.content_type.startswith('audio'))
         response.close()
 
+    @mock.patch('gepify.providers.songs.has_song_format',
+                side_effect=lambda song, format: True)
+    @mock.patch('gepify.providers.songs.get_song',
+                side_effect=lambda song: {
+                    'name': song, 'files': {'mp3': os.getcwd() + '/' + song + '.mp3'}})
+    def test_download_song_with_range_request(self, *args):
+        with open('test song.mp3', 'w+') as f:
+            f.write('some data')
+
+        self.login()
+        response = self.client.get(
+            url_for('spotify.download_song',
+                    song_name='test song', format='mp3'),
+            headers={'Range': 'bytes=5-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b'data', response.data)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 5-8/9')
+        response.close()
+
+    @mock.patch('gepify.providers.songs.has_song_format',
+                side_effect=lambda song, format: True)
+    @mock.patch('gepify.providers.songs.get_song',
+                side_effect=lambda song: {
+                    'name': song, 'files': {'mp3': os.getcwd() + '/' + song + '.mp3'}})
+    def test_download_song_if_not_modified(self, *args):
+        with open('test song.mp3', 'w+') as f:
+            f.write('some data')
+
+        self.login()
+        url = url_for('spotify.download_song',
+                      song_name='test song', format='mp3')
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        response.close()
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(b'', response.data)
+        response.close()
+
+    @mock.patch('gepify.providers.songs.has_song_format',
+                side_effect=lambda song, format: True)
+    @mock.patch('gepify.providers.songs.get_song',
+                side_effect=lambda song: {
+                    'name': song, 'files': {'mp3': './songs/' + song + '.mp3'}})
+    def test_download_song_with_accel_redirect(self, *args):
+        self.app.config['X_ACCEL_REDIRECT_PREFIX'] = '/protected/'
+        self.login()
+        response = self.client.get(
+            url_for('spotify.download_song',
+                    song_name='test song', format='mp3'))
+        self.assert200(response)
+        self.assertEqual(b'', response.data)
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/protected/songs/test%20song.mp3')
+        self.assertIn('test song.mp3', response.headers['Content-Disposition'])
+
     def test_download_playlist_with_wrong_post_data(self, *args):
         self.login()
         response = self.client.post(url_for('spotify.download_playlist'))
@@ -489,7 +633,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
     @mock.patch('gepify.providers.playlists.get_playlist',
                 side_effect=lambda *args: {
                     'path': os.getcwd() + '/playlist.zip',
-                    'checksum': '89c2226a90943679844cdc71693bc543'})
+                    'checksum': 'cc19b1306a40e2e103f2c630a74ab0ea'})
     @mock.patch('spotipy.Spotify', side_effect=MockSpotipy)
     def test_download_playlist_if_playlist_is_not_missing(self, *args):
         with open('playlist.zip', 'w+') as f:
@@ -504,6 +648,34 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertEqual(response.content_type, 'application/zip')
         response.close()
 
+    @mock.patch('gepify.providers.playlists.has_playlist',
+                side_effect=lambda *args: False)
+    @mock.patch('gepify.providers.songs.get_songs',
+                side_effect=lambda song_names: [
+                    {'name': song_name, 'files': {'mp3': 'test song.mp3'}}
+                    for song_name in song_names])
+    @mock.patch('gepify.providers.playlists.download_playlist.delay')
+    @mock.patch('spotipy.Spotify', side_effect=MockSpotipy)
+    def test_download_playlist_if_all_songs_are_downloaded(
+            self, Spotify, download_playlist, *args):
+        with open('test song.mp3', 'w+') as f:
+            f.write('some data')
+
+        self.login()
+        response = self.client.post(
+            url_for('spotify.download_playlist'),
+            data={'playlist_id': 'test_user:1', 'format': 'mp3'})
+        self.assert200(response)
+        self.assertEqual(response.content_type, 'application/zip')
+        self.assertEqual(response.headers['Accept-Ranges'], 'none')
+        self.assertFalse(download_playlist.called)
+
+        with zipfile.ZipFile(io.BytesIO(response.data)) as playlist_zip:
+            self.assertIsNone(playlist_zip.testzip())
+            # 44 of the 243 songs are repeats, which are archived only once.
+            self.assertEqual(len(playlist_zip.namelist()), 199 + 1)
+        response.close()
+
     @mock.patch('gepify.providers.playlists.has_playlist',
                 side_effect=lambda *args: True)
     @mock.patch('gepify.providers.playlists.get_playlist',
@@ -520,7 +692,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assert200(response)
         self.assertIn(b'Your playlist is getting downloaded', response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_get_access_token_success(self, post):
         response = self.client.get(
             '/spotify/get_access_token/code'
@@ -531,7 +703,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertIn(b'refresh me', response.data)
         self.assertIn(b'60', response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_404)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_404)
     def test_get_access_token_error(self, post):
         response = self.client.get(
             '/spotify/get_access_token/code'
@@ -541,7 +713,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertIn(b'There was an error while trying to authenticate you.'
                       b'Please, try again.', response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_post)
     def test_refresh_access_token_success(self, post):
         response = self.client.get(
             '/spotify/refresh_access_token/refresh me'
@@ -552,7 +724,7 @@ class SpotifyViewsTestCase(GepifyTestCase, ProfileMixin):
         self.assertIn(b'refresh me again', response.data)
         self.assertIn(b'60', response.data)
 
-    @mock.patch('requests.post', side_effect=mocked_spotify_api_401)
+    @mock.patch('requests.Session.post', side_effect=mocked_spotify_api_401)
     def test_refresh_access_token_error(self, post):
         response = self.client.get(
             '/spotify/refresh_access_token/refresh me'
@@ -0,0 +1,127 @@
+from . import GepifyTestCase
+from gepify.services import youtube
+from gepify.providers import songs
+from werkzeug.contrib.cache import SimpleCache
+from apiclient.errors import HttpError
+from flask import g
+import httplib2
+
+
+class MockRequest:
+    def __init__(self, response):
+        self.response = response
+        self.headers = {}
+
+    def execute(self):
+        if self.headers.get('If-None-Match') == self.response['etag']:
+            raise HttpError(httplib2.Response({'status': 304}), b'')
+        return self.response
+
+
+class MockYoutube:
+    def __init__(self, num_tracks):
+        self.num_tracks = num_tracks
+        self.requests = []
+
+    def playlists(self):
+        return self
+
+    def playlistItems(self):
+        return self
+
+    def list(self, **kwargs):
+        if 'playlistId' in kwargs:
+            response = self.playlist_items(kwargs.get('pageToken'))
+        elif kwargs.get('mine'):
+            response = self.user_playlists(kwargs.get('pageToken'))
+        else:
+            response = {
+                'etag': 'playlist etag',
+                'items': [{
+                    'snippet': {
+                        'title': 'Playlist 1',
+                        'description': 'Some description',
+                        'thumbnails': {'medium': {'url': 'some url'}}
+                    }
+                }]
+            }
+
+        request = MockRequest(response)
+        self.requests.append(request)
+        return request
+
+    def playlist_items(self, page_token):
+        start = int(page_token or 0)
+        end = min(start + 50, self.num_tracks)
+        response = {
+            'etag': 'page {} of {}'.format(start, self.num_tracks),
+            'items': [{
+                'snippet': {'title': 'Song {}'.format(i)},
+                'contentDetails': {'videoId': 'video {}'.format(i)}
+            } for i in range(start, end)]
+        }
+
+        if end < self.num_tracks:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def user_playlists(self, page_token):
+        response = {
+            'etag': 'playlists',
+            'items': [{
+                'id': str(page_token),
+                'snippet': {
+                    'title': 'Playlist',
+                    'thumbnails': {'medium': {'url': 'some url'}}
+                },
+                'contentDetails': {'itemCount': 1}
+            }]
+        }
+
+        if page_token is None:
+            response['nextPageToken'] = 'second page'
+        return response
+
+
+class YoutubeModelsTestCase(GepifyTestCase):
+    def setUp(self):
+        songs.cache = SimpleCache()
+        youtube.models.cache = SimpleCache()
+        g.youtube = MockYoutube(num_tracks=120)
+
+    def tearDown(self):
+        g.youtube = None
+
+    def test_get_playlists(self):
+        playlists = youtube.models.get_playlists()
+        self.assertEqual([playlist['id'] for playlist in playlists],
+                         ['None', 'second page'])
+
+    def test_get_playlist(self):
+        playlist = youtube.models.get_playlist('1')
+        self.assertEqual(playlist['name'], 'Playlist 1')
+        self.assertEqual(playlist['description'], 'Some description')
+        self.assertEqual(playlist['image'], 'some url')
+        self.assertEqual(len(playlist['tracks']), 120)
+        self.assertEqual(playlist['tracks'][119]['name'], 'Song 119')
+        self.assertEqual(playlist['tracks'][119]['youtube'], 'video 119')
+        self.assertEqual(len(g.youtube.requests), 4)
+
+    def test_get_playlist_if_playlist_has_not_changed(self):
+        youtube.models.get_playlist('1')
+        g.youtube.requests = []
+
+        playlist = youtube.models.get_playlist('1')
+        self.assertEqual(len(playlist['tracks']), 120)
+        self.assertEqual(playlist['tracks'][60]['youtube'], 'video 60')
+        self.assertEqual(len(g.youtube.requests), 4)
+        for request in g.youtube.requests:
+            self.assertIn('If-None-Match', request.headers)
+
+    def test_get_playlist_if_playlist_has_changed(self):
+        youtube.models.get_playlist('1')
+        g.youtube.num_tracks = 160
+
+        playlist = youtube.models.get_playlist('1')
+        self.assertEqual(len(playlist['tracks']), 160)
+        self.assertEqual(playlist['tracks'][159]['name'], 'Song 159')
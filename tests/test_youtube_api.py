@@ -0,0 +1,99 @@
+from unittest import mock, TestCase
+from gepify import youtube_api
+from apiclient.errors import HttpError
+import httplib2
+import json
+import threading
+
+DISCOVERY_DOCUMENT = {
+    'rootUrl': 'https://www.googleapis.com/',
+    'servicePath': 'youtube/v3/',
+    'schemas': {
+        'SearchListResponse': {'id': 'SearchListResponse', 'type': 'object'}
+    },
+    'resources': {
+        'search': {
+            'methods': {
+                'list': {
+                    'id': 'youtube.search.list',
+                    'path': 'search',
+                    'httpMethod': 'GET',
+                    'response': {'$ref': 'SearchListResponse'},
+                    'parameters': {
+                        'q': {'type': 'string', 'location': 'query'}
+                    }
+                }
+            }
+        }
+    }
+}
+
+
+def mocked_request(uri, *args, **kwargs):
+    if 'discovery' in uri:
+        content = json.dumps(DISCOVERY_DOCUMENT).encode('utf-8')
+    else:
+        content = json.dumps({
+            'uri': uri, 'headers': kwargs.get('headers')}).encode('utf-8')
+    return httplib2.Response(
+        {'status': 200, 'content-type': 'application/json'}), content
+
+
+@mock.patch('httplib2.Http.request', side_effect=mocked_request)
+class YoutubeApiTestCase(TestCase):
+    def setUp(self):
+        youtube_api._discovery_document = None
+        youtube_api._local = threading.local()
+
+    def test_get_discovery_document(self, request):
+        self.assertEqual(
+            youtube_api.get_discovery_document(), DISCOVERY_DOCUMENT)
+        youtube_api.get_discovery_document()
+        self.assertEqual(request.call_count, 1)
+
+    def test_get_discovery_document_if_request_fails(self, request):
+        request.side_effect = lambda *args, **kwargs: (
+            httplib2.Response({'status': 503}), b'')
+        with self.assertRaises(HttpError):
+            youtube_api.get_discovery_document()
+        self.assertIsNone(youtube_api._discovery_document)
+
+    def test_get_client(self, request):
+        client = youtube_api.get_client('key')
+        self.assertIs(client, youtube_api.get_client('key'))
+        self.assertIsNot(client, youtube_api.get_client('other key'))
+
+        response = client.search().list(q='song').execute()
+        self.assertIn('q=song', response['uri'])
+        self.assertIn('key=key', response['uri'])
+        self.assertEqual(request.call_count, 2)
+
+    def test_get_client_in_different_threads(self, request):
+        clients = []
+        thread = threading.Thread(
+            target=lambda: clients.append(youtube_api.get_client('key')))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(clients[0], youtube_api.get_client('key'))
+        self.assertEqual(request.call_count, 1)
+
+    def test_get_authorized_client(self, request):
+        credentials = mock.Mock()
+        credentials.apply.side_effect = lambda headers: headers.update(
+            {'Authorization': 'Bearer user token'})
+        client = youtube_api.get_authorized_client(credentials)
+
+        response = client.search().list(q='song').execute()
+        self.assertEqual(
+            response['headers']['Authorization'], 'Bearer user token')
+
+        other_credentials = mock.Mock()
+        other_credentials.apply.side_effect = lambda headers: headers.update(
+            {'Authorization': 'Bearer other token'})
+        other_client = youtube_api.get_authorized_client(other_credentials)
+        self.assertIs(client, other_client)
+
+        response = other_client.search().list(q='song').execute()
+        self.assertEqual(
+            response['headers']['Authorization'], 'Bearer other token')